@@ -16,6 +16,8 @@ os.environ['HG_B_SIMPLE_HASHING'] = 'true'
 import b
 
 _debug = False
+# b's own bugs database, used to check it is rewritten without changes
+_own_bugs = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.bugs', 'bugs')
 
 class Test(unittest.TestCase):
         
@@ -55,6 +57,18 @@ class Test(unittest.TestCase):
         b._datetime()
         b._datetime(1310458238.24)
         
+        #_timestamp
+        self.assertEqual(b._timestamp('30d', now=100 * 86400), 70 * 86400)
+        self.assertEqual(b._timestamp('2w', now=3 * 604800), 604800)
+        self.assertEqual(b._timestamp('2018-01-02 03:04'),
+                         b._timestamp('2018-01-02') + 3 * 3600 + 4 * 60)
+        self.assertEqual(b._timestamp('1310458238.24'), 1310458238.24)
+        # small numbers are years, not seconds after the epoch
+        self.assertEqual(b._timestamp('2018'), b._timestamp('2018-01-01'))
+        self.assertEqual(b._timestamp('2018-02'), b._timestamp('2018-02-01'))
+        self.assertRaises(b.InvalidInput, b._timestamp, '12345')
+        self.assertRaises(b.InvalidInput, b._timestamp, 'yesterday')
+
         #_hash
         b._hash("test")
 
@@ -86,9 +100,16 @@ class Test(unittest.TestCase):
             self.assertRaises(IOError, b._task_from_taskline, tl)
 
         #_tasklines_from_tasks
-        b._tasklines_from_tasks([
-                                 {'text': "task", 'id':"4567"}
-                                 ])
+        self.assertEqual(b._tasklines_from_tasks([
+                                 {'text': "task", 'id':"4567", 'z':'1', 'time':1234.5,
+                                  'a':'2', 'open':'True', 'owner':''}
+                                 ]),
+                         ["task".ljust(60) + " | owner:, open:True, id:4567, time:1234.5, a:2, z:1\n"])
+
+        #_format_value
+        self.assertEqual(b._format_value(1310458238.2449), '1310458238.24')
+        self.assertEqual(b._format_value(1310458238.0), '1310458238')
+        self.assertEqual(b._format_value('1310458238.240'), '1310458238.240')
         
         #_prefixes
         prefix_gen = ['a','abb','bbb','bbbb','cdef','cghi','defg','defh','e123456789']
@@ -96,6 +117,38 @@ class Test(unittest.TestCase):
                                              'e123456789': 'e', 'cghi': 'cg', 'bbbb': 'bbbb', 
                                              'bbb': 'bbb', 'defg': 'defg'})
 
+        #_list_lines, _diff_listings
+        x, y, z = [b.Bug(task_id, task_id, text, '', True, 1.0)
+                   for task_id, text in [('a', 'x'), ('bb', 'y'), ('c', 'z')]]
+        self.assertEqual(b._list_lines([x, y], {}), ['a  - x', 'bb - y'])
+        self.assertEqual(b._list_lines([x, y], {'a': '- 2018-01-02', 'bb': '10 2018-01-02'}, 14),
+                         ['a  -  - 20...', 'bb - 10 20...'])
+        self.assertEqual(b._diff_listings(([x, y], {}, 'Found 2'), ([y, z], {}, 'Found 2')),
+                         ['- a - x', '+ c - z'])
+        self.assertEqual(b._diff_listings(([x], {}, 'Found 1'), ([x._replace(prefix='aa'), y], {}, 'Found 2')),
+                         ['+ bb - y', 'Found 2'])
+        self.assertEqual(b._diff_listings(([x, y], {}, 'Found 2'), ([x, y._replace(owner='me')], {}, 'Found 2')),
+                         ['- bb - y', '+ bb - y'])
+        self.assertEqual(b._diff_listings(([x], {'a': '1'}, 'Found 1'), ([x], {'a': '2'}, 'Found 1')),
+                         ['- a - 1 - x', '+ a - 2 - x'])
+        self.assertEqual(b._diff_listings(([], {}, 'Found 0'), ([], {}, 'Found 0')), [])
+
+        #_diff_tasks, _bug_changes
+        old = [{'id': '1', 'text': 'a', 'owner': '', 'open': 'True'},
+               {'id': '2', 'text': 'b', 'owner': 'A', 'open': 'True'},
+               {'id': '3', 'text': 'c', 'owner': '', 'open': 'True'}]
+        new = [{'id': '2', 'text': 'B', 'owner': 'C', 'open': 'False'},
+               {'id': '3', 'text': 'c', 'owner': '', 'open': 'True'},
+               {'id': '4', 'text': 'd', 'owner': '', 'open': 'True'}]
+        self.assertEqual([b._bug_changes(o, n) for o, n in b._diff_tasks(old, new)],
+                         [[('removed', None, 'a', None)],
+                          [('renamed', None, 'b', 'B'), ('reassigned', None, 'A', 'C'),
+                           ('resolved', None, None, None)],
+                          [('added', None, None, 'd')]])
+        self.assertEqual(b._bug_changes(dict(old[2], priority='low', os='mac'), dict(old[2], priority='high')),
+                         [('set', 'os', 'mac', None), ('set', 'priority', 'low', 'high')])
+        self.assertEqual(list(b._diff_tasks(new, new)), [])
+
         #_describe_print
         self.assertEqual(b._describe_print(1,True,'*',''),'Found 1 open bug')
         self.assertEqual(b._describe_print(10,True,'*',''),'Found 10 open bugs')
@@ -104,6 +157,9 @@ class Test(unittest.TestCase):
         self.assertEqual(b._describe_print(13,True,'Jack',''),'Found 13 open bugs owned by Jack')
         self.assertEqual(b._describe_print(14,True,'','Word'),'Found 14 open bugs owned by Nobody whose title contains Word')
         self.assertEqual(b._describe_print(15,True,'Jack','Word'),'Found 15 open bugs owned by Jack whose title contains Word')
+        self.assertTrue(re.match('Found 16 open bugs filed since \w+, \w+ \d\d \d\d\d\d \d\d:\d\d[A|P]M'
+                                 ' filed before \w+, \w+ \d\d \d\d\d\d \d\d:\d\d[A|P]M',
+                                 b._describe_print(16,True,'*','',1310458238.24,1310458238.24)))
 
     def test_private_methods(self):
         """Tests the private methods of BD"""
@@ -119,13 +175,10 @@ class Test(unittest.TestCase):
         self.assertEqual(self.bd['a94a']['text'], 'test')
         self.assertEqual(self.bd['afc8edc74a']['text'], 'another test')
         
-        #_get_details_path
-        id = self.bd.id('a9')
-        _,path = self.bd._get_details_path(id)
-        
         #_make_details_file
+        id = self.bd.id('a9')
         self.bd._make_details_file(id)
-        self.assertTrue(os.path.exists(path))
+        self.assertTrue(os.path.exists(self.bd.storage.details_path(id)))
         
         #_user_list
         self.bd.assign('a9', 'User', True)
@@ -135,6 +188,69 @@ class Test(unittest.TestCase):
         # tested more completely by test_users
         self.assertEqual(self.bd._get_user('us'),'User')
         
+    def test_merge(self):
+        """Tests the three-way merge of bug databases"""
+        base = b._sorted_tasks(["a | id:1, owner:, open:True, time:1",
+                                "b | id:2, owner:, open:True, time:2",
+                                "c | id:3, owner:, open:True, time:3"])
+        local = b._sorted_tasks(["c | id:3, owner:, open:True, time:3", # unsorted
+                                 "a | id:1, owner:A, open:True, time:1",
+                                 "b | id:2, owner:, open:False, time:2",
+                                 "d | id:4, owner:, open:True, time:4"])
+        other = b._sorted_tasks(["a2 | id:1, owner:, open:True, time:1",
+                                 "b | id:2, owner:B, open:True, time:2",
+                                 "e | id:5, owner:, open:True, time:5"])
+        merged, conflicts = b._merge_tasks(base, local, other)
+        self.assertEqual(conflicts, [])
+        self.assertEqual([(t['id'], t['text'], t['owner'], t['open']) for t in merged],
+                         [('1', 'a2', 'A', 'True'), ('2', 'b', 'B', 'False'),
+                          ('4', 'd', '', 'True'), ('5', 'e', '', 'True')])
+
+        other = b._sorted_tasks(["a | id:1, owner:B, open:True, time:1"])
+        merged, conflicts = b._merge_tasks(base, local, other)
+        self.assertEqual(conflicts, [('1', ['owner']), ('2', ['deleted'])])
+        self.assertEqual([(t['id'], t['owner']) for t in merged],
+                         [('1', 'A'), ('2', ''), ('4', '')])
+
+        # lines added by hand get the same id on each side, so aren't doubled
+        sides = [b._sorted_tasks(lines, 5) for lines in
+                 [["by hand"], ["by hand", "local"], ["by hand", "other"]]]
+        merged, conflicts = b._merge_tasks(*sides)
+        self.assertEqual(conflicts, [])
+        self.assertEqual(sorted(t['text'] for t in merged),
+                         ['by hand', 'local', 'other'])
+
+    def test_write_unchanged(self):
+        """Tests that writing an unmodified database doesn't change it"""
+        os.mkdir('.bugs')
+        shutil.copy(_own_bugs, '.bugs/bugs')
+        with open('.bugs/bugs') as f:
+            original = f.read()
+        b.BugsDict().write()
+        with open('.bugs/bugs') as f:
+            self.assertEqual(f.read(), original)
+
+        self.bd = b.BugsDict()
+        self.bd.add('test')
+        self.bd.user = 'User'
+        self.bd.add('another test')
+        self.bd.assign('a9', 'Someone', True)
+        self.bd.list(activity=True)
+        self.bd.write()
+        with open('.bugs/bugs') as f:
+            written = f.read()
+        self.bd = b.BugsDict()
+        self.bd.write()
+        with open('.bugs/bugs') as f:
+            self.assertEqual(f.read(), written)
+        # only the modified line differs
+        self.bd.resolve('af')
+        self.bd.write()
+        with open('.bugs/bugs') as f:
+            changed = [(old, new) for old, new in zip(written.splitlines(), f.read().splitlines()) if old != new]
+        self.assertEqual(len(changed), 1)
+        self.assertTrue('another test' in changed[0][0])
+
     def test_api(self):
         """Tests api functions that don't rely on Mercurial"""
         # Version
@@ -211,6 +327,12 @@ class Test(unittest.TestCase):
                                  'On: \w+, \w+ \d\d \d\d\d\d \d\d:\d\d[A|P]M\nResolved an issue.\n'
                                  'How nice!',
                                  self.bd.details('c')))
+        self.bd.add('another test')
+        self.assertEqual(list(self.bd.iter_details(['a', 'c'])),
+                         [self.bd.details('a'), self.bd.details('c')])
+        self.assertRaises(b.UnknownPrefix, self.bd.iter_details, ['a', 'x'])
+        self.assertEqual(list(b._prefetch(lambda i: i * i, range(50), 3)),
+                         [i * i for i in range(50)])
                         
         
     
@@ -279,6 +401,905 @@ class Test(unittest.TestCase):
         self.assertEqual(self.bd.list(grep='h'),'f1 - GHIJ\nFound 1 open bug whose title contains h')
         self.assertEqual(self.bd.list(owner='u',grep='j'),'f1 - GHIJ\n4  - JKLM\nFound 2 open bugs owned by User whose title contains j')
             
+    def test_list_time(self):
+        """Tests listing bugs filed within a time window"""
+        self.bd.add("EFGH")
+        self.bd.add("ABCD")
+        self.bd.add("IJKL")
+        for task_id, filed in zip(['a', 'f', '6'], [300, 100, 200]):
+            self.bd[task_id]['time'] = filed
+        self.assertEqual(self.bd.list(chrono=True),"f - ABCD\n6 - IJKL\na - EFGH\nFound 3 open bugs")
+        self.assertEqual(self.bd.list(chrono=True, since=150).split('\n')[:2],["6 - IJKL","a - EFGH"])
+        self.assertEqual(self.bd.list(chrono=True, until=200).split('\n')[:1],["f - ABCD"])
+        self.assertEqual(self.bd.list(since=100, until=300).split('\n')[:2],["f - ABCD","6 - IJKL"])
+        # the indexes are maintained as bugs are added
+        self.bd.add("MNOP")
+        self.assertEqual(len(self.bd.list(since=150).split('\n')), 4)
+        self.assertEqual(self.bd.list(until=100),"Found 0 open bugs filed before %s" % b._datetime(100))
+
+    def test_query(self):
+        """Tests the query language used by list -q"""
+        self.assertEqual(b._parse_query('owner:me open=true title~"a b" time>=30d'),
+                         [('owner', ':', 'me'), ('open', ':', 'true'),
+                          ('title', '~', 'a b'), ('time', '>=', '30d')])
+        self.assertRaises(b.InvalidInput, b._parse_query, 'owner')
+        self.assertRaises(b.InvalidInput, b._parse_query, 'title~"unterminated')
+
+        self.bd.add("EFGH") # a
+        self.bd.add("ABCD") # f
+        self.bd.user = 'User'
+        self.bd.add("IJKL") # 6
+        self.bd.resolve('f')
+        for task_id, filed in zip(['a', 'f', '6'], [1500000300, 1500000100, 1500000200]):
+            self.bd[task_id]['time'] = filed
+        self.bd['6']['priority'] = '10'
+        self.bd['a']['priority'] = '9'
+
+        def texts(query, chrono=True):
+            return [task['text'] for task in self.bd.query(query, chrono)]
+        self.assertEqual(texts(''), ['ABCD', 'IJKL', 'EFGH'])
+        self.assertEqual(texts('open:false'), ['ABCD'])
+        self.assertEqual(texts('owner:u'), ['IJKL'])
+        self.assertEqual(texts('owner:Nobody open:true'), ['EFGH'])
+        self.assertEqual(texts('id:a'), ['EFGH'])
+        self.assertEqual(texts('title:bc'), ['ABCD'])
+        self.assertEqual(texts('title~^[AE]'), ['ABCD', 'EFGH'])
+        self.assertEqual(texts('time>1500000100 time<=1500000300'), ['IJKL', 'EFGH'])
+        # the bugs were filed in 2017, and a bare number is a year
+        self.assertEqual(texts('time>2018'), [])
+        self.assertEqual(len(texts('time<2018')), 3)
+        self.assertEqual(texts('priority>9'), ['IJKL'])
+        self.assertEqual(texts('priority:9'), ['EFGH'])
+        self.assertRaises(b.InvalidInput, self.bd.query, 'title~[')
+
+        # compiled queries reflect later changes to the database
+        owned = self.bd.compile_query('owner:u')
+        self.bd.assign('a', 'User')
+        self.assertEqual(sorted(task['text'] for task in owned()), ['EFGH', 'IJKL'])
+
+        self.assertEqual(self.bd.list(query='open:false'),
+                         'f - ABCD\nFound 1 bug matching open:false')
+        self.assertEqual(self.bd.list(query='id:6'),
+                         '6 - IJKL\nFound 1 open bug matching id:6')
+
+    def test_iter_bugs(self):
+        """Tests iterating over bug records"""
+        self.bd.add("EFGH")
+        self.bd.add("ABCD")
+        self.bd.add("IJKL")
+        self.bd.assign('6', 'User', True)
+        self.bd.resolve('f')
+        for task_id, filed in zip(['a', 'f', '6'], [1500000300, 1500000100, 1500000200]):
+            self.bd[task_id]['time'] = filed
+
+        bugs = list(self.bd.iter_bugs(open=None, sort='time'))
+        self.assertEqual([bug.text for bug in bugs], ['ABCD', 'IJKL', 'EFGH'])
+        self.assertEqual(bugs[1], b.Bug(self.bd.id('6'), '6', 'IJKL', 'User', True, 1500000200.0))
+        self.assertRaises(AttributeError, setattr, bugs[1], 'owner', 'Other')
+        self.assertEqual([bug.prefix for bug in self.bd.iter_bugs(sort='id')], ['6', 'a'])
+        self.assertEqual([bug.text for bug in self.bd.iter_bugs(open=False)], ['ABCD'])
+        self.assertEqual([bug.text for bug in self.bd.iter_bugs(owner='u')], ['IJKL'])
+        self.assertEqual([bug.text for bug in self.bd.iter_bugs(grep='gh', query='time<1500000250')], [])
+        self.assertEqual([bug.text for bug in self.bd.iter_bugs(open=None, sort='title')],
+                         ['ABCD', 'EFGH', 'IJKL'])
+        self.assertEqual([bug.text for bug in self.bd.iter_bugs(sort=['title', 'time'])],
+                         ['EFGH', 'IJKL'])
+        self.assertRaises(b.InvalidInput, self.bd.iter_bugs, sort='owner')
+        self.assertRaises(b.UnknownUser, self.bd.iter_bugs, owner='x')
+
+        # filters are applied as the iterator is consumed
+        bugs = self.bd.iter_bugs()
+        self.bd['a']['text'] = 'Changed'
+        self.assertEqual(sorted(bug.text for bug in bugs), ['Changed', 'IJKL'])
+
+    def test_activity(self):
+        """Tests the details activity summaries used by list --activity"""
+        self.bd = b.BugsDict(cachedir='cache')
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.bd['a9']['time'] = b._timestamp('2018-01-01')
+        self.bd['af']['time'] = b._timestamp('2018-01-02')
+        self.assertEqual(self.bd.activity('a9')['details'], False)
+        self.bd.comment('a9', 'first')
+        self.bd.comment('a9', 'second')
+        self.bd._make_details_file(self.bd.id('af'))
+        summary = self.bd.activity('a9')
+        self.assertEqual(summary['comments'], 2)
+        self.assertTrue(summary['last_activity'] > b._timestamp('2018-01-02'))
+        self.assertEqual(self.bd.activity('af')['comments'], 0)
+        self.assertEqual(self.bd.list(activity=True, recent=True),
+                         'af - - 2018-01-02 - another test\n'
+                         'a9 - 2 %s - test\nFound 2 open bugs'
+                         % b.datetime.now().strftime('%Y-%m-%d'))
+
+        # only changed files are read again
+        self.bd.write()
+        for path in os.listdir('.bugs/details'):
+            os.utime(os.path.join('.bugs/details', path), (1, 1))
+        b.BugsDict(cachedir='cache')._activity_index()
+        summarize = b._details_summary
+        try:
+            b._details_summary = None
+            self.assertEqual(b.BugsDict(cachedir='cache').activity('a9')['comments'], 2)
+        finally:
+            b._details_summary = summarize
+        # an unchanged index isn't written back
+        os.utime('cache/activity', (5, 5))
+        b.BugsDict(cachedir='cache')._activity_index()
+        self.assertEqual(os.path.getmtime('cache/activity'), 5)
+        self.bd.comment('a9', 'third')
+        self.assertEqual(b.BugsDict(cachedir='cache').activity('a9')['comments'], 3)
+
+    def test_packed_details(self):
+        """Tests storing details in a pack rather than a file per bug"""
+        self.assertRaises(TypeError, b.BugsDict, packed=True)
+        self.assertRaises(TypeError, b.BugsDict, '.bugs', '', False, 'cache')
+        self.bd = b.BugsDict(cachedir='cache', storage='packed')
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.assertTrue(self.bd.details('a9').endswith('No Details File Found.'))
+        self.bd.comment('a9', 'Foo Bar')
+        self.bd.edit('af', 'sed -i "s/^# Additional details$/Some details/"')
+        self.assertFalse(os.path.exists('.bugs/details'))
+        self.assertTrue(self.bd.details('a9').endswith('Foo Bar'))
+        self.assertTrue('Some details' in self.bd.details('af'))
+        self.assertEqual(self.bd.activity('a9')['comments'], 1)
+        # editing without changes doesn't append a record
+        size = os.path.getsize('.bugs/details.pack')
+        self.bd.edit('af', 'true')
+        self.assertEqual(os.path.getsize('.bugs/details.pack'), size)
+
+        # the index is read from the cache, or rebuilt from the pack
+        self.bd.comment('a9', 'Baz')
+        self.bd.write()
+        for cachedir in ('cache', None):
+            bd = b.BugsDict(cachedir=cachedir, storage='packed')
+            self.assertTrue(bd.details('a9').endswith('Baz'))
+            self.assertEqual(bd.activity('a9')['comments'], 2)
+        os.remove('cache/details.idx')
+        with open('.bugs/details.pack', 'a') as f:
+            f.write(b._pack_record(self.bd.id('af'), 'Replaced'))
+        self.assertEqual(b.BugsDict(cachedir='cache', storage='packed').details('af')[-8:], 'Replaced')
+
+        # compaction keeps only the latest details of each bug
+        self.bd = b.BugsDict(cachedir='cache', storage='packed')
+        self.bd.compact_details()
+        self.assertEqual(len(b._read_pack('.bugs/details.pack')), 2)
+        with open('.bugs/details.pack') as f:
+            self.assertEqual(f.read().count('Foo Bar'), 1)
+        self.assertTrue(self.bd.details('a9').endswith('Baz'))
+        self.assertEqual(b.BugsDict(storage='packed').details('af')[-8:], 'Replaced')
+
+        # packed mode still reads existing details files
+        b.BugsDict()._make_details_file('a' * 40)
+        self.assertEqual(b.BugsDict(storage='packed')._read_details('a' * 40),
+                         self.bd.init_details)
+
+    def test_archive(self):
+        """Tests moving resolved bugs to the archive"""
+        self.bd = b.BugsDict(archive=True)
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.bd.resolve('a9')
+        self.bd.write()
+        with open('.bugs/archive') as f:
+            self.assertTrue(f.read().startswith('test '))
+        with open('.bugs/bugs') as f:
+            self.assertFalse('a9' in f.read())
+
+        # the archive is only read when needed
+        self.bd = b.BugsDict(archive=True)
+        # prefixes only need to be unique among the open bugs
+        self.assertEqual(self.bd.list(), 'a - another test\nFound 1 open bug')
+        self.assertEqual(self.bd.id('a'), self.bd.id('af'))
+        self.assertEqual(self.bd._archived, None)
+        self.assertTrue(self.bd.details('a9').startswith('Title: test'))
+        self.assertEqual(self.bd._archived, set([self.bd.id('a9')]))
+        self.assertEqual(b.BugsDict().list(False), 'a9 - test\nFound 1 resolved bug')
+        self.assertEqual(sorted(b.BugsDict().list(None).split('\n')),
+                         ['Found 2 bugs', 'a9 - test', 'af - another test'])
+        self.assertTrue('Nobody: 1' in b.BugsDict().users())
+
+        # reopening moves bugs back, even if archiving was turned off
+        self.bd = b.BugsDict()
+        self.bd.reopen('a9')
+        self.bd.write()
+        self.assertEqual(os.path.getsize('.bugs/archive'), 0)
+        self.bd = b.BugsDict()
+        self.bd.resolve('af')
+        self.bd.write()
+        self.assertEqual(os.path.getsize('.bugs/archive'), 0)
+        self.assertEqual(b.BugsDict(archive=True).list(False), 'af - another test\nFound 1 resolved bug')
+
+        # resolved bugs in the bugs file are archived on the next write
+        b.BugsDict(archive=True).write()
+        self.assertEqual(b.BugsDict().list(), 'a - test\nFound 1 open bug')
+        with open('.bugs/archive') as f:
+            self.assertTrue(f.read().startswith('another test '))
+
+    def test_lazy(self):
+        """Tests looking up bugs without parsing the whole bugs file"""
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.bd.add("a | bug")
+        self.bd.write()
+        self.bd = b.BugsDict(lazy=True)
+        self.assertFalse('bugs' in self.bd.__dict__)
+        self.assertEqual(self.bd['a9']['text'], 'test')
+        self.assertEqual(self.bd._prefix(self.bd._matches('af')[0]), 'af')
+        self.bd['a9']['owner'] = 'User'
+        self.bd.comment('a9', 'comment')
+        self.assertTrue(self.bd.details('8').startswith('Title: a | bug'))
+        self.assertEqual(sorted(self.bd._parsed), sorted([self.bd.id('a9'), self.bd.id('8')]))
+        self.assertFalse('bugs' in self.bd.__dict__)
+        # the full table is parsed when needed, keeping changes
+        self.assertEqual(len(self.bd.bugs), 3)
+        self.bd.write()
+        self.assertEqual(b.BugsDict(lazy=True)['a9']['owner'], 'User')
+
+        # lines without an id need the whole file to be parsed
+        with open('.bugs/bugs', 'a') as f:
+            f.write('new bug\n')
+        self.bd = b.BugsDict(lazy=True)
+        self.assertTrue('bugs' in self.bd.__dict__)
+        self.assertEqual(len(self.bd.bugs), 4)
+
+    def test_bounded(self):
+        """Tests streaming over the bugs files rather than reading them"""
+        self.assertEqual(list(b._external_sort(['c\n', 'a\n', 'b\n', 'd\n', 'a\n'], str.strip, 4)),
+                         ['a\n', 'a\n', 'b\n', 'c\n', 'd\n'])
+        self.assertEqual(list(b._external_sort(['b\n', 'a\n'], str.strip, 100)), ['a\n', 'b\n'])
+        for text in ["test", "another test", "a | bug", "third test", "fourth"]:
+            self.bd.add(text)
+        self.bd.assign('8', 'User', True)
+        self.bd.resolve('af')
+        self.bd.write()
+        expected = (self.bd.list(alpha=True), self.bd.list(is_open=False), self.bd.users())
+        with open('.bugs/bugs') as f:
+            written = f.read()
+
+        self.bd = b.BugsDict(budget=1)
+        self.assertFalse('bugs' in self.bd.__dict__)
+        self.assertEqual((self.bd.list(alpha=True), self.bd.list(is_open=False), self.bd.users()), expected)
+        self.assertEqual([bug.prefix for bug in self.bd.iter_bugs(owner='User')], ['8'])
+        self.assertRaises(b.AmbiguousPrefix, self.bd.id, 'a')
+        self.assertEqual(self.bd['a9']['text'], 'test')
+        self.bd.write()
+        with open('.bugs/bugs') as f:
+            self.assertEqual(f.read(), written)
+
+        # changes are merged into the files, sorting them in runs
+        self.bd.rename('a9', 'renamed test')
+        self.bd.resolve('8')
+        self.assertTrue(self.bd.add("new bug").startswith("Added bug"))
+        new = self.bd.last_added_id
+        self.assertFalse('bugs' in self.bd.__dict__)
+        self.bd.write()
+        self.bd = b.BugsDict()
+        self.assertEqual(self.bd['a9']['text'], 'renamed test')
+        self.assertFalse(b._truth(self.bd['8']['open']))
+        self.assertEqual(self.bd.id(new[:5]), new)
+        tasks = self.bd._read_tasks('bugs')
+        self.assertEqual([task['id'] for task in tasks], sorted(self.bd.bugs))
+
+        # archived bugs are found, and moved, without reading everything
+        self.bd = b.BugsDict(archive=True, budget=1)
+        self.bd.resolve(new)
+        self.bd.write()
+        self.assertEqual(len(self.bd._read_tasks('archive')), 1)
+        self.bd = b.BugsDict(archive=True, budget=1)
+        self.bd.reopen(new)
+        self.assertEqual(self.bd.list(grep="new"), "%s - new bug\nFound 1 open bug whose title contains new" % self.bd._prefix(new))
+        self.bd.write()
+        self.assertEqual(len(self.bd._read_tasks('archive')), 0)
+
+        # commands which need every bug read them, keeping changes
+        self.bd = b.BugsDict(budget=1)
+        self.bd.rename(new, "newer bug")
+        self.assertEqual(len(self.bd.bugs), 6)
+        self.assertEqual(self.bd.bugs[new]['text'], "newer bug")
+        self.bd.write()
+        self.assertEqual(b.BugsDict()[new]['text'], "newer bug")
+
+        # a bug in both files, archived while reopened on another branch, is
+        # counted once
+        with open('.bugs/bugs') as f:
+            line = [l for l in f if new in l][0]
+        with open('.bugs/archive', 'w') as f:
+            f.write(line)
+        expected = (self.bd.list(), b.BugsDict().users())
+        self.bd = b.BugsDict(budget=1)
+        self.assertEqual((self.bd.list(), self.bd.users()), expected)
+        self.assertTrue("Nobody: 4" in expected[1])
+
+    def test_verify(self):
+        """Tests checking for, and repairing, problems in the database"""
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.bd.comment('a9', 'comment')
+        self.bd.write()
+        self.assertEqual(self.bd.verify(), ("Found 0 problems", 0))
+        with open('.bugs/bugs') as f:
+            lines = f.readlines()
+        with open('.bugs/bugs', 'a') as f:
+            f.write(lines[0].replace('test', 'dupe'))
+            f.write('no id | owner:, open:yes\n')
+            f.write('hand added\n')
+            f.write('bad | line | id=1\n')
+        with open('.bugs/details/0123.txt', 'w') as f:
+            f.write('orphan')
+        with open('.bugs/details/%s.txt' % self.bd.id('af'), 'w') as f:
+            f.write('<<<<<<< local\nmine\n=======\ntheirs\n>>>>>>> other\n')
+        with open('.bugs/details/%s.txt.orig' % self.bd.id('a9'), 'w') as f:
+            f.write('left by merge')
+        report, remaining = b.BugsDict(budget=0).verify()
+        self.assertEqual(remaining, 7)
+        self.assertEqual(report.split('\n'), [
+            'bugs:4: missing id, time',
+            'bugs:4: invalid open value yes',
+            'bugs:6: malformed line',
+            'bugs:1: duplicate id %s, superseded by bugs:3' % self.bd.id('a9'),
+            'details/0123.txt: no bug with this id',
+            'details/%s.txt.orig: not a details file' % self.bd.id('a9'),
+            'details/%s.txt: unresolved merge conflict' % self.bd.id('af'),
+            'Found 7 problems'])
+        # nothing which the malformed line could need is repaired
+        report, remaining = b.BugsDict(budget=0).verify(repair=True)
+        self.assertEqual(remaining, 6)
+        self.assertTrue(os.path.exists('.bugs/details/0123.txt'))
+        self.assertFalse(os.path.exists('.bugs/details/%s.txt.orig' % self.bd.id('a9')))
+        with open('.bugs/bugs') as f:
+            lines = f.readlines()
+        with open('.bugs/bugs', 'w') as f:
+            f.writelines(lines[:5])
+        report, remaining = b.BugsDict(budget=0).verify(repair=True)
+        self.assertEqual(remaining, 1)
+        self.assertTrue(report.endswith('Found 5 problems, repaired 4'))
+        self.assertFalse(os.path.exists('.bugs/details/0123.txt'))
+        self.bd = b.BugsDict()
+        self.assertEqual(len(self.bd.bugs), 4)
+        self.assertEqual(self.bd['a9']['text'], 'dupe')
+        self.assertEqual(b.BugsDict(budget=0).verify()[1], 1)
+
+        # conflict markers in the bugs file aren't taken for hand added bugs
+        with open('.bugs/bugs', 'w') as f:
+            f.writelines(lines[:2] + ['<<<<<<< local\n', 'mine\n', '=======\n', 'theirs\n',
+                                      '>>>>>>> other\n'])
+        report, remaining = b.BugsDict(budget=0).verify(repair=True)
+        self.assertEqual(report.split('\n')[:3], [
+            'bugs:3: unresolved merge conflict',
+            'bugs:5: unresolved merge conflict',
+            'bugs:7: unresolved merge conflict'])
+        with open('.bugs/bugs') as f:
+            self.assertEqual(f.readlines()[2], '<<<<<<< local\n')
+        # and files without repairable problems aren't rewritten
+        with open('.bugs/bugs', 'w') as f:
+            f.writelines(lines[:2])
+        os.utime('.bugs/bugs', (1, 1))
+        b.BugsDict(budget=0).verify(repair=True)
+        self.assertEqual(os.path.getmtime('.bugs/bugs'), 1)
+
+        # the details pack
+        self.bd = b.BugsDict(storage='packed')
+        self.bd.comment('af', 'packed')
+        with open('.bugs/details.pack', 'a') as f:
+            f.write(b._pack_record('0123', 'orphan') + '0456 100\ntruncated')
+        self.assertRaises(IOError, b.BugsDict(storage='packed').details, 'af')
+        self.assertRaises(IOError, b._read_pack, '.bugs/details.pack')
+        self.assertRaises(IOError, b._parse_pack, 'not a header\n')
+        report, remaining = self.bd.verify(repair=True)
+        self.assertTrue('details.pack: corrupt record at byte' in report)
+        self.assertTrue('details.pack: details of unknown bug 0123 (repaired)' in report)
+        self.assertEqual(b._read_pack('.bugs/details.pack').keys(), [self.bd.id('af')])
+        self.assertTrue('packed' in b.BugsDict(storage='packed').details('af'))
+
+    def test_sql(self):
+        """Tests querying the SQLite mirror of the bugs"""
+        import sqlite3
+        self.bd = b.BugsDict(cachedir='cache', archive=True)
+        self.bd.add("test")
+        self.bd.add("another test")
+        self.bd.add("third")
+        self.bd.comment('a9', 'a crash')
+        self.bd.resolve('af')
+        self.bd.write()
+        self.assertEqual(self.bd.sql("SELECT title, open, archived FROM bugs ORDER BY title"),
+                         (['title', 'open', 'archived'], [('another test', 0, 1), ('test', 1, 0), ('third', 1, 0)]))
+        self.assertEqual(self.bd.sql("SELECT title FROM search WHERE search MATCH ?", ('crash',))[1], [('test',)])
+        self.assertRaises(b.InvalidInput, self.bd.sql, "DELETE FROM bugs")
+        self.assertRaises(b.InvalidInput, self.bd.sql, "SELECT nothing FROM bugs")
+
+        # only the bugs which changed are synchronised
+        conn = sqlite3.connect('cache/bugs.sqlite')
+        with conn:
+            conn.execute("UPDATE bugs SET title = 'stale' WHERE title = 'third'")
+        conn.close()
+        self.bd.rename('a9', 'renamed')
+        self.bd.assign('a9', 'User', True)
+        self.bd.reopen('af')
+        self.bd.write()
+        self.bd.comment('af', 'crashed')
+        self.assertEqual(self.bd.sql("SELECT title, owner, archived FROM bugs ORDER BY title")[1],
+                         [('another test', '', 0), ('renamed', 'User', 0), ('stale', '', 0)])
+        self.assertEqual(self.bd.sql("SELECT title FROM search WHERE details MATCH 'crash*' ORDER BY title")[1],
+                         [('another test',), ('renamed',)])
+        self.assertEqual(b.BugsDict().sql("SELECT count(*) FROM bugs")[1], [(3,)])
+
+    def test_dupes(self):
+        """Tests finding bugs with similar titles"""
+        self.assertEqual(b._shingles("Crash, on START"), set(['cra', 'ras', 'ash', 'sh ', 'h o', ' on', 'on ',
+                                                              'n s', ' st', 'sta', 'tar', 'art']))
+        self.assertEqual(b._shingles("a!"), set(['a']))
+        self.assertEqual(len(b._minhash(b._shingles("a title"))), b._MINHASH_SIZE)
+        self.assertEqual(b._jaccard(set('ab'), set('bc')), 1 / 3.0)
+        self.bd = b.BugsDict(cachedir='cache')
+        self.bd.add("Crash when opening a file")
+        crash = self.bd.last_added_id
+        self.bd.add("Crash when opening files")
+        files = self.bd.last_added_id
+        self.bd.add("Typo in the manual")
+        self.bd.add("Fix typos in the manual")
+        self.bd.add("Something else entirely")
+        self.assertEqual([task_id for _s, task_id in self.bd.duplicates("crash opening a file")], [crash, files])
+        self.assertEqual([task_id for _s, task_id in self.bd.duplicates("Crash when opening a file", exclude=crash)],
+                         [files])
+        self.assertEqual(self.bd.duplicates("Nothing like the others"), [])
+        dupes = self.bd.dupes()
+        self.assertTrue(dupes.endswith("Found 2 groups of possible duplicates"))
+        self.assertFalse("Something else" in dupes)
+        # the index is updated by add and rename, and persisted
+        self.bd.rename(crash, "Something else, entirely")
+        self.assertTrue(crash in [task_id for _s, task_id in self.bd.duplicates("Something else entirely")])
+        self.bd.write()
+        self.bd = b.BugsDict(cachedir='cache')
+        self.assertEqual(len(self.bd.duplicates("Something else entirely")), 2)
+        self.bd.resolve(crash)
+        self.assertEqual(len(self.bd.duplicates("Something else entirely")), 1)
+        # the renamed bug's signature was appended, and the index stamped
+        with open('cache/dupes') as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 8)
+        self.assertTrue(lines[-2].startswith(crash))
+        self.assertTrue(lines[-1].startswith('@ '))
+
+        # a stamped index isn't checked against the titles
+        title_crc = b.BugsDict._title_crc
+        try:
+            b.BugsDict._title_crc = None
+            self.bd = b.BugsDict(cachedir='cache')
+            self.assertEqual(len(self.bd.duplicates("Something else entirely")), 2)
+        finally:
+            b.BugsDict._title_crc = title_crc
+        self.bd.rename(files, "Something else")
+        self.assertEqual(len(self.bd.duplicates("Something else entirely")), 3)
+        # unless the bugs changed since
+        with open('.bugs/bugs') as f:
+            text = f.read()
+        with open('.bugs/bugs', 'w') as f:
+            f.write(text.replace('Typo in the manual', 'Something else entirely!'))
+        self.assertEqual(len(b.BugsDict(cachedir='cache').duplicates("Something else entirely")), 3)
+
+        # pairs sharing several bands are compared once, and huge bands skipped
+        jaccard, max_bucket = b._jaccard, b._LSH_MAX_BUCKET
+        compared = []
+        try:
+            b._jaccard = lambda x, y: compared.append((id(x), id(y))) or jaccard(x, y)
+            b.BugsDict().dupes(1.0)
+            self.assertTrue(compared)
+            self.assertEqual(len(compared), len(set(compared)))
+            b._LSH_MAX_BUCKET = 1
+            del compared[:]
+            b.BugsDict().dupes(0.0)
+            self.assertEqual(compared, [])
+        finally:
+            b._jaccard, b._LSH_MAX_BUCKET = jaccard, max_bucket
+
+    def test_web(self):
+        """Tests the pages served by the web command"""
+        import json
+        self.bd.add("test")
+        self.bd.add("another <test>")
+        self.bd.assign('a9', 'User', True)
+        self.bd.resolve(self.bd.last_added_id)
+        self.bd.write()
+        loads = []
+        def make_bd():
+            loads.append(True)
+            return b.BugsDict()
+        view = b._WebView(make_bd)
+
+        status, content_type, body, etag = view.respond('/')
+        self.assertEqual((status, content_type), (200, 'text/html; charset=utf-8'))
+        self.assertTrue('>a</a></td><td>test</td><td>User</td>' in body)
+        self.assertTrue('another' not in body)
+        body = view.respond('/?open=all&sort=title')[2]
+        self.assertTrue('another &lt;test&gt;' in body)
+        self.assertTrue(body.index('another') < body.index('>test<'))
+        self.assertTrue('Title: test' in view.respond('/bug/a9')[2])
+        self.assertTrue('<td>User</td><td>1</td>' in view.respond('/users')[2])
+
+        bugs = json.loads(view.respond('/api/bugs?open=false')[2])
+        self.assertEqual([(bug['text'], bug['open']) for bug in bugs], [('another <test>', False)])
+        bug = json.loads(view.respond('/api/bugs/a9')[2])
+        self.assertEqual((bug['owner'], bug['details']), ('User', None))
+        self.assertEqual(json.loads(view.respond('/api/users')[2]), {'User': 1, 'Nobody': 0})
+        self.assertEqual(view.respond('/bug/c')[0], 404)
+        self.assertEqual(view.respond('/api/bugs?owner=x')[0], 404)
+        self.assertEqual(view.respond('/api/bugs?sort=foo')[0], 400)
+        self.assertEqual(view.respond('/foo')[0], 404)
+
+        # unchanged responses aren't rendered again, changes are reloaded
+        self.assertEqual(view.respond('/', etag)[:3], (304, None, ''))
+        self.assertEqual(view.respond('/', '"foo", ' + etag)[0], 304)
+        self.assertEqual(view.respond('/users', etag)[0], 200)
+        self.assertEqual(len(loads), 1)
+        self.bd.comment('a9', 'comment')
+        self.assertEqual(view.respond('/', etag)[0], 200)
+        self.assertEqual(len(loads), 2)
+        self.assertTrue('comment' in json.loads(view.respond('/api/bugs/a')[2])['details'])
+
+    def test_bugsdir(self):
+        """Tests a bugs directory under ~, or relative to the working
+        directory, is found once the working directory changes"""
+        home = os.environ.get('HOME')
+        os.environ['HOME'] = self.dir
+        try:
+            bd = b.BugsDict('~/home-bugs')
+        finally:
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+        bd.add('Home bug')
+        bd.comment(bd.last_added_id, 'Home comment')
+        bd.write()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.dir, 'home-bugs', 'details', bd.last_added_id + '.txt')))
+        bd = b.BugsDict('relative-bugs')
+        os.mkdir('elsewhere')
+        os.chdir('elsewhere')
+        bd.add('Relative bug')
+        bd.comment(bd.last_added_id, 'Relative comment')
+        bd.write()
+        os.chdir(self.dir)
+        self.assertTrue('Relative comment' in b.BugsDict('relative-bugs')
+                        .details(bd.last_added_id))
+
+    def test_storage(self):
+        """Runs each storage backend through the same conformance checks"""
+        self.assertRaises(b.InvalidInput, b.BugsDict, storage='nonesuch')
+
+        class Incomplete(b.Storage):
+            def records(self, name):
+                return iter([])
+        self.assertRaises(TypeError, Incomplete, 'incomplete')
+        for name in sorted(b._STORAGE):
+            storage = b._STORAGE[name](name, 'cache-' + name)
+            self.assertFalse(storage.exists('bugs'), name)
+            self.assertEqual((storage.size('bugs'), storage.load('bugs'),
+                              storage.find('bugs', 'a' * 40)), (0, [], None))
+            bd = b.BugsDict(name, storage=storage)
+            for i in range(5):
+                bd.add('Storage bug %d' % i)
+            # times as they're read back, rather than as add() made them
+            tasks = sorted((dict(task, time=str(1500000000 + i)) for i, task
+                            in enumerate(bd.bugs.values())),
+                           key=lambda task: task['id'])
+            ids = [task['id'] for task in tasks]
+            storage.save('bugs', tasks)
+            self.assertTrue(storage.exists('bugs'), name)
+            self.assertTrue(storage.size('bugs') > 0, name)
+            self.assertEqual(storage.load('bugs'), tasks, name)
+            self.assertEqual([task_id for task_id, _r in storage.records('bugs')],
+                             ids, name)
+            for (task_id, record), task in zip(storage.records('bugs'), tasks):
+                self.assertEqual(storage.parse(record), task, name)
+            self.assertEqual(storage.find('bugs', ids[2]), tasks[2], name)
+            scanned = storage.scan('bugs')
+            if scanned is not None:
+                self.assertEqual(sorted(scanned), ids, name)
+            # update() replaces, adds and removes bugs, keeping the others
+            stats = storage.stats()
+            changed = dict(tasks[0], open='False')
+            added = dict(tasks[1], id='0' * 40)
+            storage.update('bugs', [changed, added], [ids[1]], 100)
+            self.assertNotEqual(storage.stats(), stats, name)
+            self.assertEqual(storage.load('bugs'),
+                             [added, changed] + tasks[2:], name)
+
+            self.assertEqual(storage.read_details(ids[0]), None)
+            self.assertEqual(storage.details_summary(ids[0]), None)
+            stats = storage.stats(True)
+            storage.append_details(ids[0], ' more', 'initial')
+            self.assertEqual(storage.read_details(ids[0]), 'initial more')
+            storage.write_details(ids[0], 'replaced')
+            storage.append_details(ids[0], '!')
+            self.assertEqual(storage.read_details(ids[0]), 'replaced!', name)
+            self.assertNotEqual(storage.stats(True), stats, name)
+            path = storage.details_path(ids[0])
+            if path is not None:
+                with open(path) as f:
+                    self.assertEqual(f.read(), 'replaced!', name)
+            summaries = storage.details_summaries({})
+            self.assertEqual(summaries.keys(), [ids[0]], name)
+            self.assertEqual(summaries[ids[0]], storage.details_summary(ids[0]))
+            self.assertEqual(summaries[ids[0]]['comments'], 0)
+            self.assertEqual(storage.details_summaries(summaries), summaries)
+            self.assertTrue(storage.details_files(ids[0]), name)
+            storage.compact()
+            storage.refresh()
+            self.assertEqual(storage.read_details(ids[0]), 'replaced!', name)
+
+            self.assertEqual(list(storage.events()), [], name)
+            self.assertRaises(KeyError, list, storage.events('0-abc'))
+            storage.append_events([{'id': 'e1', 'op': 'add'},
+                                   {'id': 'e2', 'op': 'resolve'}])
+            events = list(storage.events())
+            self.assertEqual([event for _c, event in events],
+                             [{'id': 'e1', 'op': 'add'},
+                              {'id': 'e2', 'op': 'resolve'}], name)
+            storage.append_events([{'id': 'e3', 'op': 'reopen'}])
+            self.assertEqual([event['id'] for _c, event
+                              in storage.events(events[-1][0])], ['e3'], name)
+            self.assertEqual([event['id'] for _c, event
+                              in storage.events(events[0][0])], ['e2', 'e3'])
+
+            # and each behaves the same behind a BugsDict, however it's read
+            bugsdir = name + '-bd'
+            bd = b.BugsDict(bugsdir, storage=name)
+            bd.add('Stored bug')
+            first = bd.last_added_id
+            bd.add('Another stored bug')
+            bd.comment(first, 'Stored comment')
+            bd.resolve(bd.last_added_id)
+            bd.write()
+            for bd in (b.BugsDict(bugsdir, storage=name),
+                       b.BugsDict(bugsdir, storage=name, lazy=True),
+                       b.BugsDict(bugsdir, storage=name, budget=0)):
+                self.assertTrue('Stored comment' in bd.details(first), name)
+                self.assertEqual(bd.activity(first)['comments'], 1, name)
+                self.assertEqual(bd.list(is_open=None, alpha=True)
+                                 .splitlines()[-1], "Found 2 bugs", name)
+                self.assertEqual(bd.list(is_open=False).splitlines()[0][-20:],
+                                 "- Another stored bug", name)
+
+    def test_sharded_storage(self):
+        """Tests the sharded storage only reads and writes the shards it needs
+        to, and migrating bugs between storage backends"""
+        for i in range(20):
+            self.bd.add('Sharded bug %d' % i)
+        first = self.bd.last_added_id
+        self.bd.comment(first, 'Migrated comment')
+        self.bd.write()
+        self.assertEqual(self.bd.migrate('sharded').split(',')[0],
+                         'Moved 20 bugs to sharded storage')
+        self.assertFalse(os.path.exists('.bugs/bugs'))
+        shards = sorted(os.listdir('.bugs/bugs.d'))
+        self.assertEqual(shards, sorted(set(task_id[:2] for task_id
+                                            in self.bd.bugs)))
+        self.assertRaises(b.InvalidInput, self.bd.migrate, 'sharded')
+
+        # a change only rewrites its shard
+        bd = b.BugsDict(storage='sharded')
+        for shard in shards:
+            os.utime(os.path.join('.bugs/bugs.d', shard), (1, 1))
+        bd.rename(first, 'Renamed')
+        bd.write()
+        touched = [shard for shard in shards if
+                   os.path.getmtime(os.path.join('.bugs/bugs.d', shard)) != 1]
+        self.assertEqual(touched, [first[:2]])
+
+        # and while streaming or lazy, so do lookups, and finding a prefix
+        # only reads the shards sharing its first character
+        other = [shard for shard in shards if shard[0] != first[0]][-1]
+        with open(os.path.join('.bugs/bugs.d', other), 'w') as f:
+            f.write('unparseable\n')
+        for bd in (b.BugsDict(storage='sharded', budget=0),
+                   b.BugsDict(storage='sharded', lazy=True)):
+            self.assertEqual(bd[first[:8]]['text'], 'Renamed')
+            self.assertEqual(bd._prefix(first), b._prefixes(self.bd.bugs)[first])
+        bd.rename(first, 'Renamed again')
+        bd.write()
+        os.remove(os.path.join('.bugs/bugs.d', other))
+        self.assertEqual(b.BugsDict(storage='sharded')[first]['text'], 'Renamed again')
+
+        bd = b.BugsDict(storage='sharded')
+        bd.migrate('packed')
+        self.assertFalse(os.path.exists('.bugs/bugs.d'))
+        self.assertFalse(os.path.exists('.bugs/details'))
+        bd = b.BugsDict(storage='packed')
+        self.assertTrue('Migrated comment' in bd.details(first))
+        bd.migrate('text')
+        self.assertFalse(os.path.exists('.bugs/details.pack'))
+        self.assertTrue('Migrated comment' in b.BugsDict().details(first))
+
+    def test_fix(self):
+        """Tests resolving the bugs changesets say they fix"""
+        ids = []
+        for title in ('First', 'Second', 'Third'):
+            self.bd.add(title)
+            ids.append(self.bd.last_added_id)
+        messages = self.bd.fix([
+            ('abc', 'Dev', 'Fixes %s, %s\n\nand more' % (ids[0][:6], ids[1])),
+            ('def', 'Dev', 'Also closed %s, not fixing %s' % (ids[0][:6],
+                                                              ids[2][:6])),
+            ('fed', 'Dev', 'fixes ffff00'),
+        ])
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith('Resolved'))
+        self.assertTrue('(fixed in changeset abc)' in messages[1])
+        self.assertTrue(messages[2].startswith('Changeset fed: '))
+        self.assertEqual([self.bd[task_id]['open'] for task_id in ids],
+                         ['False', 'False', 'True'])
+        self.assertTrue('Fixed in changeset abc by Dev: Fixes'
+                        in self.bd.details(ids[0]))
+
+        # words spelt in hex aren't bug ids, unless marked with #
+        self.assertEqual(b._fix_refs('Fixes added tests, fixes face detection'), [])
+        self.assertEqual(b._fix_refs('FIXES 3F2A, #beef and fixes 3f2a5zz'), ['3f2a', 'beef'])
+
+        class Changeset(object):
+            def description(self):
+                return 'Added face detection, see 3f2a and #beef'
+            def files(self):
+                return ['.bugs/details/%s.txt' % ids[0], 'README']
+        self.assertEqual(b._commit_refs(Changeset(), '.bugs'),
+                         set(['3f2a', 'beef', ids[0]]))
+
+    def test_feed(self):
+        """Tests the change feed records each change once it's written"""
+        self.assertEqual(list(self.bd.events()), [])
+        self.bd.add('Not recorded')
+        self.bd.write()
+        self.assertEqual(list(self.bd.events()), [])
+
+        self.bd = b.BugsDict(user='Me', feed=True)
+        self.bd.add('First')
+        first = self.bd.last_added_id
+        self.bd.add('Second')
+        self.assertEqual(list(b.BugsDict().events()), [])
+        self.bd.write()
+        events = list(self.bd.events())
+        self.assertEqual([(e['op'], e['title'], e['owner'], e['user'])
+                          for _c, e in events],
+                         [('add', 'First', 'Me', 'Me'),
+                          ('add', 'Second', 'Me', 'Me')])
+        cursor = events[-1][0]
+        self.assertEqual(list(self.bd.events(cursor)), [])
+
+        self.bd.rename(first, 'Renamed')
+        self.bd.assign(first, 'Someone', True)
+        self.bd.resolve(first)
+        self.bd.reopen(first)
+        self.bd.write()
+        self.bd.comment(first, 'Commented')  # written straight away
+        events = [e for _c, e in b.BugsDict().events(cursor)]
+        self.assertEqual([e['op'] for e in events],
+                         ['rename', 'assign', 'resolve', 'reopen', 'comment'])
+        self.assertTrue(all(e['bug'] == first for e in events))
+        self.assertEqual((events[0]['from'], events[0]['title']),
+                         ('First', 'Renamed'))
+        self.assertEqual((events[1]['from'], events[1]['owner']),
+                         ('Me', 'Someone'))
+        self.assertEqual(events[4]['comment'], 'Commented')
+        self.assertEqual(len(set(e['id'] for e in events)), len(events))
+        self.assertRaises(b.InvalidInput, list, self.bd.events('12-nonesuch'))
+
+        # a comment doesn't publish changes which haven't been written
+        self.bd.rename(first, 'Unwritten')
+        self.bd.comment(first, 'Commented again')
+        self.assertEqual([e['op'] for _c, e in b.BugsDict().events(cursor)],
+                         ['rename', 'assign', 'resolve', 'reopen', 'comment',
+                          'comment'])
+        self.bd.write()
+        self.assertEqual(list(b.BugsDict().events(cursor))[-1][1]['title'],
+                         'Unwritten')
+        # and a streamed write publishes them as well
+        bd = b.BugsDict(feed=True, budget=0)
+        bd.rename(first, 'Streamed')
+        bd.write()
+        self.assertEqual(list(b.BugsDict().events(cursor))[-1][1]['title'],
+                         'Streamed')
+        # the same change twice in one tick of the clock gets two ids
+        time = b.time.time
+        b.time.time = lambda: 1500000000.0
+        try:
+            self.bd.set(first, 'priority', 'high')
+            self.bd.set(first, 'priority', 'high')
+        finally:
+            b.time.time = time
+        self.assertNotEqual(self.bd._events[0]['id'],
+                            self.bd._events[1]['id'])
+        self.bd._events = []
+
+        # a merge appends the other side's events, so cursors stay valid
+        with open('.bugs/feed') as f:
+            lines = f.readlines()
+        self.assertEqual(b._merge_feeds(lines[:3], lines[:2] + lines[4:]),
+                         lines[4:])
+        with open('.bugs/feed', 'w') as f:
+            f.writelines(lines[1:])
+        self.assertEqual(len(list(b.BugsDict().events(cursor))), 8)
+
+    def test_fields(self):
+        """Tests setting custom fields, and filtering and sorting on them"""
+        ids = []
+        for title, priority in [('Low', 'low'), ('High', 'high'),
+                                ('Unset', ''), ('Also high', 'high')]:
+            self.bd.add(title)
+            ids.append(self.bd.last_added_id)
+            if priority:
+                self.bd.set(ids[-1], 'priority', priority)
+        self.assertEqual(self.bd[ids[0]]['priority'], 'low')
+        for field, value in [('time', '1'), ('text', 'x'), ('a b', 'x'),
+                             ('priority', 'a,b'), ('priority', 'a|b')]:
+            self.assertRaises(b.InvalidInput, self.bd.set, ids[0], field,
+                              value)
+        self.bd.write()
+
+        bd = b.BugsDict()
+        self.assertEqual(
+            [t.text for t in bd.iter_bugs(fields=[('priority', 'high')],
+                                          sort='title')], ['Also high', 'High'])
+        self.assertEqual(len(bd.query('priority:low')), 1)
+        # the index is kept up to date once it's been built
+        bd.set(ids[1], 'priority', 'low')
+        bd.set(ids[0], 'priority', '')
+        self.assertTrue('priority' not in bd[ids[0]])
+        self.assertEqual([t['text'] for t in bd.query('priority:low')], ['High'])
+        self.assertEqual([t['text'] for t in bd.query('priority:high')],
+                         ['Also high'])
+        self.assertEqual([t.text for t in bd.iter_bugs(sort=['priority',
+                                                             'title'])],
+                         ['Also high', 'High', 'Low', 'Unset'])
+        self.assertRaises(b.InvalidInput, bd.iter_bugs, sort='-x')
+
+    def test_storage_speed(self):
+        """Times each storage backend saving, reading and updating a large
+        table, and appending to and reading the details of many bugs."""
+        timelimit = 4   # seconds to allow each backend to run
+        numbugs = 10000
+        self.bd.fast_add = True
+        for i in range(0, numbugs):
+            self.bd.add('This is bug %s - be nice to it' % str(i))
+        tasks = sorted(self.bd.bugs.values(), key=lambda task: task['id'])
+
+        import timeit
+        for name in sorted(b._STORAGE):
+            storage = b._STORAGE[name](name, 'cache-' + name)
+            def run():
+                storage.save('bugs', tasks)
+                self.assertEqual(len(storage.load('bugs')), numbugs)
+                storage.scan('bugs')
+                storage.find('bugs', tasks[-1]['id'])
+                storage.update('bugs', tasks[:100], [], 1 << 20)
+                for task in tasks[:500]:
+                    storage.append_details(task['id'], 'comment', 'details')
+                    storage.read_details(task['id'])
+                storage.details_summaries({})
+            time = timeit.Timer(run).timeit(1)
+            if _debug:
+                print("%s storage: %.3f seconds" % (name, time))
+            msg = ("The %s storage took %.3f seconds - not allowed to exceed "
+                   "%s seconds." % (name, time, timelimit))
+            self.assertTrue(time <= timelimit, msg)
+
+    def test_merge_packs(self):
+        """Tests merging details packs by bug"""
+        base = {'1': 'one', '2': 'two', '3': 'three'}
+        local = {'1': 'one local', '2': 'two', '3': 'three local', '4': 'four'}
+        other = {'1': 'one', '2': 'two other', '3': 'three other', '5': 'five'}
+        self.assertEqual(b._merge_packs(base, local, other),
+                         ([('2', 'two other'), ('5', 'five')], ['3']))
+        self.assertEqual(b._merge_packs({}, local, local), ([], []))
+
+    def test_conflict_block(self):
+        """Tests writing conflicting changes between conflict markers"""
+        block = b._conflict_block(['three local'], [])
+        self.assertEqual(block, '<<<<<<< local\nthree local\n=======\n'
+                                '>>>>>>> other\n')
+        self.assertEqual(len(b._CONFLICT_MARKER.findall(block)), 3)
+
     def test_speed(self):
         """Tests the speed of generating and listing a large BD.
         
@@ -66,6 +66,29 @@ setup() {
   [[ "$output" =~ "Title: some bug" ]]
 }
 
+@test "details of many bugs" {
+  hg b add some bug
+  hg b add another bug
+  hg b add third bug
+  hg b comment 8 another comment
+  hg b resolve 7
+  hg b resolve 8
+  run_hg b details 8 c 7
+  [[ "${lines[0]}" == "Title: another bug" ]]
+  [[ "$output" =~ "another comment" ]]
+  [[ "$output" =~ Title:\ another.*Title:\ third.*Title:\ some ]]
+  run_hg b details -r
+  [[ "$output" =~ "Title: another bug" ]]
+  [[ "$output" =~ "Title: some bug" ]]
+  [[ ! "$output" =~ "third bug" ]]
+  run_hg b details -r -g some
+  [[ "${lines[0]}" == "Title: some bug" ]]
+  [[ ! "$output" =~ "another bug" ]]
+  run_hg b details -r 7
+  (( status != 0 ))
+  [[ "$output" =~ "--resolved cannot be used with prefixes" ]]
+}
+
 @test "add supports duplicate names" {
   unset HG_B_SIMPLE_HASHING
   hg b add some bug
@@ -185,6 +208,242 @@ setup() {
   [[ "$output" =~ Found\ 1\ resolved ]]
   run_hg b list -r -o u -a
   [[ "$output" =~ Found\ 0\ resolved ]]
+
+  run_hg b list --since 1d -c
+  [[ "$output" =~ Found\ 2\ open ]]
+  run_hg b list --until 2000-01-01
+  [[ "$output" =~ Found\ 0\ open ]]
+  run_hg b list --since tomorrow
+  (( status != 0 ))
+
+  run_hg b list --query 'owner:UserA title~"^some"'
+  [[ "$output" =~ Found\ 1\ open ]]
+  run_hg b list --query 'open:false'
+  [[ "$output" =~ "resolved bug" ]]
+  run_hg b list --query 'owner'
+  (( status != 0 ))
+}
+
+@test "list --activity" {
+  hg b add some bug
+  hg b add another bug
+  hg b comment 7 Foo Bar
+  run_hg b list --activity --recent
+  [[ "$output" =~ 8\ -\ -\ [0-9-]+\ -\ another\ bug ]]
+  [[ "$output" =~ 7\ -\ 1\ [0-9-]+\ -\ some\ bug ]]
+  hg b comment 7 Foo Bar
+  run_hg b list --activity
+  [[ "$output" =~ 7\ -\ 2 ]]
+}
+
+@test "list --watch" {
+  hg b add some bug
+  (sleep 2; _hg b add another bug; _hg b resolve 7) > /dev/null &
+  # timeout needs the hg executable, rather than the _hg function
+  run timeout 5 hg --config extensions.b="${BATS_TEST_DIRNAME}/b.py" \
+    --config ui.interactive=true --config bugs.watch_interval=0.2 \
+    b list --watch
+  wait
+  echo "$output"
+  [[ "${lines[0]}" == "7 - some bug" ]]
+  [[ "${lines[1]}" == "Found 1 open bug" ]]
+  [[ "$output" =~ "+ 8 - another bug" ]]
+  [[ "$output" =~ "- 7 - some bug" ]]
+}
+
+@test "feed" {
+  run_hg b feed
+  [[ "$output" =~ "No events, set bugs.feed=true" ]]
+  _feed() {
+    hg --config bugs.feed=true "$@"
+  }
+  _feed b add some bug
+  _feed b assign 7 -f UserA
+  run_hg b feed
+  [[ "${lines[0]}" =~ ^[0-9]+-[0-9a-f]{12}\ Nobody\ 7\ -\ some\ bug:\ added$ ]]
+  [[ "${lines[1]}" =~ "7 - some bug: assigned to UserA" ]]
+  local cursor=${lines[1]%% *}
+  run_hg b feed --since "$cursor"
+  (( ${#lines[@]} == 0 ))
+
+  _feed b comment 7 a comment
+  _feed b resolve 7
+  run_hg b feed --since "$cursor"
+  [[ "${lines[0]}" =~ "commented: a comment" ]]
+  [[ "${lines[1]}" =~ "resolved" ]]
+  (( ${#lines[@]} == 2 ))
+  run_hg b feed --since "$cursor" --json
+  [[ "$output" =~ '"op": "resolve"' ]]
+  run_hg b feed --since 0-nonesuch
+  (( status != 0 ))
+  [[ "$output" =~ "Unknown cursor 0-nonesuch" ]]
+}
+
+@test "set" {
+  hg b add first bug
+  hg b add second bug
+  run_hg b set 2 priority=high milestone=2.0
+  [[ "${lines[0]}" == "Set priority of 2: 'first bug' to high" ]]
+  [[ "${lines[1]}" == "Set milestone of 2: 'first bug' to 2.0" ]]
+  run_hg b details 2
+  [[ "$output" =~ "priority: high" ]]
+  run_hg b list --field priority=high
+  [[ "$output" =~ "first bug" && ! "$output" =~ "second bug" ]]
+  hg b set 9 priority=low
+  run_hg b list --sort priority
+  [[ "${lines[0]}" =~ "first bug" && "${lines[1]}" =~ "second bug" ]]
+  run_hg b set 2 priority=
+  [[ "$output" == "Removed priority of 2: 'first bug'" ]]
+  run_hg b set 2 priority
+  (( status != 0 ))
+  run_hg b set 2 owner=someone
+  (( status != 0 ))
+}
+
+@test "fixes" {
+  hg b add some bug
+  hg b add another bug
+  hg --config ui.username=username commit -m "file bugs"
+  local upstream="$PWD-upstream"
+  hg clone "$PWD" "$upstream"
+  printf '[bugs]\nfixes = true\n' >> "$upstream/.hg/hgrc"
+  # a server without a working copy has no bugs to change
+  local bare="$PWD-bare"
+  hg clone -U "$PWD" "$bare"
+  printf '[bugs]\nfixes = true\n' >> "$bare/.hg/hgrc"
+
+  echo foo > foo
+  run_hg --config bugs.fixes=true --config ui.username=username \
+    commit -A -m "fixes 7f07e"
+  [[ "$output" =~ "b: Resolved 7: 'some bug' (fixed in changeset" ]]
+  run_hg b details 7
+  [[ "$output" =~ "Fixed in changeset" && "$output" =~ "fixes 7f07e" ]]
+  run_hg status .bugs
+  [[ "$output" =~ "M .bugs/bugs" && "$output" =~ "A .bugs/details/7f07e" ]]
+
+  # a push resolves the bugs every incoming changeset fixes in one go
+  echo bar > bar
+  hg --config ui.username=username commit -A -m "closes 8c7d9, fixes 0000"
+  hg push "$bare"
+  [[ ! -e "$bare/.bugs" ]]
+  hg push "$upstream"
+  cd "$upstream"
+  run_hg b list
+  [[ "$output" == "Found 0 open bugs" ]]
+  run_hg b details 8
+  [[ "$output" =~ "closes 8c7d9" ]]
+}
+
+@test "web" {
+  hg b add some bug
+  # run hg directly, so that it's the process killed below
+  command hg --config extensions.b="${BATS_TEST_DIRNAME}/b.py" \
+    b web --port 0 > web.log 2>&1 &
+  local server=$!
+  local url
+  for _ in {1..50}; do
+    url=$(grep -o 'http://[^ ]*' web.log) && break
+    sleep 0.1
+  done
+
+  run curl -sS "${url}api/bugs"
+  kill "$server"
+  echo "$output"
+  [[ "$output" =~ '"text": "some bug"' ]]
+}
+
+@test "diff" {
+  hg b add some bug
+  hg b add another bug
+  hg --config ui.username=username commit -m "rev0"
+  hg b rename 7 renamed bug
+  hg b assign -f 8 UserB
+  hg b resolve 8
+  hg b comment 7 a comment
+  run_hg b diff 0
+  [[ "${lines[0]}" == "7 - renamed bug" ]]
+  [[ "${lines[1]}" == "    renamed from: some bug" ]]
+  [[ "${lines[2]}" == "    details changed" ]]
+  [[ "${lines[4]}" =~ "reassigned from "(Nobody|test)" to UserB" ]]
+  [[ "${lines[5]}" == "    resolved" ]]
+  [[ "${lines[6]}" == "Found 2 changed bugs" ]]
+  hg --config ui.username=username commit -m "rev1"
+  run_hg b diff 1 0 --json
+  [[ "$output" =~ '"change": "reopened"' ]]
+  run_hg b diff 0 0
+  [[ "$output" == "Found 0 changed bugs" ]]
+  # as are custom fields
+  hg b set 8 priority=high
+  run_hg b diff 1
+  [[ "${lines[1]}" == "    set priority from '' to 'high'" ]]
+  run_hg b diff 1 --json
+  [[ "$output" =~ '"field": "priority"' ]]
+  hg b set 8 priority=
+  # details in the pack are compared bug by bug
+  hg --config bugs.packed_details=true b comment 8 a packed comment
+  run_hg --config bugs.packed_details=true b diff 1
+  [[ "${lines[0]}" == "8 - another bug" ]]
+  [[ "${lines[1]}" == "    details changed" ]]
+  [[ "${lines[2]}" == "Found 1 changed bug" ]]
+  run_hg b diff
+  [[ "$output" =~ "Must specify one or two revisions" ]]
+}
+
+@test "sql" {
+  hg b add some bug
+  hg b add another bug
+  hg b comment 7 it crashed
+  run_hg b sql "SELECT title, open FROM bugs ORDER BY title"
+  [[ "$output" == "title | open"$'\n'"another bug | 1"$'\n'"some bug | 1" ]]
+  hg b resolve 8
+  run_hg b sql --json "SELECT id FROM search WHERE search MATCH 'crashed'"
+  [[ "$output" =~ '"id": "7f07e8490f2307c8139756893baecad033fa6e7c"' ]]
+  run_hg b sql "SELECT count(*) FROM bugs WHERE open = 0"
+  [[ "${lines[1]}" == "1" ]]
+  run_hg b sql "DELETE FROM bugs"
+  (( status == 1 ))
+  [[ "$output" =~ "Invalid query" ]]
+}
+
+@test "dupes" {
+  hg b add crash when opening a file
+  run_hg b add crash when opening files
+  [[ "$output" =~ "Possible duplicates:" ]]
+  [[ "$output" =~ "crash when opening a file (" ]]
+  run_hg --config bugs.dupes=false b add crash opening files
+  [[ ! "$output" =~ "Possible duplicates" ]]
+  hg b add typo in the manual
+  run_hg b dupes
+  [[ "$output" =~ "crash when opening files" ]]
+  [[ ! "$output" =~ "typo" ]]
+  [[ "$output" =~ Found\ 1\ group\ of ]]
+  run_hg --config bugs.dupe_threshold=0.9 b dupes
+  [[ "$output" =~ Found\ 0\ groups ]]
+}
+
+@test "verify" {
+  hg b add some bug
+  hg b comment 7 a comment
+  run_hg b verify
+  [[ "$output" == "Found 0 problems" ]]
+  echo "orphan" > .bugs/details/0123.txt
+  hg b add another bug
+  hg --config ui.username=username commit -m "bugs"
+  hg b list --rev tip
+  tail -n1 .bugs/bugs >> .bugs/bugs
+  run_hg b verify
+  (( status == 1 ))
+  [[ "$output" =~ "bugs:2: duplicate id" ]]
+  [[ "$output" =~ "details/0123.txt: no bug with this id" ]]
+  [[ "$output" =~ "Found 1 cached revision in" ]]
+  run_hg b verify --repair
+  (( status == 0 ))
+  [[ "$output" =~ "Found 2 problems, repaired 2" ]]
+  [[ "$output" =~ "Removed 1 cached revision" ]]
+  run_hg status
+  [[ "$output" == "R .bugs/details/0123.txt" ]]
+  run_hg b verify
+  [[ "$output" == "Found 0 problems" ]]
 }
 
 @test "id" {
@@ -232,6 +491,259 @@ setup() {
   echo DONE; false
 }
 
+@test "commits" {
+  hg b add some bug
+  hg b add another bug
+  hg --config ui.username=username commit -m "file bugs"
+  echo foo > foo
+  hg --config ui.username=username commit -A -m "fixes 7f07e, not cafe"
+  hg b comment 8 Foo Bar
+  hg --config ui.username=username commit -m "comment"
+
+  run_hg log -r 'bug(7)' -T '{rev}\n'
+  [[ "$output" == 1 ]]
+  run_hg log -r 'bug(8)' -T '{rev}\n'
+  [[ "$output" == 2 ]]
+  run_hg log -r 1 -T '{bugs}'
+  [[ "$output" == 7f07e8490f2307c8139756893baecad033fa6e7c ]]
+  run_hg b details 7 --commits
+  [[ "${lines[${#lines[@]}-1]}" =~ ^1:[0-9a-f]{12}\ fixes\ 7f07e ]]
+
+  # the index is updated incrementally
+  hg b add new bug
+  hg --config ui.username=username commit -m "file 04cc3"
+  run_hg log -r 'bug(0)' -T '{rev}\n'
+  [[ "$output" == 3 ]]
+}
+
+@test "status api" {
+  # this test creates plain files, so it works in a repo of its own that
+  # doesn't depend on setup()'s working directory
+  local dir
+  dir=$(mktemp -d "$BATS_TMPDIR/b-status-XXXXXX")
+  _hg init "$dir/repo"
+  cd "$dir/repo"
+  cat > "$dir/hook.py" <<EOF
+import sys
+sys.path.insert(0, "$BATS_TEST_DIRNAME")
+import b
+
+def hook(ui, repo, **kwargs):
+    ui.write('%r\n' % b.status(ui, repo, 'tip'))
+    ui.write('%r\n' % b.statuses(ui, repo, 'all()', ['glob:*.orig']))
+EOF
+  hg b add some bug
+  hg --config ui.username=username commit -m "bug only"
+  echo foo > foo
+  echo foo > foo.orig
+  hg --config ui.username=username commit -A -m "no bugs"
+  hg b resolve 7
+  echo bar > foo
+  echo bar > foo.orig
+  hg --config ui.username=username commit -m "fix"
+  hg update 1
+  echo baz > baz
+  hg --config ui.username=username commit -A -m "no bugs"
+  hg merge 2
+  hg --config ui.username=username commit -m "merge"
+
+  # like status --change, the merge is compared to its first parent
+  run_hg --config hooks.pre-identify="python:$dir/hook.py:hook" id
+  [[ "${lines[0]}" == "['foo', 'foo.orig']" ]]
+  [[ "${lines[1]}" == "[(0, []), (1, None), (2, ['foo']), (3, None), (4, ['foo'])]" ]]
+}
+
+@test "working directory" {
+  cat > "$BATS_TMPDIR/b-cwd-hook.py" <<EOF
+import os, sys
+sys.path.insert(0, "$BATS_TEST_DIRNAME")
+import b
+
+def hook(ui, repo, **kwargs):
+    # runs several commands in one process, as chg would
+    before = os.getcwd()
+    for args, opts in [(['add', 'third bug'], {}), (['list'], {}),
+                       (['details', '7'], {'rev': '0'})]:
+        opts = dict(dict((o[1], o[2]) for o in b.cmdtable['b|bug|bugs'][1]),
+                    **opts)
+        b.execute_command(ui, repo, *args, **opts)
+        ui.write('%s\\n' % (os.getcwd() == before))
+EOF
+  hg b add some bug
+  hg --config ui.username=username commit -m "bug"
+  mkdir sub
+  cd sub
+  hg b add another bug
+  hg b comment 8 from a subdirectory
+  run_hg b details 8
+  [[ "$output" =~ "from a subdirectory" ]]
+  run_hg b details 7 --rev 0
+  [[ "$output" =~ "Title: some bug" ]]
+  [[ ! -e .bugs ]]
+
+  run_hg --config hooks.pre-identify="python:$BATS_TMPDIR/b-cwd-hook.py:hook" id
+  [[ "$output" =~ "Found 3 open bugs" ]]
+  [[ "$output" =~ "Title: some bug" ]]
+  [[ "$output" =~ True ]]
+  [[ ! "$output" =~ False ]]
+  [[ ! -e .bugs ]]
+}
+
+@test "merge" {
+  hg b add some bug
+  hg b add another bug
+  hg --config ui.username=username commit -m "base"
+  hg b assign -f 7 UserA
+  hg b add local bug
+  hg --config ui.username=username commit -m "local"
+  hg update 0
+  hg b rename 7 renamed bug
+  hg b resolve 8
+  hg b add other bug
+  hg --config ui.username=username commit -m "other"
+
+  run_hg merge 1
+  (( status == 0 ))
+  run_hg b list -o UserA
+  [[ "$output" =~ "renamed bug" ]]
+  run_hg b list
+  [[ "$output" =~ "local bug" ]]
+  [[ "$output" =~ "other bug" ]]
+  [[ "$output" =~ Found\ 3\ open ]]
+}
+
+@test "merge conflict" {
+  hg b add some bug
+  printf 'a\nb\nc\n' > file
+  hg add file
+  hg --config ui.username=username commit -m "base"
+  hg b assign -f 7 UserA
+  printf 'A\nb\nc\n' > file
+  hg --config ui.username=username commit -m "local"
+  hg update 0
+  hg b assign -f 7 UserB
+  printf 'a\nb\nC\n' > file
+  hg --config ui.username=username commit -m "other"
+
+  run_hg merge 1
+  (( status == 1 ))
+  [[ "$output" =~ "conflicting changes to bug 7f07e8490f (owner)" ]]
+  [[ ! "$output" =~ "hook failed" ]]
+  run_hg resolve -l
+  [[ "$output" =~ "U .bugs/bugs" ]]
+  [[ "$output" =~ "R file" ]]
+  run cat file
+  [[ "$output" == $'A\nb\nC' ]]
+  run_hg b verify
+  [[ "$output" =~ "unresolved merge conflict" ]]
+  grep -q "owner:UserB" .bugs/bugs
+  grep -q "owner:UserA" .bugs/bugs
+}
+
+@test "archive" {
+  hg b add some bug
+  hg b add another bug
+  hg --config bugs.archive=true b resolve 7
+  run cat .bugs/archive
+  [[ "$output" =~ "some bug" ]]
+  run_hg b list
+  [[ "$output" =~ Found\ 1\ open ]]
+  run_hg b list -r
+  [[ "$output" =~ "some bug" ]]
+  run_hg b details 7
+  [[ "$output" =~ "*Resolved*" ]]
+  hg b reopen 7
+  run_hg b list
+  [[ "$output" =~ Found\ 2\ open ]]
+  run cat .bugs/archive
+  [[ -z "$output" ]]
+}
+
+@test "memory budget" {
+  hg b add some bug
+  hg b add another bug
+  _bounded() {
+    hg --config bugs.memory_budget=1 "$@"
+  }
+  _bounded b resolve 7
+  _bounded b add third bug
+  run_hg --config bugs.memory_budget=1 b list
+  [[ "$output" =~ "another bug" ]]
+  [[ "$output" =~ "third bug" ]]
+  [[ "$output" =~ Found\ 2\ open ]]
+  run_hg b list -r
+  [[ "$output" =~ "some bug" ]]
+  run sort -c -t: -k4 .bugs/bugs
+  (( status == 0 ))
+}
+
+@test "packed details" {
+  _packed() {
+    hg --config bugs.packed_details=true "$@"
+  }
+  _packed b add some bug
+  _packed b add another bug
+  _packed b comment 7 base comment
+  hg --config ui.username=username commit -m "base"
+  [[ ! -e .bugs/details ]]
+  _packed b comment 7 local comment
+  hg --config ui.username=username commit -m "local"
+  hg update 0
+  _packed b comment 8 other comment
+  hg --config ui.username=username commit -m "other"
+
+  run_hg merge 1
+  (( status == 0 ))
+  run_hg --config bugs.packed_details=true b details 7
+  [[ "$output" =~ "local comment" ]]
+  run_hg --config bugs.packed_details=true b details 8
+  [[ "$output" =~ "other comment" ]]
+  run_hg --config bugs.packed_details=true b list --activity
+  [[ "$output" =~ 7\ -\ 2 ]]
+}
+
+@test "storage" {
+  hg --config bugs.storage=packed b add some bug
+  hg --config bugs.storage=packed b comment 7 packed comment
+  [[ -e .bugs/details.pack ]]
+  [[ ! -e .bugs/details ]]
+  run_hg --config bugs.storage=packed b details 7
+  [[ "$output" =~ "packed comment" ]]
+  run_hg --config bugs.storage=nonesuch b list
+  (( status != 0 ))
+  [[ "$output" =~ "Unknown storage 'nonesuch', expected one of packed, sharded, text" ]]
+}
+
+@test "migrate" {
+  hg b add some bug
+  hg b add another bug
+  hg b comment 7 a comment
+  hg --config ui.username=username commit -m "text layout"
+  run_hg b migrate sharded
+  [[ "$output" =~ "Moved 2 bugs to sharded storage" ]]
+  [[ ! -e .bugs/bugs && -d .bugs/bugs.d ]]
+  run_hg status .bugs
+  [[ "$output" =~ "R .bugs/bugs" && "$output" =~ "A .bugs/bugs.d/" ]]
+  _sharded() {
+    hg --config bugs.storage=sharded "$@"
+  }
+  _sharded b resolve 7
+  run_hg --config bugs.storage=sharded b list
+  [[ "$output" =~ "another bug" && ! "$output" =~ "some bug" ]]
+  run_hg --config bugs.storage=sharded b details 7
+  [[ "$output" =~ "a comment" ]]
+  # revisions are read in the layout they were committed in
+  run_hg --config bugs.storage=sharded b list --rev 0
+  [[ "$output" =~ "some bug" ]]
+  hg --config ui.username=username commit -m "sharded layout"
+  run_hg --config bugs.storage=sharded b diff 0
+  [[ "$output" =~ "resolved" ]]
+  run_hg --config bugs.storage=sharded b verify
+  [[ "$output" =~ "Found 0 problems" ]]
+  run_hg b migrate sharded
+  (( status != 0 ))
+}
+
 # Failure Tests
 # Ok to remove error-message checks if they become too brittle
 
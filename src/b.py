@@ -35,20 +35,41 @@ See the README file for more details on what you can, and can't, do with b.
 #
 # Imports
 #
+import abc
+import BaseHTTPServer
+import bisect
+import cgi
 import errno
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import operator
 import os
 import re
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
 import time
 import traceback
+import urlparse
+import zlib
+from collections import deque, namedtuple
 from datetime import date, datetime
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from mercurial.error import Abort
 from mercurial.i18n import _
-from mercurial import hg, commands, registrar
+from mercurial.node import nullid, short
+from mercurial import hg, commands, registrar, revsetlang, scmutil, smartset
+from mercurial import match as matchmod, templateutil, util
+try:
+    import sqlite3
+except ImportError:  # Python was built without SQLite, see BugsDict.sql()
+    sqlite3 = None
 
 #
 # Version Info
@@ -156,6 +177,9 @@ class InvalidInput(Error):
 #
 # Helper Methods - often straight from t
 #
+_DATETIME_FORMAT = "%A, %B %d %Y %I:%M%p"
+
+
 def _datetime(timestamp=None):
     """Returns a formatted string of the time from a timestamp,
     or now if called with no arguments"""
@@ -163,7 +187,76 @@ def _datetime(timestamp=None):
         t = datetime.fromtimestamp(float(timestamp))
     else:
         t = datetime.now()
-    return t.strftime("%A, %B %d %Y %I:%M%p")
+    return t.strftime(_DATETIME_FORMAT)
+
+
+# The earliest timestamp _timestamp() accepts as such, in 1973; smaller numbers
+# are far more likely to be years or typos than times bugs were filed
+_MIN_TIMESTAMP = 100000000
+
+
+def _timestamp(when, now=None):
+    """Returns a timestamp for either an absolute date, formatted YYYY-MM-DD
+    with an optional HH:MM (or just YYYY-MM or YYYY), a relative age such as
+    12h, 30d or 2w, or a timestamp as stored in the bugs file."""
+    ages = {'h': 3600, 'd': 86400, 'w': 604800}
+    try:
+        if float(when) >= _MIN_TIMESTAMP:
+            return float(when)
+    except ValueError:
+        pass
+    relative = re.match(r'^(\d+)([hdw])$', when.strip())
+    if relative:
+        if now is None:
+            now = time.time()
+        return now - int(relative.group(1)) * ages[relative.group(2)]
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m', '%Y'):
+        try:
+            return time.mktime(time.strptime(when.strip(), fmt))
+        except ValueError:
+            pass
+    raise InvalidInput(_("Unrecognized date '%s', expected YYYY-MM-DD "
+                         "[HH:MM] or an age such as 30d") % when)
+
+
+_QUERY_TERM = re.compile(r'^(\w+)(:|=|~|>=|<=|>|<)(.*)$', re.S)
+
+
+def _parse_query(query):
+    """Parse a query string into a list of (field, operator, value) terms.
+
+    A query is a whitespace separated list of terms, all of which must match:
+
+        field:value  the field is value; owner takes a user prefix, id a bug
+                     prefix, open true or false, and title a case-insensitive
+                     substring.  field=value is equivalent.
+        field~regex  the field matches the regular expression
+        field>value  also >=, < and <=; compares numerically where possible,
+                     and time takes the same dates as list --since
+
+    Values containing spaces can be quoted, e.g. title~"fails? to load".
+    """
+    try:
+        words = shlex.split(query)
+    except ValueError, e:
+        raise InvalidInput(_("Could not parse query: %s") % e)
+    terms = []
+    for word in words:
+        match = _QUERY_TERM.match(word)
+        if not match:
+            raise InvalidInput(_("Invalid query term '%s', expected "
+                                 "field:value") % word)
+        field, op, value = match.groups()
+        terms.append((field, ':' if op == '=' else op, value))
+    return terms
+
+
+def _ordered(value):
+    """Returns a sort key which orders numeric values numerically"""
+    try:
+        return 0, float(value)
+    except (TypeError, ValueError):
+        return 1, value
 
 
 def _hash(*args):
@@ -199,7 +292,20 @@ def _truth(s):
     return s == 'True' or s == 'true'
 
 
-def _task_from_taskline(taskline):
+# The id of a taskline, which is in the metadata following its last '|'
+_TASK_ID = re.compile(r'(?m)[|,][ \t]*id:[ \t]*(\w+)[^|\n]*$')
+_NONBLANK_LINE = re.compile(r'(?m)^[ \t]*\S')
+# A whole taskline and its id, see _TASK_ID
+_TASK_RECORD = re.compile(r'(?m)^(.*[|,][ \t]*id:[ \t]*(\w+)[^|\n]*)$')
+
+
+def _open_only(query):
+    """Indicates whether the terms of a query only match open bugs"""
+    return any(field == 'open' and op == ':' and _truth(value)
+               for field, op, value in query)
+
+
+def _task_from_taskline(taskline, now=None):
     """Parse a taskline (from a task file) and return a task.
     
     A taskline should be in the format:
@@ -215,6 +321,8 @@ def _task_from_taskline(taskline):
     A taskline can also consist of only summary text, in which case the id
     and other metadata will be generated when the line is read.  This is
     supported to enable editing of the taskfile with a simple text editor.
+    The id is a hash of the text, so the line is given the same id each time
+    it's read, and the time is now (the current time by default).
     """
     try:
         if '|' in taskline:
@@ -225,11 +333,11 @@ def _task_from_taskline(taskline):
                 task[label.strip()] = data.strip()
         else:
             text = taskline.strip()
-            task = {'id': _hash(text, str(time.time())),
+            task = {'id': _hash(text),
                     'text': text,
                     'owner': '',
                     'open': 'True',
-                    'time': time.time()
+                    'time': time.time() if now is None else now
                     }
         return task
     except Exception:
@@ -238,19 +346,91 @@ def _task_from_taskline(taskline):
                         "Line is: %s") % taskline)
 
 
+# The order b has always written these fields in; any others follow, sorted
+_FIELD_ORDER = ('owner', 'open', 'id', 'time')
+# The names of the custom fields set() can set, which aren't those above
+_FIELD_NAME = re.compile(r'^\w+$')
+
+
+def _format_value(value):
+    """Formats a metadata value for the bugs file.  Numbers are written with
+    at most two decimal places, and strings - including values read from the
+    file - are written unchanged."""
+    if isinstance(value, float):
+        return ('%.2f' % value).rstrip('0').rstrip('.')
+    return str(value)
+
+
 def _tasklines_from_tasks(tasks):
-    """Parse a list of tasks into tasklines suitable for writing to a file."""
+    """Parse a list of tasks into tasklines suitable for writing to a file.
+
+    The output is canonical: fields are written in a fixed order, so a task
+    which was read from a file and not modified is written back byte for
+    byte, keeping diffs of the bugs file limited to the bugs that changed."""
 
     tasklines = []
 
     for task in tasks:
-        meta = [m for m in task.items() if m[0] != 'text']
-        meta_str = ', '.join('%s:%s' % m for m in meta)
+        fields = [f for f in _FIELD_ORDER if f in task]
+        fields += sorted(f for f in task
+                         if f not in _FIELD_ORDER and f != 'text')
+        meta_str = ', '.join('%s:%s' % (f, _format_value(task[f]))
+                             for f in fields)
         tasklines.append('%s | %s\n' % (task['text'].ljust(60), meta_str))
 
     return tasklines
 
 
+def _common_prefix_len(a, b):
+    """Returns the length of the longest common prefix of two strings"""
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+
+# MinHash parameters for detecting duplicate titles.  Signatures are
+# _MINHASH_SIZE hashes of a title's shingles, split into bands of _LSH_ROWS
+# hashes; titles sharing any band are compared.  Two rows per band finds
+# titles which are half the same nine times out of ten.
+_MINHASH_SIZE = 16
+_LSH_ROWS = 2
+_MINHASH_PRIME = (1 << 32) + 15
+# Bands shared by more titles than this are too common to tell anything, e.g.
+# a prefix every title has, and comparing all their pairs is quadratic, so
+# dupes() skips them
+_LSH_MAX_BUCKET = 50
+_MINHASH_SEEDS = [(int(hashlib.sha1('a%d' % i).hexdigest()[:8], 16) | 1,
+                   int(hashlib.sha1('b%d' % i).hexdigest()[:8], 16))
+                  for i in range(_MINHASH_SIZE)]
+
+
+def _shingles(text):
+    """Returns the set of character trigrams of the words of text, ignoring
+    case and punctuation"""
+    text = ' '.join(re.findall(r'\w+', text.lower()))
+    if len(text) < 3:
+        return set([text]) if text else set()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _minhash(shingles):
+    """Returns the MinHash signature of a set of shingles, a tuple of the
+    smallest value of each of the hash functions over the shingles"""
+    hashes = [zlib.crc32(s) & 0xffffffff for s in shingles]
+    if not hashes:
+        return ()
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes)
+                 for a, b in _MINHASH_SEEDS)
+
+
+def _jaccard(a, b):
+    """Returns the Jaccard similarity of two sets"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / float(len(a | b))
+
+
 def _prefixes(elements):
     """Return a mapping of elements to their unique prefix in O(n) time.
     
@@ -296,17 +476,1126 @@ def _prefixes(elements):
     return pre
 
 
-def _describe_print(num, is_open, owner, filter_by):
+def _sorted_tasks(tasklines, now=None):
+    """Parse tasklines into a list of tasks ordered by id.
+
+    Files written by b are already sorted, in which case this is a single
+    linear pass; hand-edited files are sorted as a fallback.  now is passed on
+    to _task_from_taskline."""
+    tasks = [_task_from_taskline(tl.strip(), now) for tl in tasklines
+             if tl.strip()]
+    ids = [task['id'] for task in tasks]
+    if any(ids[i] > ids[i + 1] for i in range(len(ids) - 1)):
+        tasks.sort(key=itemgetter('id'))
+    return tasks
+
+
+def _external_sort(lines, key, budget):
+    """Returns an iterator over lines sorted by key, holding no more than about
+    budget bytes of them in memory, or all of them if budget is None.
+
+    Lines are sorted in memory in runs of up to budget bytes, and if there's
+    more than one run each is written to a temporary file and the runs are
+    merged as they're read back."""
+    runs = []
+    run, size = [], 0
+    for line in lines:
+        run.append(line)
+        size += len(line)
+        if budget is not None and size > budget:
+            run.sort(key=key)
+            f = tempfile.TemporaryFile()
+            f.writelines(run)
+            f.seek(0)
+            runs.append(f)
+            run, size = [], 0
+    run.sort(key=key)
+    if not runs:
+        return iter(run)
+    return _merge_runs(runs, run, key)
+
+
+def _merge_runs(files, run, key):
+    """Merges sorted runs of lines, some in temporary files, closing the files
+    when done"""
+    try:
+        runs = [((key(line), line) for line in f) for f in files]
+        runs.append((key(line), line) for line in run)
+        for _key, line in heapq.merge(*runs):
+            yield line
+    finally:
+        for f in files:
+            f.close()
+
+
+def _merge_task(base, local, other):
+    """Three-way merge a single bug field-by-field.
+
+    Any of the arguments may be None, indicating the bug does not exist on
+    that side.  Returns the merged task (or None if the bug should be removed)
+    and a list of the fields which conflicted.  Conflicting fields keep the
+    local value; a bug deleted on one side and modified on the other is kept.
+    """
+    if local is None and other is None:
+        return None, []
+    if local is None or other is None:
+        changed = local if other is None else other
+        if base is None:
+            return changed, []  # added on one side
+        if changed == base:
+            return None, []  # deleted on one side, untouched on the other
+        return changed, ['deleted']
+    base = base or {}
+    merged = {}
+    conflicts = []
+    for field in sorted(set(base) | set(local) | set(other)):
+        b, l, o = base.get(field), local.get(field), other.get(field)
+        if l == o or o == b:
+            value = l
+        elif l == b:
+            value = o
+        else:
+            value = l
+            conflicts.append(field)
+        if value is not None:
+            merged[field] = value
+    return merged, conflicts
+
+
+def _merge_tasks(base, local, other):
+    """Three-way merge lists of tasks, each sorted by id.
+
+    The lists are merge-joined by id in a single linear pass.  Returns the
+    merged tasks, sorted by id, and a list of (id, fields) conflicts.
+    """
+    merged = []
+    conflicts = []
+    sides = [base, local, other]
+    pos = [0, 0, 0]
+    while True:
+        heads = [side[p]['id'] if p < len(side) else None
+                 for side, p in zip(sides, pos)]
+        present = [h for h in heads if h is not None]
+        if not present:
+            break
+        task_id = min(present)
+        matched = []
+        for i, head in enumerate(heads):
+            if head == task_id:
+                matched.append(sides[i][pos[i]])
+                pos[i] += 1
+            else:
+                matched.append(None)
+        task, fields = _merge_task(*matched)
+        if task is not None:
+            merged.append(task)
+        if fields:
+            conflicts.append((task_id, fields))
+    return merged, conflicts
+
+
+_COMMENT_DATE = re.compile(r'(?m)^On: (.+)$')
+
+# The schema of the SQLite mirror of the bugs, see BugsDict.sql().  _sync has
+# the line and details summary each bug was last mirrored from.
+_SQL_VERSION = 1
+_SQL_SCHEMA = """
+CREATE TABLE bugs (id TEXT UNIQUE NOT NULL, title TEXT, owner TEXT,
+                   open INTEGER, time REAL, archived INTEGER);
+CREATE INDEX bugs_owner ON bugs (owner);
+CREATE INDEX bugs_open ON bugs (open);
+CREATE INDEX bugs_time ON bugs (time);
+CREATE VIRTUAL TABLE search USING fts4 (id, title, details, notindexed=id);
+CREATE TABLE _sync (id TEXT PRIMARY KEY, line TEXT, details TEXT);
+CREATE TABLE _files (stats TEXT);
+PRAGMA user_version = %d;
+""" % _SQL_VERSION
+
+# Lines left in a file by a merge which wasn't resolved
+_CONFLICT_MARKER = re.compile(r'(?m)^(<{7} |={7}$|>{7} )')
+
+# The number of details files verify checks at once
+_VERIFY_THREADS = 8
+
+# The number of bugs' details read ahead at once when reporting on many bugs
+_DETAILS_THREADS = 8
+
+
+def _prefetch(func, items, threads):
+    """Yields func(item) for each of items in order, calling func ahead of the
+    consumer on up to threads threads.  No more than twice that many results
+    are held at once, so a slow consumer doesn't read everything ahead."""
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= threads * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+
+
+def _check_details(path):
+    """Returns the problem with the details file at path, or None"""
+    try:
+        with open(path) as f:
+            text = f.read()
+    except IOError, e:
+        return _("unreadable: %s") % e.strerror
+    if _CONFLICT_MARKER.search(text):
+        return _("unresolved merge conflict")
+    return None
+
+
+def _details_summary(path, st):
+    """Summarizes the details file at path, whose os.stat() result is st.
+
+    Returns a dict of the file's size and mtime, the number of comments added
+    by the comment command, and the time of the last of them (or None)."""
+    with open(path) as f:
+        return _summarize_details(f.read(), st.st_size, st.st_mtime)
+
+
+def _summarize_details(text, size, mtime):
+    """Summarizes the given details, see _details_summary.  Details stored in
+    a pack have no mtime, the offset of their record is used instead."""
+    times = []
+    for match in _COMMENT_DATE.finditer(text):
+        try:
+            times.append(time.mktime(time.strptime(match.group(1).strip(),
+                                                   _DATETIME_FORMAT)))
+        except ValueError:
+            pass  # not written by comment
+    return {'size': size, 'mtime': mtime,
+            'comments': len(times), 'last_comment': max(times or [None])}
+
+
+_PACK_FILE = 'details.pack'
+# Superseded records the pack may contain before it's compacted, in bytes
+_PACK_SLACK = 1 << 16
+
+
+def _pack_record(task_id, text):
+    """Returns the details pack record storing text as the details of a bug.
+
+    A pack is a sequence of records, each a header line of the bug's id and
+    the length of its details, followed by the details and a newline.  Records
+    are only ever appended, so the last record of a bug holds its details."""
+    return '%s %d\n%s\n' % (task_id, len(text), text)
+
+
+def _pack_entries(f):
+    """Yields the id, and the offset and length of the details, of each record
+    in the details pack f, without reading the details themselves.  Raises
+    IOError if a record's header is corrupt or its details are truncated."""
+    start = f.tell()
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    f.seek(start)
+    while True:
+        offset = f.tell()
+        header = f.readline()
+        if not header:
+            return
+        try:
+            task_id, length = header.split()
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0 or f.tell() + length + 1 > end:
+            raise IOError(errno.EIO, _(
+                "Corrupt details pack record at byte %d; "
+                "hg b verify --repair can drop it") % offset)
+        yield task_id, f.tell(), length
+        f.seek(length + 1, os.SEEK_CUR)
+
+
+def _read_pack(path):
+    """Returns a mapping of the bug ids in the details pack at path to their
+    details."""
+    with open(path, 'rb') as f:
+        return _parse_pack(f.read())
+
+
+def _parse_pack(data):
+    """Returns a mapping of the bug ids in the contents of a details pack to
+    their details."""
+    return dict((task_id, data[offset:offset + length]) for task_id, offset,
+                length in _pack_entries(io.BytesIO(data)))
+
+
+_FEED_FILE = 'feed'
+# Numbers the change feed events made by this process, see BugsDict._event()
+_EVENT_SEQUENCE = itertools.count()
+
+
+def _merge_feeds(local, other):
+    """Merges two versions of the change feed, as lists of lines.  Returns the
+    lines of other which need to be appended to local; events are never
+    removed, so local is kept as it is and cursors into it stay valid."""
+    seen = set(local)
+    return [line for line in other if line.strip() and line not in seen]
+
+
+def _merge_packs(base, local, other):
+    """Merges the details of each bug in three versions of a details pack, as
+    read by _read_pack.
+
+    Returns the (id, details) pairs which need to be appended to local, and the
+    ids of bugs whose details were changed on both sides."""
+    appended = []
+    conflicts = []
+    for task_id in sorted(other):
+        theirs = other[task_id]
+        ours = local.get(task_id)
+        if theirs == ours or theirs == base.get(task_id):
+            continue
+        if ours is None or ours == base.get(task_id):
+            appended.append((task_id, theirs))
+        else:
+            conflicts.append(task_id)
+    return appended, conflicts
+
+
+def _diff_tasks(old, new, unchanged=False):
+    """Merge-joins two lists of tasks sorted by id in one pass, yielding the
+    (old, new) pairs of the bugs which differ, or of every bug if unchanged
+    is true.  old is None for bugs only in new, and new None for bugs only in
+    old."""
+    i = j = 0
+    while i < len(old) or j < len(new):
+        if j == len(new) or (i < len(old) and old[i]['id'] < new[j]['id']):
+            yield old[i], None
+            i += 1
+        elif i == len(old) or new[j]['id'] < old[i]['id']:
+            yield None, new[j]
+            j += 1
+        else:
+            if unchanged or old[i] != new[j]:
+                yield old[i], new[j]
+            i += 1
+            j += 1
+
+
+def _bug_changes(old, new):
+    """Returns the changes between two versions of a bug, as a list of
+    (change, field, old value, new value) tuples.  change is one of added,
+    removed, renamed, reassigned, resolved, reopened, or set when a custom
+    field (see BugsDict.set()) was set, changed or cleared; field is the name
+    of that field, and None for the other changes."""
+    if old is None:
+        return [('added', None, None, new['text'])]
+    if new is None:
+        return [('removed', None, old['text'], None)]
+    changes = []
+    if old['text'] != new['text']:
+        changes.append(('renamed', None, old['text'], new['text']))
+    if old.get('owner', '') != new.get('owner', ''):
+        changes.append(('reassigned', None, old.get('owner', ''),
+                        new.get('owner', '')))
+    if _truth(old['open']) != _truth(new['open']):
+        changes.append(('reopened' if _truth(new['open']) else 'resolved',
+                        None, None, None))
+    for field in sorted(set(old) | set(new)):
+        if (field not in _FIELD_ORDER and field != 'text'
+                and old.get(field) != new.get(field)):
+            changes.append(('set', field, old.get(field), new.get(field)))
+    return changes
+
+
+def _list_lines(bugs, columns, truncate=0):
+    """Renders Bug records as the lines list prints for them, lining up their
+    prefixes and, if there are any, their activity columns from columns.
+    Lines longer than a non-zero truncate are cut short."""
+    plen = max([len(bug.prefix) for bug in bugs] or [0])
+    clen = max([len(columns[bug.id]) for bug in bugs if columns] or [0])
+    lines = []
+    for bug in bugs:
+        prefix = bug.prefix.ljust(plen)
+        if columns:
+            prefix = '%s - %s' % (prefix, columns[bug.id].rjust(clen))
+        line = _('%s - %s') % (prefix, bug.text)
+        if 0 < truncate < len(line):
+            line = line[:truncate - 4] + '...'
+        lines.append(line)
+    return lines
+
+
+def _diff_listings(old, new, truncate=0):
+    """Compares two listings of bugs, as returned by BugsDict._listing(), by
+    the ids, fields and activity of the bugs in them.
+
+    Returns the lines of the bugs which are only in old, or which changed,
+    prefixed by '- ', then those only in new or changed prefixed by '+ ',
+    followed by the new summary if it differs.  Only these bugs are
+    rendered, see _list_lines()."""
+    def values(listing):
+        bugs, columns, _summary = listing
+        # prefixes aren't fields, they just shift as bugs come and go
+        return dict((bug.id, (bug._replace(prefix=None), columns.get(bug.id)))
+                    for bug in bugs)
+    old_values, new_values = values(old), values(new)
+    removed = [bug for bug in old[0]
+               if old_values[bug.id] != new_values.get(bug.id)]
+    added = [bug for bug in new[0]
+             if new_values[bug.id] != old_values.get(bug.id)]
+    changed = (['- ' + line
+                for line in _list_lines(removed, old[1], truncate)]
+               + ['+ ' + line
+                  for line in _list_lines(added, new[1], truncate)])
+    if old[2] != new[2]:
+        changed.append(new[2])
+    return changed
+
+
+def _describe_print(num, is_open, owner, filter_by, since=None, until=None,
+                    query=''):
     """ Helper function used by list to describe the data just displayed """
-    type_name = 'open' if is_open else 'resolved'
-    out = _("Found %s %s bug%s") % (num, type_name, '' if num == 1 else 's')
+    if is_open is None:
+        out = _("Found %s bug%s") % (num, '' if num == 1 else 's')
+    else:
+        type_name = 'open' if is_open else 'resolved'
+        out = _("Found %s %s bug%s") % (num, type_name,
+                                        '' if num == 1 else 's')
     if owner != '*':
         out = out + (_(" owned by %s") % ('Nobody' if owner == '' else owner))
     if filter_by:
         out = out + _(" whose title contains %s") % filter_by
+    if since is not None:
+        out = out + _(" filed since %s") % _datetime(since)
+    if until is not None:
+        out = out + _(" filed before %s") % _datetime(until)
+    if query:
+        out = out + _(" matching %s") % query
     return out
 
 
+# A read-only view of a bug, as returned by BugsDict.iter_bugs().  owner is ''
+# for unassigned bugs, and prefix is the shortest unique prefix of the id.
+Bug = namedtuple('Bug', ['id', 'prefix', 'text', 'owner', 'open', 'time'])
+
+
+#
+# Storage backends for BugsDict
+#
+
+class Storage(object):
+    """Where a BugsDict keeps its bugs and their details.
+
+    Bugs are kept in tables, named 'bugs' and 'archive', of records: strings
+    which each describe one bug, and which change whenever the bug does.  The
+    details of a bug are a string of their own.
+
+    Backends subclass Storage and are registered in _STORAGE, which the
+    bugs.storage setting selects from.  Subclasses need to implement the
+    abstract methods, and can't be created until they do; the rest fall back
+    on those.  test_storage in b-test.py runs every registered backend
+    through the same conformance tests and benchmarks."""
+
+    __metaclass__ = abc.ABCMeta
+
+    tables = ('bugs', 'archive')
+
+    # Whether ids() of a prefix and find() read only part of a table, so
+    # lazy lookups needn't scan it, see BugsDict
+    partial = False
+
+    def __init__(self, bugsdir, cachedir=None):
+        self.bugsdir = bugsdir
+        self.cachedir = cachedir
+
+    def _path(self, relpath):
+        """Returns the path of a file or directory in the bugs directory"""
+        return os.path.join(self.bugsdir, relpath)
+
+    def exists(self, name):
+        """Returns whether the named table has any bugs"""
+        return self.size(name) > 0
+
+    def table_files(self, name):
+        """Returns the paths, relative to the bugs directory, of the text files
+        (see _task_from_taskline) the named table is kept in.  verify() checks
+        them and repairs them through save_file(), which backends returning
+        any need to implement, and migrate() removes those it moved bugs out
+        of."""
+        return []
+
+    @abc.abstractmethod
+    def size(self, name):
+        """Returns the size of the named table in bytes (0 if it doesn't
+        exist), which BugsDict compares to its memory budget"""
+
+    @abc.abstractmethod
+    def records(self, name):
+        """Yields the id and record of each bug in the named table, reading
+        them one at a time.  Bugs without an id (added by hand) are given one,
+        a hash of their text, see _task_from_taskline."""
+
+    @abc.abstractmethod
+    def parse(self, record):
+        """Returns the bug, a dict of its fields, a record describes"""
+
+    def ids(self, name, prefix=''):
+        """Yields the ids of the bugs in the named table which start with
+        prefix"""
+        for task_id, _record in self.records(name):
+            if task_id.startswith(prefix):
+                yield task_id
+
+    def scan(self, name):
+        """Returns a mapping of the ids of the bugs in the named table to their
+        records, without parsing them, or None if that's no quicker than
+        load() or any bug lacks an id.  See the lazy argument to BugsDict."""
+        return None
+
+    def load(self, name):
+        """Returns every bug in the named table"""
+        return [self.parse(record) for _id, record in self.records(name)]
+
+    def find(self, name, full_id):
+        """Returns the bug in the named table with the given id, or None"""
+        for task_id, record in self.records(name):
+            if task_id == full_id:
+                return self.parse(record)
+        return None
+
+    @abc.abstractmethod
+    def save(self, name, tasks):
+        """Replaces the bugs in the named table with the given ones, which are
+        sorted by id"""
+
+    @abc.abstractmethod
+    def update(self, name, tasks, removed, budget):
+        """Adds the given bugs to the named table, replacing those with the
+        same ids, and removes the bugs whose ids are in removed, keeping the
+        other bugs as they are.  No more than about budget bytes of the table
+        should be held in memory at once."""
+
+    @abc.abstractmethod
+    def stats(self, details=False):
+        """Returns a list of values, e.g. the size and mtime of files, which
+        changes whenever the tables (and optionally the details) do"""
+
+    @abc.abstractmethod
+    def read_details(self, full_id):
+        """Returns the details of the given bug, or None if it has none"""
+
+    @abc.abstractmethod
+    def write_details(self, full_id, text):
+        """Replaces the details of the given bug"""
+
+    def prefetch_details(self, full_ids):
+        """Yields the details of each of the given bugs in order, like
+        read_details(), reading them ahead of the consumer concurrently"""
+        return _prefetch(self.read_details, full_ids, _DETAILS_THREADS)
+
+    def append_details(self, full_id, text, initial=''):
+        """Appends text to the details of the given bug, which start as initial
+        if it has none"""
+        current = self.read_details(full_id)
+        self.write_details(full_id,
+                           (initial if current is None else current) + text)
+
+    def details_path(self, full_id):
+        """Returns the path of a file holding the details of the given bug,
+        which may be edited in place, or None if the details can only be
+        changed by write_details()"""
+        return None
+
+    def details_summary(self, full_id):
+        """Returns a summary of the details of the given bug (see
+        _summarize_details), or None if it has none"""
+        return self.details_summaries({}).get(full_id)
+
+    @abc.abstractmethod
+    def details_summaries(self, cached):
+        """Returns a mapping of the ids of the bugs with details to summaries
+        of them, like details_summary(), reusing the summaries in cached whose
+        size and mtime are unchanged"""
+
+    def details_files(self, full_id):
+        """Returns the paths, relative to the bugs directory, of the files the
+        details of the given bug are read from, to read them at other
+        revisions"""
+        return []
+
+    def remove_files(self, relpaths):
+        """Removes files, relative to the bugs directory, which the bugs or
+        details were moved out of, and the directories they leave empty, see
+        BugsDict.migrate()"""
+        for relpath in relpaths:
+            if os.path.exists(self._path(relpath)):
+                os.remove(self._path(relpath))
+        for dirname in set(os.path.dirname(relpath) for relpath in relpaths):
+            path = self._path(dirname)
+            if dirname and os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+
+    def verify_details(self, ids, repair, known=True):
+        """Checks the stored details for problems left by hand edits or bad
+        merges, see BugsDict.verify(): details of bugs which aren't in ids and
+        unresolved merge conflicts, along with any the backend can find in its
+        own files.  Returns a list of (location, message, repairable) problems.
+        If repair is true those which are repairable are repaired; details of
+        unknown bugs only are if known is true, i.e. ids are all the bugs
+        there are."""
+        return []
+
+    @abc.abstractmethod
+    def append_events(self, events):
+        """Appends the given events, dicts which can be serialized as JSON, to
+        the change feed"""
+
+    @abc.abstractmethod
+    def events(self, cursor=None):
+        """Yields a cursor and each event in the change feed after the event
+        the given cursor was yielded with, or every event without one.  A
+        cursor is a string, which should let the feed be resumed without
+        reading the events before it.  Raises KeyError if the cursor isn't
+        known."""
+
+    def compact(self):
+        """Reclaims the space taken by superseded details, if any is kept"""
+
+    def refresh(self):
+        """Forgets anything cached about the stored bugs and details, after
+        they were changed behind the backend's back"""
+
+
+class TextStorage(Storage):
+    """The default backend: each table is a text file of one line per bug (see
+    _task_from_taskline), and each bug's details are a text file in the
+    details directory, named by its id."""
+
+    detailsdir = 'details'
+
+    def _details_path(self, full_id):
+        """Returns the path of the details file of a bug"""
+        return self._path(os.path.join(self.detailsdir, full_id + '.txt'))
+
+    def table_files(self, name):
+        return [name] if os.path.exists(self._path(name)) else []
+
+    def size(self, name):
+        return sum(os.path.getsize(self._path(relpath))
+                   for relpath in self.table_files(name))
+
+    def records(self, name):
+        for relpath in self.table_files(name):
+            for item in self._file_records(relpath):
+                yield item
+
+    def _file_records(self, relpath):
+        """Yields the id and line of each bug in one of the table files"""
+        path = self._path(relpath)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as tfile:
+            for line in tfile:
+                line = line.strip()
+                if not line:
+                    continue
+                match = _TASK_ID.search(line)
+                if match:
+                    yield match.group(1), line
+                else:
+                    task = _task_from_taskline(line)
+                    yield (task['id'],
+                           _tasklines_from_tasks([task])[0].strip())
+
+    def parse(self, record):
+        return _task_from_taskline(record.strip())
+
+    def scan(self, name):
+        text = ''
+        for relpath in self.table_files(name):
+            with open(self._path(relpath), 'r') as tfile:
+                text += tfile.read()
+        records = _TASK_RECORD.findall(text)
+        if len(records) != len(_NONBLANK_LINE.findall(text)):
+            return None
+        return dict((task_id, line) for line, task_id in records)
+
+    def load(self, name):
+        tasks = []
+        for relpath in self.table_files(name):
+            with open(self._path(relpath), 'r') as tfile:
+                tasks.extend(_task_from_taskline(tl.strip()) for tl in tfile
+                             if tl.strip())
+        return tasks
+
+    def save(self, name, tasks):
+        self.save_file(name, tasks)
+
+    def save_file(self, relpath, tasks):
+        """Replaces the bugs in one of the table_files() with the given ones,
+        which are sorted by id"""
+        path = self._path(relpath)
+        _mkdir_p(os.path.dirname(path))
+        with open(path, 'w') as tfile:
+            tfile.writelines(_tasklines_from_tasks(tasks))
+
+    def update(self, name, tasks, removed, budget):
+        _mkdir_p(self._path(''))
+        self._update_file(name, tasks, removed, budget)
+
+    def _update_file(self, relpath, tasks, removed, budget):
+        """Merges tasks into one of the table files, see update()"""
+        replaced = set(removed).union(task['id'] for task in tasks)
+        lines = itertools.chain(
+            (line + '\n' for task_id, line in self._file_records(relpath)
+             if task_id not in replaced),
+            _tasklines_from_tasks(tasks))
+        path = self._path(relpath)
+        with open(path + '.tmp', 'w') as tfile:
+            tfile.writelines(_external_sort(
+                lines, lambda line: _TASK_ID.search(line).group(1), budget))
+        os.rename(path + '.tmp', path)
+
+    def _stats(self, names):
+        """Returns the name, size and mtime of the given files in the bugs
+        directory, or None for those which don't exist"""
+        stats = []
+        for name in names:
+            try:
+                st = os.stat(self._path(name))
+                stats.append((name, st.st_size, st.st_mtime))
+            except OSError:
+                stats.append((name, None, None))
+        return stats
+
+    def stats(self, details=False):
+        names = [relpath for name in self.tables
+                 for relpath in self.table_files(name) or [name]]
+        if details:
+            dirpath = self._path(self.detailsdir)
+            if os.path.isdir(dirpath):
+                names += [os.path.join(self.detailsdir, name)
+                          for name in sorted(os.listdir(dirpath))]
+        return self._stats(names)
+
+    def read_details(self, full_id):
+        path = self._details_path(full_id)
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read()
+        return None
+
+    def write_details(self, full_id, text):
+        path = self._details_path(full_id)
+        _mkdir_p(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def append_details(self, full_id, text, initial=''):
+        path = self._details_path(full_id)
+        if not os.path.exists(path):
+            self.write_details(full_id, initial)
+        with open(path, 'a') as f:
+            f.write(text)
+
+    def details_path(self, full_id):
+        return self._details_path(full_id)
+
+    def details_summary(self, full_id):
+        path = self._details_path(full_id)
+        if not os.path.exists(path):
+            return None
+        return _details_summary(path, os.stat(path))
+
+    def details_summaries(self, cached):
+        dirpath = self._path(self.detailsdir)
+        names = os.listdir(dirpath) if os.path.isdir(dirpath) else []
+        summaries = {}
+        for name in names:
+            if not name.endswith('.txt'):
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            summary = cached.get(name[:-4])
+            if (summary is None or summary['size'] != st.st_size
+                    or summary['mtime'] != st.st_mtime):
+                summary = _details_summary(path, st)
+            summaries[name[:-4]] = summary
+        return summaries
+
+    def details_files(self, full_id):
+        return [os.path.join(self.detailsdir, full_id + '.txt')]
+
+    def verify_details(self, ids, repair, known=True):
+        """Also checks for files in the details directory which aren't details,
+        reading the details files concurrently."""
+        problems = []
+        dirpath = self._path(self.detailsdir)
+        names = sorted(os.listdir(dirpath)) if os.path.isdir(dirpath) else []
+        pool = ThreadPool(_VERIFY_THREADS)
+        try:
+            checked = pool.map(_check_details,
+                               [os.path.join(dirpath, name) for name in names
+                                if name.endswith('.txt')])
+        finally:
+            pool.close()
+        checked = iter(checked)
+        for name in names:
+            where = os.path.join(self.detailsdir, name)
+            path = os.path.join(dirpath, name)
+            if not name.endswith('.txt'):
+                problems.append((where, _("not a details file"), True))
+            elif name[:-4] not in ids:
+                problems.append((where, _("no bug with this id"), known))
+                next(checked)
+                if not known:
+                    continue
+            else:
+                problem = next(checked)
+                if problem:
+                    problems.append((where, problem, False))
+                continue
+            if repair:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        return problems
+
+    def append_events(self, events):
+        _mkdir_p(self._path(''))
+        with open(self._path(_FEED_FILE), 'ab') as f:
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def events(self, cursor=None):
+        """The feed is a file of one event per line, as JSON.  Cursors are the
+        offset of the line of an event and a prefix of the event's id; if the
+        line at the offset is of another event, e.g. once the feed has been
+        merged, the feed is searched for the event."""
+        path = self._path(_FEED_FILE)
+        if not os.path.exists(path):
+            if cursor:
+                raise KeyError(cursor)
+            return
+        with open(path, 'rb') as f:
+            if cursor:
+                offset, _sep, event_id = cursor.partition('-')
+                if not offset.isdigit() or not event_id:
+                    raise KeyError(cursor)
+                f.seek(int(offset))
+                if not self._event_line(f.readline(), event_id):
+                    f.seek(0)
+                    for line in iter(f.readline, ''):
+                        if self._event_line(line, event_id):
+                            break
+                    else:
+                        raise KeyError(cursor)
+            for line in iter(f.readline, ''):
+                if line.strip():
+                    event = json.loads(line)
+                    yield ('%d-%s' % (f.tell() - len(line), event['id'][:12]),
+                           event)
+
+    @staticmethod
+    def _event_line(line, event_id):
+        """Returns whether line is the line of an event whose id starts with
+        event_id"""
+        try:
+            return json.loads(line)['id'].startswith(event_id)
+        except (ValueError, KeyError, TypeError):
+            return False
+
+
+class PackedStorage(TextStorage):
+    """Keeps the tables as TextStorage does, but stores details in a single
+    append-only pack file (see _pack_record) rather than a file per bug.
+    Details files which already exist are still read until the bug's details
+    are next changed."""
+
+    def __init__(self, bugsdir, cachedir=None):
+        super(PackedStorage, self).__init__(bugsdir, cachedir)
+        self._pack = None
+
+    def _pack_path(self):
+        """Returns the path to the details pack"""
+        return self._path(_PACK_FILE)
+
+    def _pack_index(self):
+        """Returns a mapping of bug ids to the offset and length of their
+        details in the details pack.
+
+        The index is persisted in the cachedir along with the size and mtime of
+        the pack, which is only scanned again if it was changed elsewhere, e.g.
+        by updating the working copy."""
+        if self._pack is not None:
+            return self._pack
+        try:
+            st = os.stat(self._pack_path())
+        except OSError:
+            self._pack = {}
+            return self._pack
+        cache = None
+        if self.cachedir:
+            cache = os.path.join(self.cachedir, 'details.idx')
+            try:
+                with open(cache) as f:
+                    if f.readline() == '%d %r\n' % (st.st_size, st.st_mtime):
+                        self._pack = {}
+                        for line in f:
+                            task_id, offset, length = line.split()
+                            self._pack[task_id] = (int(offset), int(length))
+            except (IOError, ValueError):
+                self._pack = None  # missing or corrupt, rebuild it
+        if self._pack is None:
+            with open(self._pack_path(), 'rb') as f:
+                self._pack = dict((e[0], e[1:]) for e in _pack_entries(f))
+            self._save_pack_index()
+        return self._pack
+
+    def _save_pack_index(self):
+        """Persists the pack index to the cachedir, if there is one"""
+        if not self.cachedir:
+            return
+        st = os.stat(self._pack_path())
+        _mkdir_p(self.cachedir)
+        with open(os.path.join(self.cachedir, 'details.idx'), 'w') as f:
+            f.write('%d %r\n' % (st.st_size, st.st_mtime))
+            for task_id, (offset, length) in sorted(self._pack.items()):
+                f.write('%s %d %d\n' % (task_id, offset, length))
+
+    def stats(self, details=False):
+        return (super(PackedStorage, self).stats(details) +
+                self._stats([_PACK_FILE]))
+
+    def read_details(self, full_id):
+        entry = self._pack_index().get(full_id)
+        if entry is None:
+            return super(PackedStorage, self).read_details(full_id)
+        with open(self._pack_path(), 'rb') as f:
+            f.seek(entry[0])
+            return f.read(entry[1])
+
+    def prefetch_details(self, full_ids):
+        """Reads packed details in order from the one file, there's nothing to
+        gain from reading it concurrently"""
+        index = self._pack_index()
+        if not index:
+            for text in super(PackedStorage, self).prefetch_details(full_ids):
+                yield text
+            return
+        with open(self._pack_path(), 'rb') as f:
+            for full_id in full_ids:
+                entry = index.get(full_id)
+                if entry is None:
+                    yield super(PackedStorage, self).read_details(full_id)
+                else:
+                    f.seek(entry[0])
+                    yield f.read(entry[1])
+
+    def write_details(self, full_id, text):
+        """Appends the new details to the pack, and compacts the pack if it is
+        mostly made up of superseded records"""
+        index = self._pack_index()
+        record = _pack_record(full_id, text)
+        _mkdir_p(self._path(''))
+        with open(self._pack_path(), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            index[full_id] = (f.tell() + len(record) - len(text) - 1,
+                              len(text))
+            f.write(record)
+            size = f.tell()
+        live = sum(len(task_id) + len(str(length)) + length + 3
+                   for task_id, (_offset, length) in index.items())
+        if size - live > max(live, _PACK_SLACK):
+            self.compact()
+        else:
+            self._save_pack_index()
+
+    def append_details(self, full_id, text, initial=''):
+        # records can't be appended to, append a new record for the bug
+        Storage.append_details(self, full_id, text, initial)
+
+    def details_path(self, full_id):
+        return None
+
+    def details_summary(self, full_id):
+        entry = self._pack_index().get(full_id)
+        if entry is None:
+            return super(PackedStorage, self).details_summary(full_id)
+        offset, length = entry
+        return _summarize_details(self.read_details(full_id), length, offset)
+
+    def details_summaries(self, cached):
+        summaries = super(PackedStorage, self).details_summaries(cached)
+        if self._pack_index():
+            with open(self._pack_path(), 'rb') as f:
+                for task_id, (offset, length) in self._pack_index().items():
+                    summary = cached.get(task_id)
+                    if (summary is None or summary['size'] != length
+                            or summary['mtime'] != offset):
+                        f.seek(offset)
+                        summary = _summarize_details(f.read(length), length,
+                                                     offset)
+                    summaries[task_id] = summary
+        return summaries
+
+    def details_files(self, full_id):
+        return [_PACK_FILE]
+
+    def verify_details(self, ids, repair, known=True):
+        """Also checks the details pack for corrupt records, which are
+        repaired by truncating the pack before the first of them."""
+        problems = super(PackedStorage, self).verify_details(ids, repair,
+                                                             known)
+        path = self._pack_path()
+        if not os.path.exists(path):
+            return problems
+        pack_problems = []
+        records = {}
+        with open(path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                header = f.readline()
+                if not header:
+                    break
+                try:
+                    task_id, length = header.split()
+                    length = int(length)
+                except ValueError:
+                    length = -1
+                text = f.read(max(length, 0))
+                if len(text) != length or f.read(1) != '\n':
+                    pack_problems.append((_PACK_FILE, _(
+                        "corrupt record at byte %d, and everything after it")
+                        % offset, True))
+                    break
+                records[task_id] = text
+        for task_id, text in sorted(records.items()):
+            if task_id not in ids:
+                pack_problems.append((_PACK_FILE, _(
+                    "details of unknown bug %s") % task_id, known))
+            elif _CONFLICT_MARKER.search(text):
+                pack_problems.append((_PACK_FILE, _(
+                    "unresolved merge conflict in details of %s") % task_id,
+                    False))
+        if repair and any(fixable for _w, _m, fixable in pack_problems):
+            with open(path + '.tmp', 'wb') as dest:
+                for task_id, text in sorted(records.items()):
+                    if task_id in ids or not known:
+                        dest.write(_pack_record(task_id, text))
+            os.rename(path + '.tmp', path)
+            self.refresh()
+        return problems + pack_problems
+
+    def compact(self):
+        """Rewrites the details pack with only the current details of each bug,
+        dropping superseded records."""
+        index = self._pack_index()
+        if not index:
+            return
+        compacted = {}
+        temp = self._pack_path() + '.tmp'
+        with open(self._pack_path(), 'rb') as src:
+            with open(temp, 'wb') as dest:
+                for task_id in sorted(index):
+                    offset, length = index[task_id]
+                    src.seek(offset)
+                    record = _pack_record(task_id, src.read(length))
+                    compacted[task_id] = (
+                        dest.tell() + len(record) - length - 1, length)
+                    dest.write(record)
+        os.rename(temp, self._pack_path())
+        self._pack = compacted
+        self._save_pack_index()
+
+    def refresh(self):
+        self._pack = None
+
+
+class ShardedStorage(TextStorage):
+    """Keeps each table as a directory of shards, e.g. bugs.d/3f, text files
+    of the bugs whose ids start with the shard's name, so a change to a bug
+    only rewrites (and versions) its shard, and changes on different branches
+    rarely touch the same file.  Looking up a prefix only reads the shards it
+    could be in.  Details are stored as TextStorage stores them."""
+
+    suffix = '.d'
+    # The number of characters of the ids which name the shards
+    shard_len = 2
+    partial = True
+
+    def _shards(self, name, prefix=''):
+        """Returns the paths, relative to the bugs directory, of the shards of
+        the named table which could hold ids starting with prefix"""
+        dirpath = self._path(name + self.suffix)
+        if not os.path.isdir(dirpath):
+            return []
+        key = prefix[:self.shard_len]
+        return [os.path.join(name + self.suffix, shard)
+                for shard in sorted(os.listdir(dirpath))
+                if shard.startswith(key) and not shard.endswith('.tmp')]
+
+    def _shard(self, name, full_id):
+        """Returns the path of the shard of the named table for the given id"""
+        return os.path.join(name + self.suffix, full_id[:self.shard_len])
+
+    def table_files(self, name):
+        return self._shards(name)
+
+    def ids(self, name, prefix=''):
+        for relpath in self._shards(name, prefix):
+            for task_id, _record in self._file_records(relpath):
+                if task_id.startswith(prefix):
+                    yield task_id
+
+    def find(self, name, full_id):
+        for task_id, record in self._file_records(self._shard(name, full_id)):
+            if task_id == full_id:
+                return self.parse(record)
+        return None
+
+    def save(self, name, tasks):
+        """Writes only the shards whose bugs changed, and removes those left
+        without bugs"""
+        shards = {}
+        for task in tasks:
+            shards.setdefault(self._shard(name, task['id']), []).append(task)
+        for relpath in set(self._shards(name)) - set(shards):
+            os.remove(self._path(relpath))
+        _mkdir_p(self._path(name + self.suffix))
+        for relpath, shard_tasks in shards.items():
+            text = ''.join(_tasklines_from_tasks(shard_tasks))
+            path = self._path(relpath)
+            if os.path.exists(path):
+                with open(path, 'r') as tfile:
+                    if tfile.read() == text:
+                        continue
+            self.save_file(relpath, shard_tasks)
+
+    def update(self, name, tasks, removed, budget):
+        """Merges the bugs into only the shards they (or those removed) are
+        in"""
+        changed = {}
+        for task in tasks:
+            relpath = self._shard(name, task['id'])
+            changed.setdefault(relpath, ([], []))[0].append(task)
+        for task_id in removed:
+            relpath = self._shard(name, task_id)
+            if relpath in changed or os.path.exists(self._path(relpath)):
+                changed.setdefault(relpath, ([], []))[1].append(task_id)
+        _mkdir_p(self._path(name + self.suffix))
+        for relpath in sorted(changed):
+            shard_tasks, shard_removed = changed[relpath]
+            self._update_file(relpath, shard_tasks, shard_removed, budget)
+            if not os.path.getsize(self._path(relpath)):
+                os.remove(self._path(relpath))
+
+
+# The storage backends the bugs.storage setting can select, by name
+_STORAGE = {'text': TextStorage, 'packed': PackedStorage,
+            'sharded': ShardedStorage}
+
+
 #
 # b's business logic and programatic API
 #
@@ -317,20 +1606,100 @@ class BugsDict(object):
     The list's file is read from disk when initialized. The items
     can be written back out to disk with the write() function.
     
-    You can specify any taskdir you want, but the intent is to work from the cwd
-    and therefore anything calling this class ought to handle that change
-    (normally to the repo root)
+    You can specify any bugsdir you want; a relative one is relative to the
+    cwd, so the command line passes an absolute path under the repo root
+    rather than changing the cwd.
     """
 
-    def __init__(self, bugsdir='.bugs', user='', fast_add=False):
-        """Initialize by reading the task files, if they exist."""
+    def __init__(self, bugsdir='.bugs', user='', fast_add=False, **options):
+        """Initialize by reading the task files, if they exist.
+
+        bugsdir may start with ~, and is made absolute, so the storage created
+        for it finds the same files if the working directory changes.  The
+        other options are keyword arguments:
+
+        cachedir, if set, is a directory (outside the bugs directory) used to
+        persist data derived from the bugs database between runs.
+
+        storage is the backend the bugs and their details are kept in, either
+        a Storage instance or the name of one in _STORAGE, 'text' by default;
+        'packed' stores details in a single append-only pack file rather than
+        a file per bug.
+
+        If archive is true resolved bugs are moved to a separate archive file
+        when written, which is only read when a command needs resolved bugs
+        (or a prefix matches no open bugs).  Bugs which were already archived
+        are read from the archive, and moved back when reopened, either way.
+
+        If lazy is true only the ids of the bugs are read up front, and bugs
+        are parsed as they are looked up by prefix; the rest of the bugs file
+        is parsed the first time self.bugs is used.  If the storage can look
+        up a prefix without reading every bug (see Storage.partial) not even
+        the ids are read, and bugs are found as if streaming, see budget.
+
+        If budget is set, and the bugs files are larger than budget bytes, the
+        bugs aren't read into memory at all: bugs are found by reading through
+        the files a line at a time, as are the bugs listed by list(), users()
+        and iter_bugs(), and write() merges the bugs which were changed into
+        the files, sorting them in runs of up to budget bytes.  This trades
+        time for memory; commands which need every bug at once, such as
+        dupes(), still read them all, see _materialize().
+
+        If feed is true the changes made by add(), rename(), assign(),
+        comment(), set(), resolve() and reopen() are recorded as events in an
+        append-only change feed when they're written, see events()."""
+        cachedir = options.pop('cachedir', None)
+        archive = options.pop('archive', False)
+        lazy = options.pop('lazy', False)
+        budget = options.pop('budget', None)
+        storage = options.pop('storage', 'text')
+        feed = options.pop('feed', False)
+        if options:
+            raise TypeError("__init__() got an unexpected keyword argument "
+                            "'%s'" % sorted(options)[0])
+        bugsdir = os.path.abspath(os.path.expanduser(bugsdir))
         self.bugsdir = bugsdir
         self.user = user
         self.fast_add = fast_add
+        self.cachedir = cachedir
+        if isinstance(storage, basestring):
+            if storage not in _STORAGE:
+                raise InvalidInput(
+                    _("Unknown storage '%s', expected one of %s")
+                    % (storage, ', '.join(sorted(_STORAGE))))
+            storage = _STORAGE[storage](bugsdir, cachedir)
+        self.storage = storage
         self.file = 'bugs'
-        self.detailsdir = 'details'
+        self.archive = archive
+        self.archivefile = 'archive'
         self.last_added_id = None
+        self.budget = budget
+        self.feed = feed
+        # Events not yet appended to the change feed, see _log_event()
+        self._events = []
         self.bugs = {}
+        # Indexes over self.bugs, built on first use and maintained by add()
+        self._ids = None
+        self._times = None
+        self._owners = None
+        # Maps custom fields to their _field_index(), once it's been built
+        self._fields = {}
+        self._activity = None
+        # Maps ids to the crc of their title and its MinHash signature, and
+        # bands of signatures to the ids sharing them, see _dupes_index()
+        self._signatures = None
+        self._bands = None
+        # The ids whose signatures changed since the index was saved, the
+        # number of lines in the saved index (None to rewrite it) and the
+        # file_stats() it was last stamped with
+        self._dupes_changed = set()
+        self._dupes_lines = None
+        self._dupes_stamp = None
+        # The ids of the bugs renamed in memory, whose cached signatures
+        # can't be trusted even if the index was stamped
+        self._retitled = set()
+        # The ids of the bugs read from the archive, once it's been read
+        self._archived = None
         # this is the default contents of the bugs directory.  If you'd like,
         # you can modify this variable's contents.  Be sure to leave [comments]
         # as the last field. Remember that storing metadata like [reporter] in
@@ -374,23 +1743,255 @@ class BugsDict(object):
             "# Comments and updates - leave your name"
         ])
 
-        path = os.path.join(os.path.expanduser(self.bugsdir), self.file)
-        if os.path.exists(path):
-            with open(path, 'r') as tfile:
-                tlns = tfile.readlines()
-                tls = [tl.strip() for tl in tlns if tl.strip()]
-                tasks = map(_task_from_taskline, tls)
-                for task in tasks:
-                    self.bugs[task['id']] = task
+        self._streaming = False
+        if (lazy and self.storage.partial) or budget is not None and sum(
+                self.storage.size(name)
+                for name in (self.file, self.archivefile)) > budget:
+            self._stream()
+        elif not (lazy and self._scan()):
+            for task in self._read_tasks(self.file):
+                self.bugs[task['id']] = task
+
+    def _scan(self):
+        """Indexes the ids in the bugs file without parsing its lines, leaving
+        self.bugs unset until it's used, see __getattr__.  Returns False,
+        without doing so, if any line lacks an id, see Storage.scan()."""
+        records = self.storage.scan(self.file)
+        if records is None:
+            return False
+        del self.bugs
+        self._records = records
+        self._parsed = {}
+        self._ids = sorted(records)
+        return True
+
+    def _stream(self):
+        """Leaves the bugs in their files, see the budget argument to
+        __init__.  The bugs which are looked up or added are kept in
+        self._parsed, along with the name of the file they were read from (or
+        None) in self._sources, and self.bugs is unset until it's used."""
+        del self.bugs
+        self._streaming = True
+        self._parsed = {}
+        self._sources = {}
+
+    def _stream_names(self):
+        """Returns the files to read through when streaming: the archive is
+        included once it would have been loaded, see _load_archive."""
+        if self._archived is None:
+            return [self.file]
+        return [self.file, self.archivefile]
+
+    def _stream_ids(self, prefix=''):
+        """Yields the id of every bug while streaming, or of those starting
+        with prefix, which the storage may find without reading every bug"""
+        last = None
+        for task_id in heapq.merge(*[self.storage.ids(name, prefix)
+                                     for name in self._stream_names()]):
+            if task_id != last:
+                yield task_id
+            last = task_id
+        for task_id, source in self._sources.items():
+            if source is None and task_id.startswith(prefix):
+                yield task_id
+
+    def _all_tasks(self):
+        """Returns every bug, reading them one at a time while streaming"""
+        if not self._streaming:
+            return self.bugs.values()
+        return self._stream_tasks()
+
+    def _stream_tasks(self):
+        """Yields every bug while streaming, parsing each line as it's read.
+
+        The files, written sorted by id, are merge-joined, so a bug in both the
+        bugs file and the archive is yielded once, from the bugs file, like
+        _load_archive() reads it.  Of the copies of a bug in one file the last
+        is read, as when it's loaded."""
+        def numbered(index, name):
+            for position, (task_id, record) in enumerate(
+                    self.storage.records(name)):
+                yield task_id, index, -position, record
+
+        last = None
+        for task_id, _i, _p, record in heapq.merge(*[
+                numbered(index, name)
+                for index, name in enumerate(self._stream_names())]):
+            if task_id == last:
+                continue
+            last = task_id
+            task = self._parsed.get(task_id)
+            yield task if task is not None else self.storage.parse(record)
+        for task_id, source in self._sources.items():
+            if source is None:
+                yield self._parsed[task_id]
+
+    def _materialize(self):
+        """Reads every bug into self.bugs, ending streaming"""
+        parsed = self._parsed
+        del self._parsed, self._sources
+        self._streaming = False
+        archived, self._archived = self._archived, None
+        self.bugs = {}
+        for task in self._read_tasks(self.file):
+            self.bugs[task['id']] = task
+        if archived is not None:
+            self._load_archive()
+        self.bugs.update(parsed)
+        return self.bugs
+
+    def _write_streamed(self):
+        """Writes the bugs which were looked up or added while streaming back
+        to their files, keeping the other bugs as they were"""
+        dests = {}
+        for task_id, task in self._parsed.items():
+            archived = not _truth(task['open']) and (
+                self.archive or self._sources[task_id] == self.archivefile)
+            dests[task_id] = self.archivefile if archived else self.file
+        for name in (self.file, self.archivefile):
+            if name == self.archivefile and not any(
+                    name in (dests[task_id], self._sources[task_id])
+                    for task_id in self._parsed):
+                continue
+            mine = [task for task_id, task in self._parsed.items()
+                    if dests[task_id] == name]
+            self.storage.update(name, sorted(mine, key=itemgetter('id')),
+                                self._parsed, self.budget)
+        for task_id in self._parsed:
+            self._sources[task_id] = dests[task_id]
+        self._flush_events()
+
+    def __getattr__(self, name):
+        """Parses the bugs file when self.bugs is first used after _scan(),
+        keeping any bugs which were already looked up."""
+        if name == 'bugs' and self.__dict__.get('_streaming'):
+            return self._materialize()
+        if name != 'bugs' or '_records' not in self.__dict__:
+            raise AttributeError(name)
+        self.bugs = {}
+        for task_id, record in self._records.items():
+            task = self._parsed.get(task_id)
+            self.bugs[task_id] = task if task is not None \
+                else self.storage.parse(record)
+        del self._records, self._parsed
+        return self.bugs
+
+    def _task(self, full_id):
+        """Returns the bug with the given id, parsing only its record if it
+        hasn't been parsed yet."""
+        if self._streaming:
+            if full_id not in self._parsed:
+                for name in self._stream_names():
+                    task = self.storage.find(name, full_id)
+                    if task is not None:
+                        self._parsed[full_id] = task
+                        self._sources[full_id] = name
+                        break
+            return self._parsed[full_id]
+        if '_records' not in self.__dict__:
+            return self.bugs[full_id]
+        if full_id not in self._parsed:
+            self._parsed[full_id] = self.storage.parse(self._records[full_id])
+        return self._parsed[full_id]
+
+    def _read_tasks(self, name):
+        """Returns the tasks in the given table of the storage"""
+        return self.storage.load(name)
+
+    def _write_tasks(self, name, tasks):
+        """Writes the given tasks to a table of the storage"""
+        self.storage.save(name, tasks)
+
+    def _load_archive(self):
+        """Reads the archived bugs, unless they've already been read.  Returns
+        whether any bugs were added."""
+        if self._archived is not None:
+            return False
+        if self._streaming:
+            self._archived = set()
+            return self.storage.exists(self.archivefile)
+        self._archived = set()
+        for task in self._read_tasks(self.archivefile):
+            # a bug in both files was changed on another branch while being
+            # archived, the bugs file wins
+            if task['id'] not in self.bugs:
+                self.bugs[task['id']] = task
+                self._archived.add(task['id'])
+        if self._archived:
+            self._ids = self._times = self._owners = None
+            self._fields = {}
+            self._signatures = self._bands = None
+        return bool(self._archived)
 
     def write(self):
         """Flush the finished and unfinished tasks to the files on disk."""
-        _mkdir_p(self.bugsdir)
-        path = os.path.join(os.path.expanduser(self.bugsdir), self.file)
+        if self._streaming:
+            return self._write_streamed()
+        if self.archive and not all(_truth(task['open'])
+                                    for task in self.bugs.values()):
+            self._load_archive()
         tasks = sorted(self.bugs.values(), key=itemgetter('id'))
-        with open(path, 'w') as tfile:
-            for taskline in _tasklines_from_tasks(tasks):
-                tfile.write(taskline)
+        if self._archived is not None:
+            self._archived = set(
+                task['id'] for task in tasks if not _truth(task['open'])
+                and (self.archive or task['id'] in self._archived))
+        archived = self._archived or set()
+        self._write_tasks(self.file, [task for task in tasks
+                                      if task['id'] not in archived])
+        if self._archived is not None and (
+                self._archived or self.storage.exists(self.archivefile)):
+            self._write_tasks(self.archivefile, [task for task in tasks
+                                                 if task['id'] in archived])
+        if self._bands is not None:
+            stamp = repr(self.file_stats())
+            if self._dupes_changed or stamp != self._dupes_stamp:
+                self._save_dupes_index(stamp)
+        self._flush_events()
+
+    def _log_event(self, op, task, **fields):
+        """Records a change to a bug for the change feed, to be appended to it
+        when the change is written"""
+        event = self._event(op, task, **fields)
+        if event is not None:
+            self._events.append(event)
+
+    def _event(self, op, task, **fields):
+        """Returns the change feed event of a change to a bug, or None if the
+        feed is off.  The id hashes the process and a sequence number too, so
+        the same change made twice in one tick of the clock gets two ids."""
+        if not self.feed:
+            return None
+        now = time.time()
+        return dict(fields, op=op, bug=task['id'], title=task['text'],
+                    user=self.user, time=now,
+                    id=_hash('%s %s %r %d %d' % (op, task['id'], now,
+                                                 os.getpid(),
+                                                 next(_EVENT_SEQUENCE)),
+                             self.user))
+
+    def _flush_events(self):
+        """Appends the recorded events to the change feed"""
+        if self._events:
+            self.storage.append_events(self._events)
+            self._events = []
+
+    def events(self, cursor=None):
+        """Yields a cursor and each event in the change feed after the event
+        the given cursor was yielded with, or every event without one.  A
+        consumer keeps the last cursor it saw, and passes it next time to
+        only read the events since.
+
+        Events are dicts of their id, time and user, the op (add, rename,
+        assign, comment, set, resolve or reopen), and the id and title of the
+        bug.  Renames, assignments and sets also have the previous title,
+        owner or value as 'from', and assignments and additions the new
+        'owner', comments the 'comment', and sets the 'field' and 'value'.
+        Raises InvalidInput if the cursor isn't known."""
+        try:
+            for item in self.storage.events(cursor):
+                yield item
+        except KeyError:
+            raise InvalidInput(_("Unknown cursor %s") % cursor)
 
     def __getitem__(self, prefix):
         """Return the task with the given prefix.
@@ -401,41 +2002,613 @@ class BugsDict(object):
         If no tasks match the prefix an UnknownPrefix exception will be raised.
         
         """
-        matched = [item for item in self.bugs.keys() if item.startswith(prefix)]
+        matched = self._matches(prefix)
+        if not matched and self._load_archive():
+            matched = self._matches(prefix)
         if len(matched) == 1:
-            return self.bugs[matched[0]]
+            return self._task(matched[0])
         elif len(matched) == 0:
             raise UnknownPrefix(prefix)
+        elif matched[0] == prefix:  # an exact id sorts before its extensions
+            return self._task(prefix)
         else:
-            matched = [item for item in self.bugs.keys() if item == prefix]
-            if len(matched) == 1:
-                return self.bugs[matched[0]]
+            raise AmbiguousPrefix(prefix)
+
+    def _matches(self, prefix):
+        """Returns the ids which start with prefix, using the id index"""
+        if self._streaming:
+            return sorted(set(self._stream_ids(prefix)))
+        ids = self._id_index()
+        lo = bisect.bisect_left(ids, prefix)
+        hi = bisect.bisect_left(ids, prefix + '\xff')
+        return ids[lo:hi]
+
+    def _id_index(self):
+        """Returns a sorted list of all bug ids"""
+        if self._ids is None:
+            self._ids = sorted(self.bugs.keys())
+        return self._ids
+
+    def _time_index(self):
+        """Returns a list of (time, id) pairs for all bugs, sorted by time"""
+        if self._times is None:
+            self._times = sorted((float(task['time']), task['id'])
+                                 for task in self.bugs.values())
+        return self._times
+
+    def _owner_index(self):
+        """Returns a mapping of owners to the set of ids of their bugs"""
+        if self._owners is None:
+            self._owners = {}
+            for task in self.bugs.values():
+                self._owners.setdefault(task['owner'], set()).add(task['id'])
+        return self._owners
+
+    def _field_index(self, field):
+        """Returns a mapping of the values of a custom field to the set of ids
+        of the bugs with that value, see set()"""
+        if field not in self._fields:
+            index = {}
+            for task in self.bugs.values():
+                if field in task:
+                    index.setdefault(task[field], set()).add(task['id'])
+            self._fields[field] = index
+        return self._fields[field]
+
+    def _activity_index(self):
+        """Returns a mapping of bug ids to a summary of their details, see
+        _summarize_details.  Bugs without details are not included.
+
+        Summaries are persisted in the cachedir, and only details whose size
+        or mtime changed since they were cached are read again."""
+        if self._activity is not None:
+            return self._activity
+        cache = None
+        cached = {}
+        if self.cachedir:
+            cache = os.path.join(self.cachedir, 'activity')
+            try:
+                with open(cache) as f:
+                    for line in f:
+                        task_id, size, mtime, comments, last = line.split()
+                        cached[task_id] = {
+                            'size': int(size), 'mtime': float(mtime),
+                            'comments': int(comments),
+                            'last_comment':
+                                None if last == '-' else float(last)}
+            except (IOError, ValueError):
+                cached = {}  # missing or corrupt, rebuild it
+
+        self._activity = self.storage.details_summaries(cached)
+
+        # Files modified in the last couple seconds could be modified again
+        # without their mtime changing, so leave them to be read next time
+        recent = time.time() - 2
+        cacheable = dict((task_id, summary) for task_id, summary
+                         in self._activity.items()
+                         if summary['mtime'] < recent)
+        if cache and cacheable != cached:
+            _mkdir_p(self.cachedir)
+            with open(cache, 'w') as f:
+                for task_id, summary in sorted(cacheable.items()):
+                    last = summary['last_comment']
+                    f.write('%s %d %r %d %s\n' % (
+                        task_id, summary['size'], summary['mtime'],
+                        summary['comments'],
+                        '-' if last is None else repr(last)))
+        return self._activity
+
+    def _update_activity(self, full_id):
+        """Refreshes the activity summary of a bug whose details changed"""
+        if self._activity is None:
+            return
+        self._activity[full_id] = self.storage.details_summary(full_id)
+
+    def activity(self, prefix):
+        """Returns a summary of the activity on the given bug: whether it has
+        a details file, the number of comments and the time of the last one,
+        the size of the details file, and the time of the last activity -
+        the last comment, or when the bug was filed."""
+        task = self[prefix]
+        summary = self._activity_index().get(task['id'])
+        last = float(task['time'])
+        if summary is None:
+            return {'details': False, 'comments': 0, 'last_comment': None,
+                    'size': 0, 'last_activity': last}
+        return {'details': True, 'comments': summary['comments'],
+                'last_comment': summary['last_comment'],
+                'size': summary['size'],
+                'last_activity': max(last, summary['last_comment'] or 0)}
+
+    def _prefix(self, full_id):
+        """Returns the unique prefix of the given id.
+
+        Equivalent to _prefixes(self.bugs)[full_id], but only compares the id
+        to its neighbors in the id index rather than to every bug."""
+        if self._streaming:
+            return self._prefixes([full_id])[full_id]
+        ids = self._id_index()
+        i = bisect.bisect_left(ids, full_id)
+        common = 0
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(ids):
+                common = max(common, _common_prefix_len(ids[j], full_id))
+        return full_id[:common + 1]
+
+    def _prefixes(self, full_ids):
+        """Returns a mapping of the given ids to their unique prefixes, like
+        _prefix(), comparing them in one pass while streaming to every bug
+        which shares a first character with one of them.  If they all share
+        one, the storage may find those bugs without reading the rest."""
+        if not self._streaming:
+            return dict((task_id, self._prefix(task_id))
+                        for task_id in full_ids)
+        ids = sorted(set(full_ids))
+        common = dict.fromkeys(ids, 0)
+        for task_id in self._stream_ids(os.path.commonprefix(ids)[:1]):
+            i = bisect.bisect_left(ids, task_id)
+            for j in (i - 1, i):
+                if 0 <= j < len(ids) and ids[j] != task_id:
+                    common[ids[j]] = max(common[ids[j]],
+                                         _common_prefix_len(ids[j], task_id))
+        return dict((task_id, task_id[:common[task_id] + 1])
+                    for task_id in ids)
+
+    def file_stats(self, details=False):
+        """Returns the size and mtime of the files the bugs are stored in, and
+        optionally of the details, to detect when they're changed; see
+        Storage.stats()."""
+        return self.storage.stats(details)
+
+    def _dupes_index(self):
+        """Returns the bands of the MinHash signatures of the bugs' titles, a
+        mapping of (band number, hashes) to the ids of the bugs sharing them.
+
+        Signatures are persisted in the cachedir along with a crc of the title
+        they were computed from, and only computed for bugs which were added
+        or renamed since.  write() stamps the index with the file_stats() of
+        the tables once they're written, and while the stamp is current the
+        crcs needn't be checked.  add() and rename() keep the index up to date
+        once it's built."""
+        if self._bands is not None:
+            return self._bands
+        cached = {}
+        stamp = None
+        self._dupes_lines = None
+        if self.cachedir:
+            try:
+                with open(os.path.join(self.cachedir, 'dupes')) as f:
+                    if f.readline() == 'minhash %d %d\n' % (_MINHASH_SIZE,
+                                                             _LSH_ROWS):
+                        lines = 1
+                        for line in f:
+                            lines += 1
+                            # only a stamp after every signature holds
+                            stamp = None
+                            if line.startswith('@ '):
+                                stamp = line[2:].rstrip('\n')
+                                continue
+                            task_id, crc, sig = line.split()
+                            cached[task_id] = (int(crc, 16), tuple(
+                                int(h, 16) for h in sig.split(',') if h))
+                        self._dupes_lines = lines
+            except (IOError, ValueError):
+                cached = {}  # missing or corrupt, rebuild it
+                stamp = None
+                self._dupes_lines = None
+        self._dupes_stamp = stamp
+        trusted = stamp is not None and stamp == repr(self.file_stats())
+        self._signatures = {}
+        self._bands = {}
+        self._dupes_changed = set()
+        for task_id in self.bugs:
+            signature = cached.get(task_id)
+            if (signature is None or task_id in self._retitled
+                    or not trusted
+                    and signature[0] != self._title_crc(task_id)):
+                self._index_title(task_id)
             else:
-                raise AmbiguousPrefix(prefix)
+                self._index_title(task_id, signature)
+        if len(cached) != len(self._signatures):
+            self._dupes_lines = None  # drop the bugs which are gone
+        if self._dupes_changed or self._dupes_lines is None:
+            self._save_dupes_index()
+        return self._bands
+
+    def _title_crc(self, full_id):
+        """Returns the crc of a bug's title, to detect when it changes"""
+        return zlib.crc32(self.bugs[full_id]['text']) & 0xffffffff
+
+    def _index_title(self, full_id, signature=None):
+        """Adds a bug's title to the duplicates index, replacing any previous
+        title.  signature is the bug's (title crc, MinHash signature), which is
+        computed if not given."""
+        old = self._signatures.get(full_id)
+        if old is not None:
+            for band in self._title_bands(old[1]):
+                self._bands[band].discard(full_id)
+        if signature is None:
+            signature = (self._title_crc(full_id),
+                         _minhash(_shingles(self.bugs[full_id]['text'])))
+            self._dupes_changed.add(full_id)
+        self._signatures[full_id] = signature
+        for band in self._title_bands(signature[1]):
+            self._bands.setdefault(band, set()).add(full_id)
+
+    @staticmethod
+    def _title_bands(signature):
+        """Returns the LSH bands of a MinHash signature"""
+        return [(i, signature[i:i + _LSH_ROWS])
+                for i in range(0, len(signature), _LSH_ROWS)]
+
+    def _save_dupes_index(self, stamp=None):
+        """Persists the title signatures to the cachedir, if there is one.
+
+        The signatures which changed since the index was last saved are
+        appended to it, the last line for an id winning, unless superseded
+        lines would then outnumber the rest and it's rewritten.  stamp is the
+        file_stats() of the tables the signatures are known to match, see
+        _dupes_index()."""
+        changed, self._dupes_changed = self._dupes_changed, set()
+        if not self.cachedir:
+            return
+        _mkdir_p(self.cachedir)
+        if (self._dupes_lines is None or self._dupes_lines + len(changed)
+                > 2 * len(self._signatures) + 1):
+            mode, ids = 'w', sorted(self._signatures)
+            lines = ['minhash %d %d\n' % (_MINHASH_SIZE, _LSH_ROWS)]
+        else:
+            mode, ids, lines = 'a', sorted(changed), []
+        for task_id in ids:
+            crc, sig = self._signatures[task_id]
+            lines.append('%s %x %s\n' % (task_id, crc,
+                                         ','.join('%x' % h for h in sig)))
+        if stamp is not None:
+            lines.append('@ %s\n' % stamp)
+        with open(os.path.join(self.cachedir, 'dupes'), mode) as f:
+            f.writelines(lines)
+        self._dupes_lines = len(lines) + (self._dupes_lines if mode == 'a'
+                                          else 0)
+        self._dupes_stamp = stamp
+
+    def duplicates(self, text, threshold=0.5, exclude=None):
+        """Returns the open bugs whose titles are similar to text, as a list of
+        (similarity, id) pairs with the most similar first.
+
+        similarity is the Jaccard similarity of the titles' character
+        trigrams, and only bugs at least as similar as threshold are returned.
+        Candidates are found through the duplicates index, so only bugs which
+        share some of text's trigrams are compared.  exclude is an id to leave
+        out, such as the bug text is the title of."""
+        bands = self._dupes_index()
+        shingles = _shingles(text)
+        candidates = set()
+        for band in self._title_bands(_minhash(shingles)):
+            candidates.update(bands.get(band, ()))
+        candidates.discard(exclude)
+        found = []
+        for task_id in candidates:
+            task = self.bugs[task_id]
+            if not _truth(task['open']):
+                continue
+            similarity = _jaccard(shingles, _shingles(task['text']))
+            if similarity >= threshold:
+                found.append((similarity, task_id))
+        return sorted(found, key=lambda pair: (-pair[0], pair[1]))
+
+    def dupes(self, threshold=0.5):
+        """Lists groups of open bugs with similar titles, see duplicates()
+
+        Bugs are grouped with every bug they're similar to, so members of a
+        group aren't necessarily all similar to each other."""
+        bands = self._dupes_index()
+        groups = {}  # union-find forest of similar bugs
+
+        def find(task_id):
+            while groups.get(task_id, task_id) != task_id:
+                task_id = groups[task_id]
+            return task_id
+        # similar titles share several bands, so gather the pairs to compare
+        # from all of them before comparing each pair once
+        pairs = set()
+        for members in bands.values():
+            members = sorted(m for m in members
+                             if _truth(self.bugs[m]['open']))
+            if len(members) > _LSH_MAX_BUCKET:
+                continue
+            for i, one in enumerate(members):
+                for other in members[i + 1:]:
+                    pairs.add((one, other))
+        shingles = {}
+        for one, other in sorted(pairs):
+            if find(one) == find(other):
+                continue
+            for m in (one, other):
+                if m not in shingles:
+                    shingles[m] = _shingles(self.bugs[m]['text'])
+            if _jaccard(shingles[one], shingles[other]) >= threshold:
+                groups[find(other)] = find(one)
+        clusters = {}
+        for task_id in groups:
+            clusters.setdefault(find(task_id), []).append(task_id)
+        clusters = [sorted(members, key=lambda m: float(self.bugs[m]['time']))
+                    for members in clusters.values()]
+        clusters.sort(key=lambda members: float(self.bugs[members[0]]['time']))
+        out = ''
+        for members in clusters:
+            for task_id in members:
+                out += _('%s - %s\n') % (self._prefix(task_id),
+                                         self.bugs[task_id]['text'])
+            out += '\n'
+        return out + _("Found %d group%s of possible duplicates") % (
+            len(clusters), '' if len(clusters) == 1 else 's')
+
+    def sql(self, query, params=()):
+        """Runs a read-only SQL query against a SQLite mirror of the bugs,
+        returning the names of the columns and the rows.
+
+        The mirror has a bugs table with the id, title, owner, open (0 or 1),
+        time and archived (0 or 1) of each bug, indexed by owner, open and
+        time, and a full-text search table, search, with the id, title and
+        details of each bug, whose docid is the rowid of the bug in bugs:
+
+            SELECT id, title FROM search WHERE search MATCH 'crash'
+
+        The mirror is kept in the cachedir (or in memory, without one), and
+        before each query is synchronised with the bugs files, updating only
+        the bugs whose lines or details changed since."""
+        if sqlite3 is None:
+            raise InvalidCommand(_("SQL queries need Python's sqlite3 module"))
+        path = os.path.join(self.cachedir, 'bugs.sqlite') if self.cachedir \
+            else ':memory:'
+        if self.cachedir:
+            _mkdir_p(self.cachedir)
+        conn = sqlite3.connect(path)
+        try:
+            conn.text_factory = str
+            if conn.execute('PRAGMA user_version').fetchone()[0] != \
+                    _SQL_VERSION:
+                conn.close()
+                if path != ':memory:':
+                    os.remove(path)
+                conn = sqlite3.connect(path)
+                conn.text_factory = str
+                conn.executescript(_SQL_SCHEMA)
+            self._sync_sql(conn)
+            conn.execute('PRAGMA query_only = ON')
+            try:
+                cursor = conn.execute(query, params)
+            except (sqlite3.Error, sqlite3.Warning), e:
+                raise InvalidInput(_("Invalid query: %s") % e)
+            columns = [column[0] for column in cursor.description or []]
+            return columns, cursor.fetchall()
+        finally:
+            conn.close()
+
+    def _sync_sql(self, conn):
+        """Brings the SQLite mirror up to date with the bugs files, see
+        sql()"""
+        stats = repr(self.file_stats(True))
+        if conn.execute('SELECT stats FROM _files').fetchone() == (stats,):
+            return
+        lines = {}
+        for name in (self.archivefile, self.file):  # the bugs file wins
+            for task_id, line in self.storage.records(name):
+                lines[task_id] = (line, name == self.archivefile)
+        details = dict((task_id, repr(sorted(summary.items()))) for
+                       task_id, summary in self._activity_index().items())
+        synced = dict((task_id, (line, synced_details)) for
+                      task_id, line, synced_details in
+                      conn.execute('SELECT id, line, details FROM _sync'))
+        with conn:
+            for task_id in set(synced) - set(lines):
+                rowid = conn.execute('SELECT rowid FROM bugs WHERE id = ?',
+                                     (task_id,)).fetchone()[0]
+                conn.execute('DELETE FROM bugs WHERE rowid = ?', (rowid,))
+                conn.execute('DELETE FROM search WHERE docid = ?', (rowid,))
+                conn.execute('DELETE FROM _sync WHERE id = ?', (task_id,))
+            for task_id, (line, archived) in lines.items():
+                line_key = '%s %d' % (line, archived)
+                if synced.get(task_id) == (line_key, details.get(task_id)):
+                    continue
+                task = _task_from_taskline(line)
+                values = (task['text'], task.get('owner', ''),
+                          int(_truth(task.get('open'))),
+                          float(task.get('time', 0)), int(archived), task_id)
+                if task_id in synced:
+                    conn.execute('UPDATE bugs SET title = ?, owner = ?, '
+                                 'open = ?, time = ?, archived = ? '
+                                 'WHERE id = ?', values)
+                    rowid = conn.execute('SELECT rowid FROM bugs WHERE id = ?',
+                                         (task_id,)).fetchone()[0]
+                    conn.execute('DELETE FROM search WHERE docid = ?',
+                                 (rowid,))
+                else:
+                    rowid = conn.execute(
+                        'INSERT INTO bugs (title, owner, open, time, '
+                        'archived, id) VALUES (?, ?, ?, ?, ?, ?)',
+                        values).lastrowid
+                conn.execute('INSERT INTO search (docid, id, title, details) '
+                             'VALUES (?, ?, ?, ?)',
+                             (rowid, task_id, task['text'],
+                              self._read_details(task_id) or ''))
+                conn.execute('INSERT OR REPLACE INTO _sync VALUES (?, ?, ?)',
+                             (task_id, line_key, details.get(task_id)))
+            conn.execute('DELETE FROM _files')
+            conn.execute('INSERT INTO _files VALUES (?)', (stats,))
+
+    def verify(self, repair=False):
+        """Checks the bugs files, details files and details pack for problems
+        left by hand edits or bad merges: lines which can't be parsed or are
+        missing fields, bugs with the same id, details without a bug, files in
+        the details directory which aren't details, corrupt pack records, and
+        unresolved merge conflicts.  Details files are read concurrently.
+
+        If repair is true the problems which can be are repaired: missing
+        fields are filled in, the duplicates b ignores (all but the last line
+        with an id, preferring the bugs file to the archive) are dropped, and
+        the other files and pack records are removed.  Only the bugs files
+        with such problems are rewritten, and never one with lines which can't
+        be parsed or merge conflict markers.  The files are changed on disk,
+        so read them again before using the bugs.
+
+        Returns a report listing the problems, and the number of them which
+        weren't repaired."""
+        problems = []  # of (location, message, repairable)
+        entries = {}  # maps file names to the (line number, task) in them
+        broken = set()  # files with lines which can't be parsed
+        # the bugs files, then the archive files
+        files = [relpath for name in (self.file, self.archivefile)
+                 for relpath in self.storage.table_files(name)]
+        for relpath in files:
+            path = os.path.join(self.bugsdir, relpath)
+            entries[relpath] = []
+            with open(path) as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    where = '%s:%d' % (relpath, lineno)
+                    # markers would otherwise pass for bugs added by hand
+                    if _CONFLICT_MARKER.search(line):
+                        problems.append((where, _("unresolved merge conflict"),
+                                         False))
+                        broken.add(relpath)
+                        continue
+                    try:
+                        task = _task_from_taskline(line)
+                    except IOError:
+                        problems.append((where, _("malformed line"), False))
+                        broken.add(relpath)
+                        continue
+                    missing = [field for field in _FIELD_ORDER
+                               if field not in task]
+                    if missing:
+                        problems.append((where, _("missing %s")
+                                         % ', '.join(missing), True))
+                        task.setdefault('owner', '')
+                        task.setdefault('open', 'True')
+                        task.setdefault('time', time.time())
+                        task.setdefault('id', _hash(task['text'],
+                                                    str(task['time'])))
+                    if task['open'] not in ('True', 'true', 'False', 'false'):
+                        problems.append((where, _("invalid open value %s")
+                                         % task['open'], True))
+                        task['open'] = str(_truth(task['open']))
+                    try:
+                        float(task['time'])
+                    except ValueError:
+                        problems.append((where, _("invalid time %s")
+                                         % task['time'], False))
+                    entries[relpath].append((lineno, task))
+        # the line b reads for each id, see write() and _load_archive()
+        winners = {}
+        for relpath in reversed(files):
+            for lineno, task in entries[relpath]:
+                winners[task['id']] = (relpath, lineno)
+        for relpath in files:
+            for lineno, task in entries[relpath]:
+                if winners[task['id']] != (relpath, lineno):
+                    problems.append(('%s:%d' % (relpath, lineno),
+                                     _("duplicate id %s, superseded by %s:%d")
+                                     % ((task['id'],) + winners[task['id']]),
+                                     True))
+        problems = [(where, message, fixable
+                     and where.split(':')[0] not in broken)
+                    for where, message, fixable in problems]
+        if repair:
+            fixed = set(where.split(':')[0]
+                        for where, _m, fixable in problems if fixable)
+            for relpath in files:
+                if relpath in fixed:
+                    tasks = sorted(
+                        (task for lineno, task in entries[relpath]
+                         if winners[task['id']] == (relpath, lineno)),
+                        key=itemgetter('id'))
+                    self.storage.save_file(relpath, tasks)
+
+        # unparsed lines could be the bugs apparently stray details belong to
+        details_problems = self.storage.verify_details(winners, repair,
+                                                       not broken)
+        if repair and any(fixable for _w, _m, fixable in details_problems):
+            self._activity = None
+        problems += details_problems
 
-    def _get_details_path(self, full_id):
-        """Returns the directory and file path to the details specified by id"""
-        dirpath = os.path.join(self.bugsdir, self.detailsdir)
-        path = os.path.join(dirpath, full_id + ".txt")
-        return dirpath, path
+        out = ''
+        for where, message, fixable in problems:
+            out += '%s: %s%s\n' % (where, message, _(' (repaired)')
+                                    if repair and fixable else '')
+        out += _("Found %d problem%s") % (len(problems),
+                                          '' if len(problems) == 1 else 's')
+        repaired = len([p for p in problems if p[2]]) if repair else 0
+        if repair:
+            out += _(", repaired %d") % repaired
+        return out, len(problems) - repaired
+
+    def migrate(self, storage):
+        """Moves the bugs, and their details if they're stored differently, to
+        another storage backend named in _STORAGE, e.g. from 'text' to
+        'sharded', removing the files they were kept in.  The bugs.storage
+        setting needs to name the new backend for b to find them afterwards.
+        Returns a message saying how many bugs were moved."""
+        if storage not in _STORAGE:
+            raise InvalidInput(_("Unknown storage '%s', expected one of %s")
+                               % (storage, ', '.join(sorted(_STORAGE))))
+        source = self.storage
+        target = _STORAGE[storage](self.bugsdir, self.cachedir)
+        if type(target) is type(source) or (
+                not any(source.exists(name) for name in source.tables)
+                and any(target.exists(name) for name in target.tables)):
+            raise InvalidInput(_("The bugs are already in %s storage")
+                               % storage)
+
+        moved = 0
+        for name in source.tables:
+            if not source.exists(name):
+                continue
+            old = source.table_files(name)
+            tasks = source.load(name)
+            target.save(name, tasks)
+            moved += len(tasks)
+            source.remove_files(set(old) - set(target.table_files(name)))
+
+        probe = '0' * 40
+        if source.details_files(probe) != target.details_files(probe):
+            old, new = set(), set()
+            for full_id in sorted(source.details_summaries({})):
+                target.write_details(full_id, source.read_details(full_id))
+                old.update(source.details_files(full_id))
+                new.update(target.details_files(full_id))
+            source.remove_files(old - new)
+        self.storage = target
+        self._activity = None
+        return _("Moved %d bug%s to %s storage, set storage = %s in the "
+                 "[bugs] section of your config to use it") % (
+                     moved, '' if moved == 1 else 's', storage, storage)
+
+    def compact_details(self):
+        """Reclaims the space taken by superseded details, see
+        Storage.compact()."""
+        self.storage.compact()
+        self._activity = None  # packed summaries are keyed by their offset
+
+    def _read_details(self, full_id):
+        """Returns the details of the given bug, or None if it has none"""
+        return self.storage.read_details(full_id)
 
     def _make_details_file(self, full_id):
         """ Create a details file for the given id """
-        (dirpath, path) = self._get_details_path(full_id)
-        if not os.path.exists(dirpath):
-            _mkdir_p(dirpath)
-        if not os.path.exists(path):
-            with open(path, "w+") as f:
-                f.write(self.init_details)
-        return path
+        if self.storage.read_details(full_id) is None:
+            self.storage.write_details(full_id, self.init_details)
+        return self.storage.details_path(full_id)
 
     def _users_list(self):
         """Returns a mapping of usernames to the number of open bugs assigned to
         that user"""
-        open_tasks = [item['owner'] for item in self.bugs.values() if
-                      _truth(item['open'])]
-        closed = [item['owner'] for item in self.bugs.values() if
-                  not _truth(item['open'])]
+        open_tasks, closed = [], []
+        for item in self._all_tasks():
+            (open_tasks if _truth(item['open']) else closed).append(
+                item['owner'])
         users = {}
         for user in open_tasks:
             if user in users:
@@ -483,8 +2656,8 @@ class BugsDict(object):
             if user == 'Nobody':
                 return ''
         else:  # we're forcing a new username
-            if '|' in user:
-                raise InvalidInput(_("Usernames cannot contain '|'."))
+            if '|' in user or ',' in user:
+                raise InvalidInput(_("Usernames cannot contain '|' or ','."))
         return user
 
     def id(self, prefix):
@@ -494,13 +2667,28 @@ class BugsDict(object):
     def add(self, text):
         """Adds a bug with no owner to the task list"""
         task_id = _hash(text, self.user, str(time.time()))
-        self.bugs[task_id] = {'id': task_id, 'open': 'True', 'owner': self.user,
-                              'text': text, 'time': time.time()}
+        task = {'id': task_id, 'open': 'True', 'owner': self.user,
+                'text': text, 'time': time.time()}
+        if self._streaming:
+            self._parsed[task_id] = task
+            self._sources[task_id] = None
+        else:
+            self.bugs[task_id] = task
         self.last_added_id = task_id
+        if self._ids is not None:
+            bisect.insort(self._ids, task_id)
+        if self._times is not None:
+            bisect.insort(self._times, (task['time'], task_id))
+        if self._owners is not None:
+            self._owners.setdefault(self.user, set()).add(task_id)
+        if self._bands is not None:
+            self._index_title(task_id)
+        self._log_event('add', task, owner=self.user)
         if self.fast_add:
             short_task_id = "%s..." % task_id[:10]
         else:
-            prefix = _prefixes(self.bugs.keys())[task_id]
+            prefix = (self._prefix(task_id) if self._streaming
+                      else _prefixes(self.bugs.keys())[task_id])
             short_task_id = "%s:%s" % (prefix, task_id[len(prefix):10])
         return _("Added bug %s") % short_task_id
 
@@ -519,10 +2707,16 @@ class BugsDict(object):
             find, _, repl = text.partition('/')
             text = re.sub(find, repl, task['text'])
 
+        old = task['text']
         task['text'] = text
+        self._retitled.add(task['id'])
+        self._log_event('rename', task, **{'from': old})
+        if self._bands is not None:
+            self._index_title(task['id'])
 
     def users(self):
         """Prints a list of users along with their number of open bugs"""
+        self._load_archive()
         users = self._users_list()
         if len(users) > 0:
             ulen = max([len(user) for user in users.keys()]) + 1
@@ -541,11 +2735,47 @@ class BugsDict(object):
         it will not try to guess, or warn the user."""
         task = self[prefix]
         user = self._get_user(user, force)
+        if self._owners is not None:
+            self._owners[task['owner']].discard(task['id'])
+            self._owners.setdefault(user, set()).add(task['id'])
+        self._log_event('assign', task, owner=user, **{'from': task['owner']})
         task['owner'] = user
         if user == '':
             user = 'Nobody'
         return _("Assigned %s: '%s' to %s" % (prefix, task['text'], user))
 
+    def set(self, prefix, field, value):
+        """Sets a custom field of a bug, such as its priority or milestone, or
+        removes the field if value is empty.  Custom fields are stored along
+        with the bug's other fields, and can be filtered and sorted on by
+        list() and query()."""
+        task = self[prefix]
+        value = value.strip()
+        if not _FIELD_NAME.match(field) or field in _FIELD_ORDER + ('text',):
+            raise InvalidInput(_("'%s' can't be set, fields are named by "
+                                 "letters, digits and _, and may not be one "
+                                 "of %s") % (field, ', '.join(
+                                     _FIELD_ORDER + ('text',))))
+        if any(c in value for c in ',|\n'):
+            raise InvalidInput(_("Field values can't contain ',', '|' or "
+                                 "newlines"))
+        old = task.get(field, '')
+        index = self._fields.get(field)
+        if index is not None and old:
+            index[old].discard(task['id'])
+        if value:
+            task[field] = value
+            if index is not None:
+                index.setdefault(value, set()).add(task['id'])
+        else:
+            task.pop(field, None)
+        self._log_event('set', task, field=field, value=value,
+                        **{'from': old})
+        if not value:
+            return _("Removed %s of %s: '%s'") % (field, prefix, task['text'])
+        return _("Set %s of %s: '%s' to %s") % (field, prefix, task['text'],
+                                                value)
+
     def details(self, prefix):
         """ Provides additional details on the requested bug.
         
@@ -557,11 +2787,20 @@ class BugsDict(object):
         are not displayed.
         """
         task = self[prefix]  # confirms prefix does exist
-        path = self._get_details_path(task['id'])[1]
-        if os.path.exists(path):
-            with open(path) as f:
-                text = f.read()
-
+        return self._format_details(task, self._read_details(task['id']))
+
+    def iter_details(self, prefixes):
+        """Returns an iterator over details() of each of the given bugs, in
+        order.  Every prefix is checked up front, and then the details are
+        read ahead concurrently as the iterator is consumed, see
+        Storage.prefetch_details()."""
+        tasks = [self[prefix] for prefix in prefixes]
+        texts = self.storage.prefetch_details([task['id'] for task in tasks])
+        return itertools.imap(self._format_details, tasks, texts)
+
+    def _format_details(self, task, text):
+        """Formats a bug's details for display, see details()"""
+        if text is not None:
             text = re.sub("(?m)^#.*\n?", "", text)
 
             while True:
@@ -580,77 +2819,345 @@ class BugsDict(object):
             header = header + _("*Resolved* ")
         if task['owner'] != '':
             header = header + (_("Owned By: %s\n") % task['owner'])
-        header = header + (_("Filed On: %s\n\n") % _datetime(task['time']))
-        text = header + text
+        header = header + (_("Filed On: %s\n") % _datetime(task['time']))
+        for field in sorted(task):
+            if field not in _FIELD_ORDER + ('text',):
+                header = header + '%s: %s\n' % (field, task[field])
+        text = header + '\n' + text
 
         return text.strip()
 
     def edit(self, prefix, editor):
         """Allows the user to edit the details of the specified bug"""
         task = self[prefix]  # confirms prefix does exist
-        path = self._get_details_path(task['id'])[1]
-        if not os.path.exists(path):
-            self._make_details_file(task['id'])
+        path = self.storage.details_path(task['id'])
+        if path is None:
+            self._edit_copy(task['id'], editor)
+            return
+        self._make_details_file(task['id'])
         subprocess.call("%s '%s'" % (editor, path), shell=True)
+        self._update_activity(task['id'])
+
+    def _edit_copy(self, full_id, editor):
+        """Edits details which aren't kept in a file of their own in a
+        temporary file, writing them back only if they were changed"""
+        text = self._read_details(full_id)
+        if text is None:
+            text = self.init_details
+        fd, path = tempfile.mkstemp(prefix='b-%s-' % full_id[:10],
+                                    suffix='.txt')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            subprocess.call("%s '%s'" % (editor, path), shell=True)
+            with open(path) as f:
+                edited = f.read()
+        finally:
+            os.unlink(path)
+        if edited != text:
+            self.storage.write_details(full_id, edited)
+            self._update_activity(full_id)
 
     def comment(self, prefix, comment):
         """Allows the user to add a comment to the bug without launching an editor.
         
         If they have a username set, the comment will show who made it."""
         task = self[prefix]  # confirms prefix does exist
-        path = self._get_details_path(task['id'])[1]
-        if not os.path.exists(path):
-            self._make_details_file(task['id'])
-
+        event = self._event('comment', task, comment=comment)
         comment = _("On: %s\n%s") % (_datetime(), comment)
 
         if self.user != '':
             comment = _("By: %s\n%s") % (self.user, comment)
 
-        with open(path, "a") as f:
-            f.write("\n\n" + comment)
+        self.storage.append_details(task['id'], "\n\n" + comment,
+                                    self.init_details)
+        self._update_activity(task['id'])
+        # the details are already written, unlike any other pending changes
+        if event is not None:
+            self.storage.append_events([event])
 
     def resolve(self, prefix):
         """Marks a bug as resolved"""
         task = self[prefix]
         task['open'] = 'False'
+        self._log_event('resolve', task)
 
     def reopen(self, prefix):
         """Reopens a bug that was previously resolved"""
         task = self[prefix]
         task['open'] = 'True'
-
-    def list(self, is_open=True, owner='*', grep='', alpha=False, chrono=False,
-             truncate=0):
-        """Lists all bugs, applying the given filters"""
-        tasks = dict(self.bugs.items())
-
-        prefixes = _prefixes(tasks).items()
-        for task_id, prefix in prefixes:
-            tasks[task_id]['prefix'] = prefix
-
+        self._log_event('reopen', task)
+
+    def fix(self, changesets):
+        """Resolves the open bugs which changesets say they fix, with a keyword
+        such as "fixes 3f2a" (see _fix_refs) in their description, and
+        comments on each which changeset fixed it.  changesets is a list of
+        (node, user, description) triples in the order they were committed,
+        which are all applied to the bugs in one pass; the bugs still need to
+        be written afterwards.
+
+        Returns a message for each bug resolved, and for each prefix which
+        didn't match exactly one bug."""
+        messages = []
+        for node, user, description in changesets:
+            for prefix in _fix_refs(description):
+                try:
+                    task = self[prefix]
+                except (UnknownPrefix, AmbiguousPrefix), e:
+                    messages.append(_("Changeset %s: %s") % (node, e.msg))
+                    continue
+                if not _truth(task['open']):
+                    continue
+                summary = (description.strip().splitlines() or [''])[0]
+                self.comment(task['id'], _("Fixed in changeset %s by %s: %s")
+                             % (node, user, summary))
+                self.resolve(task['id'])
+                messages.append(_("Resolved %s: '%s' (fixed in changeset %s)")
+                                % (self._prefix(task['id']), task['text'],
+                                   node))
+        return messages
+
+    def compile_query(self, query):
+        """Compiles a query into a function returning the matching bugs.
+
+        query is either a query string (see _parse_query) or a list of terms.
+        The query is parsed once; each call to the returned function uses the
+        id, owner, time or custom field index - whichever narrows the search
+        the most - to find candidate bugs, and only tests those against the
+        full query.
+
+        The function takes a chrono argument; if true, the bugs are returned
+        in the order they were filed.  It also takes a lazy argument; if true,
+        an iterator over the bugs is returned, which tests them as it goes."""
+        if isinstance(query, basestring):
+            query = _parse_query(query)
+        if not _open_only(query):
+            self._load_archive()
+        tests = []
+        # lower and upper are bisection keys into the time index
+        prefix, owners, lower, upper = '', [], None, None
+        fields = []  # (field, value) of terms on custom fields
+        comparisons = {'>': operator.gt, '>=': operator.ge,
+                       '<': operator.lt, '<=': operator.le}
+        for field, op, value in query:
+            if field == 'title':
+                field = 'text'
+            if op == '~':
+                try:
+                    regex = re.compile(value)
+                except re.error, e:
+                    raise InvalidInput(_("Invalid regular expression '%s': %s")
+                                       % (value, e))
+                tests.append(lambda t, f=field, r=regex:
+                             f in t and r.search(str(t[f])))
+            elif op == ':' and field == 'open':
+                tests.append(lambda t, o=_truth(value): _truth(t['open']) == o)
+            elif op == ':' and field == 'owner':
+                owner = self._get_user(value)
+                owners.append(owner)
+                tests.append(lambda t, o=owner: t['owner'] == o)
+            elif op == ':' and field == 'id':
+                prefix = max(prefix, value, key=len)
+                tests.append(lambda t, p=value: t['id'].startswith(p))
+            elif op == ':' and field == 'text':
+                regex = re.compile(re.escape(value), re.I)
+                tests.append(lambda t, r=regex: r.search(t['text']))
+            elif op == ':':
+                if field not in _FIELD_ORDER and value:
+                    fields.append((field, value))
+                tests.append(
+                    lambda t, f=field, v=value: str(t.get(f, '')) == v)
+            elif field == 'time':
+                if not isinstance(value, (int, float)):
+                    value = _timestamp(value)
+                # (t,) sorts before, and (t, '\xff') after, all bugs filed at t
+                key = (value,) if op in ('>=', '<') else (value, '\xff')
+                if op.startswith('>'):
+                    lower = key if lower is None else max(lower, key)
+                else:
+                    upper = key if upper is None else min(upper, key)
+                tests.append(lambda t, c=comparisons[op], v=value:
+                             c(float(t['time']), v))
+            else:
+                tests.append(lambda t, f=field, c=comparisons[op],
+                             v=_ordered(value):
+                             f in t and c(_ordered(t[f]), v))
+
+        def candidates(chrono):
+            """Returns the bugs selected by the most restrictive index, or None
+            if a scan is cheaper, and whether they're in the order filed"""
+            options = []
+            if self._streaming:
+                return None, False
+            if prefix:
+                ids = self._id_index()
+                lo = bisect.bisect_left(ids, prefix)
+                hi = bisect.bisect_left(ids, prefix + '\xff')
+                options.append((hi - lo, lambda lo=lo, hi=hi: ids[lo:hi],
+                                False))
+            if owners:
+                owned = self._owner_index().get(owners[0], ())
+                options.append((len(owned), lambda: list(owned), False))
+            for field, value in fields:
+                matched = self._field_index(field).get(value, ())
+                options.append((len(matched), lambda m=matched: list(m),
+                                False))
+            if lower is not None or upper is not None or chrono:
+                times = self._time_index()
+                lo = 0 if lower is None else bisect.bisect_left(times, lower)
+                hi = len(times) if upper is None else bisect.bisect_left(
+                    times, upper)
+                # already in order, so prefer it to equally restrictive indexes
+                options.append((hi - lo - (1 if chrono else 0),
+                                lambda lo=lo, hi=hi: [task_id for _t, task_id
+                                                      in times[lo:hi]], True))
+            if not options:
+                return None, False
+            _count, select, ordered = min(options, key=itemgetter(0))
+            return (self.bugs[task_id] for task_id in select()), ordered
+
+        def matches(chrono=False, lazy=False):
+            tasks, ordered = candidates(chrono)
+            if tasks is None:
+                tasks = self._all_tasks()
+            tasks = (task for task in tasks
+                     if all(test(task) for test in tests))
+            if chrono and not ordered:
+                tasks = sorted(tasks, key=lambda t: float(t['time']))
+            return tasks if lazy else list(tasks)
+
+        return matches
+
+    def query(self, query, chrono=False):
+        """Returns the bugs matching the given query, see _parse_query"""
+        return self.compile_query(query)(chrono)
+
+    def _filters(self, is_open, owner, grep, since, until, query, fields=()):
+        """Returns the query terms for the filters taken by list, along with
+        is_open (None if the query filters on open) and the owner's full
+        name (or '*')."""
+        terms = _parse_query(query) if query else []
+        terms += [(field, ':', value) for field, value in fields]
+        if any(term[0] == 'open' for term in terms):
+            is_open = None
+        if is_open is not None:
+            terms.append(('open', ':', str(is_open)))
+        if not _open_only(terms):
+            self._load_archive()  # before looking up owners
         if owner != '*':
             owner = self._get_user(owner)
+            terms.append(('owner', ':', owner or 'Nobody'))
+        if grep:
+            terms.append(('title', ':', grep))
+        if since is not None:
+            terms.append(('time', '>=', since))
+        if until is not None:
+            terms.append(('time', '<', until))
+        return terms, is_open, owner
+
+    def iter_bugs(self, open=True, owner='*', grep='', sort=None, since=None,
+                  until=None, query='', fields=()):
+        """Returns an iterator over the bugs matching the given filters, as Bug
+        records.
+
+        open is True or False to only include open or resolved bugs, or None
+        to include both.  owner is a user prefix as accepted by assign, or '*'
+        for any owner, grep a string the title must contain, since and until
+        timestamps bounding when the bugs were filed, query an additional
+        query string (see _parse_query), and fields (field, value) pairs of
+        custom fields the bugs must have, see set().
+
+        sort is one of 'id', 'title', 'time', 'activity' (the bug's last
+        activity, see activity()) or a custom field some bug has, or a list of
+        them in order of precedence.  Bugs without a custom field sort after
+        those with it.
+        Unsorted bugs are returned in no particular order.  Bugs are only
+        tested against the filters as the iterator is consumed, unless they
+        need to be sorted.  Don't modify the BugsDict while iterating."""
+        terms = self._filters(open, owner, grep, since, until, query,
+                              fields)[0]
+        if isinstance(sort, basestring):
+            sort = [sort]
+        return self._iter_bugs(terms, sort or [])
+
+    def _iter_bugs(self, terms, sort):
+        """Returns an iterator over the bugs matching the given query terms as
+        Bug records, sorted by the given keys"""
+        keys = {'id': itemgetter('id'),
+                'title': lambda t: t['text'].lower(),
+                'time': lambda t: float(t['time']),
+                'activity': lambda t: self.activity(t['id'])['last_activity']}
+        for key in sort:
+            if key not in keys and (key in _FIELD_ORDER
+                                    or not _FIELD_NAME.match(key)
+                                    or not self._field_index(key)):
+                raise InvalidInput(_("Cannot sort by '%s'") % key)
+            keys.setdefault(key, lambda t, k=key: (k not in t,
+                                                   _ordered(t.get(k))))
+        # the time index yields bugs in order, so needn't be sorted again
+        chrono = sort == ['time'] and not self._streaming
+        tasks = self.compile_query(terms)(chrono, lazy=True)
+        if sort and not chrono:
+            tasks = sorted(tasks,
+                           key=lambda t: tuple(keys[k](t) for k in sort))
+        if self._streaming:
+            # finding prefixes takes a pass over the bugs, so do them together
+            tasks = list(tasks)
+            prefixes = self._prefixes([task['id'] for task in tasks])
+            return (self._record(task, prefixes[task['id']]) for task in tasks)
+        return (self._record(task) for task in tasks)
+
+    def _record(self, task, prefix=None):
+        """Returns the Bug record of a task"""
+        return Bug(task['id'], prefix or self._prefix(task['id']),
+                   task['text'], task['owner'], _truth(task['open']),
+                   float(task['time']))
 
-        small = [task for task in tasks.values()
-                 if _truth(task['open']) == is_open
-                 and (owner == '*' or owner == task['owner'])
-                 and (grep == '' or grep.lower() in task['text'].lower())]
-        if len(small) > 0:
-            plen = max([len(task['prefix']) for task in small])
-        else:
-            plen = 0
-        out = ''
-        if alpha:
-            small = sorted(small, key=lambda x: x['text'].lower())
-        if chrono:
-            small = sorted(small, key=itemgetter('time'))
-        for task in small:
-            line = _('%s - %s') % (task['prefix'].ljust(plen), task['text'])
-            if 0 < truncate < len(line):
-                line = line[:truncate - 4] + '...'
-            out += line + '\n'
-        return out + _describe_print(len(small), is_open, owner, grep)
+    def list(self, is_open=True, owner='*', grep='', alpha=False, chrono=False,
+             truncate=0, since=None, until=None, query='', activity=False,
+             recent=False, fields=(), sort=()):
+        """Lists all bugs, applying the given filters
+
+        since and until are timestamps bounding when the bugs were filed, and
+        query is an additional query string (see _parse_query).  If the query
+        filters on open, is_open is ignored.  fields are (field, value) pairs
+        of custom fields the bugs must have, and sort a list of fields to sort
+        by before any of alpha, chrono and recent, see iter_bugs().
+
+        activity adds columns with the number of comments on each bug (or -
+        if it has no details file) and the date of its last activity, and
+        recent sorts the bugs by their last activity.
+
+        The bugs are found by iter_bugs()."""
+        bugs, columns, summary = self._listing(
+            is_open, owner, grep, alpha, chrono, since, until, query,
+            activity, recent, fields, sort)
+        return ''.join(line + '\n' for line in
+                       _list_lines(bugs, columns, truncate)) + summary
+
+    def _listing(self, is_open=True, owner='*', grep='', alpha=False,
+                 chrono=False, since=None, until=None, query='',
+                 activity=False, recent=False, fields=(), sort=()):
+        """Returns the bugs list() lists, as Bug records, a mapping of their
+        ids to their activity columns (empty unless activity is true), and
+        the summary line list() ends with.  See list() for the arguments."""
+        terms, is_open, owner = self._filters(is_open, owner, grep, since,
+                                              until, query, fields)
+        sort = list(sort) + [key for key, enabled in [
+            ('activity', recent), ('time', chrono), ('title', alpha)]
+            if enabled]
+        small = list(self._iter_bugs(terms, sort))
+        columns = {}
+        if activity:
+            for bug in small:
+                summary = self.activity(bug.id)
+                columns[bug.id] = '%s %s' % (
+                    summary['comments'] if summary['details'] else '-',
+                    datetime.fromtimestamp(summary['last_activity'])
+                    .strftime('%Y-%m-%d'))
+        query = ' '.join([query] + ['%s=%s' % field for field in fields])
+        return small, columns, _describe_print(
+            len(small), is_open, owner, grep, since, until, query.strip())
 
 
 #
@@ -680,6 +3187,10 @@ class ValidOpts:
         def non_default(key, value):
             if key == 'owner':
                 return value != '*'
+            if key == 'address':
+                return value != 'localhost'
+            if key == 'port':
+                return value != 8000
             return value
 
         def d(that, args, opts):
@@ -737,6 +3248,17 @@ def prefix_plus_args(f):
 # Mercurial Extention Operations
 # These are used to allow the tool to work as a Hg Extention
 #
+def _field_args(args):
+    """Parses field=value arguments into (field, value) pairs"""
+    fields = []
+    for arg in args:
+        field, sep, value = arg.partition('=')
+        if not sep or not field:
+            raise InvalidCommand(_("Expected field=value, not '%s'") % arg)
+        fields.append((field, value))
+    return fields
+
+
 def _track(ui, repo, path):
     """ Adds new files to Mercurial. """
     if os.path.exists(path):
@@ -746,8 +3268,10 @@ def _track(ui, repo, path):
 
 
 def _cat(ui, repo, path, todir, rev=None):
+    """Writes the file at path, relative to the repo root, as of rev to the
+    same path relative to todir"""
     ui.pushbuffer(error=True)
-    success = commands.cat(ui, repo, path, rev=rev,
+    success = commands.cat(ui, repo, 'path:' + util.pconvert(path), rev=rev,
                            output=os.path.join(todir, path))
     msg = ui.popbuffer()
     if success != 0:
@@ -756,6 +3280,406 @@ def _cat(ui, repo, path, todir, rev=None):
                           path, rev, msg))
 
 
+# A word in a changeset's description which may name a bug, if _FIX_REF
+# matches it
+_HEX_WORD = re.compile(r'(?<![\w#])#?[0-9a-f]{4,40}\b')
+# A keyword in a changeset's description saying it fixes one or more bugs,
+# e.g. "fixes 3f2a" or "closes 3f2a, #beef", see _fix_refs()
+_FIX_KEYWORD = re.compile(r'\b(?:fix(?:e[sd])?|close[sd]?|resolve[sd]?)\s+'
+                          r'(#?[0-9a-f]{4,40}(?:\s*,\s*#?[0-9a-f]{4,40})*)\b',
+                          re.IGNORECASE)
+# A bug id prefix a fix keyword names: one with a digit in it, so words like
+# "face" or "added" aren't taken for one, or any after an explicit #
+_FIX_REF = re.compile(r'^(?:#([0-9a-f]{4,40})'
+                      r'|((?=[a-f]*[0-9])[0-9a-f]{4,40}))$')
+
+
+def _fix_refs(description):
+    """Returns the prefixes of the bugs a changeset's description says it
+    fixes, in the order they're named, see _FIX_KEYWORD"""
+    refs = []
+    for keyword in _FIX_KEYWORD.finditer(description):
+        for ref in keyword.group(1).lower().split(','):
+            match = _FIX_REF.match(ref.strip())
+            if match:
+                refs.append(match.group(1) or match.group(2))
+    return refs
+
+
+def _rev_table_files(ctx, bugsdir, name):
+    """ Returns the paths, relative to the repo root, of the files a table of
+    bugs is kept in at a revision or the working directory: its text file, and
+    its shards if it's sharded (see ShardedStorage). """
+    path = bugsdir + '/' + name
+    match = matchmod.match(ctx.repo().root, '',
+                           ['path:' + path + ShardedStorage.suffix])
+    paths = [path] if path in ctx else []
+    return paths + sorted(ctx.manifest().walk(match))
+
+
+def _rev_file_tasks(ctx, path, rank):
+    """ Yields the bugs in a file at a revision sorted by id, keyed for
+    _rev_tasks() to merge: as (id, rank, position, task) tuples. """
+    tasks = _sorted_tasks(ctx[path].data().splitlines())
+    for position, task in enumerate(tasks):
+        yield task['id'], rank, position, task
+
+
+def _rev_tasks(ctx, bugsdir):
+    """ Returns the bugs, including archived bugs, in a revision or the working
+    directory, sorted by id.
+
+    The files the bugs are kept in, each sorted by id, are merged in one pass.
+    As in BugsDict, of the lines with the same id the last one read wins, and
+    the bugs file is read after the archive. """
+    paths = [path for name in ('archive', 'bugs')
+             for path in _rev_table_files(ctx, bugsdir, name)]
+    tasks = []
+    for task_id, _r, _p, task in heapq.merge(*[
+            _rev_file_tasks(ctx, path, rank)
+            for rank, path in enumerate(paths)]):
+        if tasks and tasks[-1]['id'] == task_id:
+            tasks[-1] = task
+        else:
+            tasks.append(task)
+    return tasks
+
+
+def _diff_revs(old, new, bugsdir, storage):
+    """ Returns the bugs which changed between two revisions (or a revision and
+    the working directory) as (id, title, changes) triples sorted by id, see
+    _bug_changes.  Bugs whose details changed have a details change; the
+    files their details are kept in are those storage's details_files() says.
+    """
+    old_tasks, new_tasks = _rev_tasks(old, bugsdir), _rev_tasks(new, bugsdir)
+    st = old.status(new, match=matchmod.match(
+        new.repo().root, '', ['path:' + bugsdir]))
+    changed = set(st.modified + st.added + st.removed)
+    packs = {}
+
+    def details_changed(task_id):
+        for relpath in storage.details_files(task_id):
+            path = bugsdir + '/' + util.pconvert(relpath)
+            if path not in changed:
+                continue
+            if relpath != _PACK_FILE:
+                return True
+            # every bug's details are in the pack, so compare its records
+            if path not in packs:
+                packs[path] = [_parse_pack(ctx[path].data()) if path in ctx
+                               else {} for ctx in (old, new)]
+            if packs[path][0].get(task_id) != packs[path][1].get(task_id):
+                return True
+        return False
+
+    changes = []
+    for old_task, new_task in _diff_tasks(old_tasks, new_tasks, True):
+        task = new_task or old_task
+        bug_changes = _bug_changes(old_task, new_task)
+        if details_changed(task['id']):
+            bug_changes.append(('details', None, None, None))
+        if bug_changes:
+            changes.append((task['id'], task['text'], bug_changes))
+    return changes
+
+
+def _commit_refs(ctx, bugsdir):
+    """ Returns the possible bug references in a changeset; any words in its
+    description which _FIX_REF takes for bug id prefixes, and the ids of the
+    details files it touched. """
+    refs = set()
+    for word in _HEX_WORD.findall(ctx.description().lower()):
+        match = _FIX_REF.match(word)
+        if match:
+            refs.add(match.group(1) or match.group(2))
+    details = bugsdir + '/details/'
+    for path in ctx.files():
+        if path.startswith(details) and path.endswith('.txt'):
+            refs.add(path[len(details):-4])
+    return refs
+
+
+_commit_indexes = {}
+# Changed when _commit_refs finds different references, so older caches are
+# read again
+_COMMIT_INDEX_VERSION = 2
+
+
+def _commit_index(repo):
+    """ Returns a mapping of revisions to their bug references, see
+    _commit_refs.  Revisions without references are omitted.
+
+    The mapping is kept in the repository cache along with the last revision
+    indexed, so only changesets added since then are read. """
+    unfi = repo.unfiltered()
+    bugsdir = util.pconvert(os.path.normpath(bugs_dir(repo.ui)))
+    tip = len(unfi) - 1
+    header = '%d %d %s %s' % (_COMMIT_INDEX_VERSION, tip, unfi[tip].hex(),
+                              bugsdir)
+    cached = _commit_indexes.get(unfi.root)
+    if cached and cached[0] == header:
+        return cached[1]
+
+    refs = {}
+    start = 0
+    stale = True
+    try:
+        with unfi.cachevfs('b/commits') as f:
+            version, rev, node, cachedbugsdir = f.readline().split()
+            rev = int(rev)
+            # if the last indexed revision changed history was rewritten
+            if (int(version) == _COMMIT_INDEX_VERSION
+                    and cachedbugsdir == bugsdir and rev <= tip
+                    and unfi[rev].hex() == node):
+                for line in f:
+                    fields = line.split()
+                    refs[int(fields[0])] = fields[1:]
+                start = rev + 1
+                stale = False
+    except (IOError, ValueError):
+        pass
+
+    if stale or start <= tip:
+        for rev in xrange(start, tip + 1):
+            found = _commit_refs(unfi[rev], bugsdir)
+            if found:
+                refs[rev] = sorted(found)
+        try:
+            with unfi.cachevfs('b/commits', 'w', atomictemp=True) as f:
+                f.write(header + '\n')
+                for rev in sorted(refs):
+                    f.write('%d %s\n' % (rev, ' '.join(refs[rev])))
+        except (IOError, OSError):
+            pass  # the cache is an optimization, e.g. the repo is read-only
+    _commit_indexes[unfi.root] = (header, refs)
+    return refs
+
+
+def _bug_commits(repo, bd, full_id):
+    """ Returns the revisions referencing the given bug, either by a unique
+    prefix of its id in their description or by changing its details. """
+    shortest = len(bd._prefix(full_id))
+    return [rev for rev, refs in sorted(_commit_index(repo).items())
+            if any(len(ref) >= shortest and full_id.startswith(ref)
+                   for ref in refs)]
+
+
+_repo_bugsdicts = {}
+
+
+def _repo_bugs(repo):
+    """ Returns a BugsDict of the repository's working copy, reusing the
+    previous one if the bugs and archive files have not changed.  Must be
+    treated as read-only. """
+    bugsdir = os.path.join(repo.root, bugs_dir(repo.ui))
+    storage = repo.ui.config("bugs", "storage", None) or 'text'
+    key = (storage, _STORAGE.get(storage, TextStorage)(bugsdir).stats())
+    cached = _repo_bugsdicts.get(bugsdir)
+    if cached is None or cached[0] != key:
+        cached = (key, BugsDict(bugsdir, lazy=True, storage=storage))
+        _repo_bugsdicts[bugsdir] = cached
+    return cached[1]
+
+
+def _conflict_block(local, other):
+    """Returns the local and other versions of a conflicting change, each a
+    list of lines, between conflict markers."""
+    lines = ['<<<<<<< local\n'] + local + ['=======\n'] + other
+    lines = [line if line.endswith('\n') else line + '\n' for line in lines]
+    return ''.join(lines) + '>>>>>>> other\n'
+
+
+def _merge_tool(ui, repo, hooktype, args=None, **kwargs):
+    """ Merges the bugs database by bug ID, rather than line by line, the
+    details pack by the details of each bug, and the change feed by event.
+
+    Invoked by Mercurial as a python: merge tool with the base, local, and
+    other versions of the file; the merged result is written to local.  If
+    both sides changed the same bug (or its details) both versions are written
+    between conflict markers, which reposetup has Mercurial check for, so the
+    file is left unresolved while the rest of the merge goes on.  A python:
+    tool can't fail without aborting the whole merge, so this always succeeds.
+    """
+    base, local, other = args
+    if os.path.basename(local) == _FEED_FILE:
+        with open(local, 'rb') as f:
+            local_lines = f.readlines()
+        with open(other, 'rb') as f:
+            appended = _merge_feeds(local_lines, f.readlines())
+        with open(local, 'ab') as f:
+            if local_lines and not local_lines[-1].endswith('\n'):
+                f.write('\n')
+            f.writelines(appended)
+        return False
+    if os.path.basename(local) == _PACK_FILE:
+        packs = [_read_pack(path) for path in (base, local, other)]
+        appended, conflicts = _merge_packs(*packs)
+        for task_id in conflicts:
+            ui.warn(_("b: conflicting changes to the details of bug %s\n")
+                    % task_id[:10])
+            appended.append((task_id, _conflict_block(
+                [packs[1][task_id]], [packs[2][task_id]])))
+        with open(local, 'ab') as f:
+            for task_id, text in appended:
+                f.write(_pack_record(task_id, text))
+        return False
+    # lines added by hand are read with the same time, as well as the same
+    # id, on each side
+    now = time.time()
+    tasks = []
+    for path in (base, local, other):
+        with open(path, 'r') as f:
+            tasks.append(_sorted_tasks(f.readlines(), now))
+    merged, conflicts = _merge_tasks(*tasks)
+    conflicts = dict(conflicts)
+    ours, theirs = [dict((task['id'], task) for task in side)
+                    for side in tasks[1:]]
+    with open(local, 'w') as f:
+        for task in merged:
+            fields = conflicts.get(task['id'])
+            if not fields:
+                f.writelines(_tasklines_from_tasks([task]))
+                continue
+            ui.warn(_("b: conflicting changes to bug %s (%s)\n")
+                    % (task['id'][:10], ', '.join(fields)))
+            if fields == ['deleted']:
+                sides = [ours.get(task['id']), theirs.get(task['id'])]
+            else:
+                # the merged bug has the local value of conflicting fields
+                other_task = dict(task)
+                for field in fields:
+                    other_task.pop(field, None)
+                    if field in theirs[task['id']]:
+                        other_task[field] = theirs[task['id']][field]
+                sides = [task, other_task]
+            f.write(_conflict_block(
+                *[_tasklines_from_tasks(filter(None, [side]))
+                  for side in sides]))
+    return False
+
+
+_WEB_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title></head>
+<body>
+<p><a href="/">Open</a> | <a href="/?open=false">Resolved</a> |
+<a href="/users">Users</a></p>
+<h1>%(title)s</h1>
+%(body)s
+</body></html>
+"""
+
+
+class _WebView(object):
+    """The pages served by the web command.
+
+    The BugsDict returned by make_bd() is kept between requests, and only
+    loaded again when the bugs directory changes.  Responses are tagged with
+    the state of the bugs directory, so requests from clients which already
+    have the current response are answered without rendering it again."""
+
+    def __init__(self, make_bd):
+        self._make_bd = make_bd
+        self._bd = None
+        self._stats = None
+
+    def bd(self):
+        """Returns the BugsDict, loading it again if the files changed"""
+        stats = self._bd.file_stats(True) if self._bd else None
+        if self._bd is None or stats != self._stats:
+            self._bd = self._make_bd()
+            self._stats = stats or self._bd.file_stats(True)
+        return self._bd
+
+    def respond(self, path, if_none_match=None):
+        """Returns the status, content type, body and ETag of the response to
+        a GET of path.  The body is empty if if_none_match, the value of the
+        request's If-None-Match header, lists the current ETag."""
+        url = urlparse.urlsplit(path)
+        bd = self.bd()
+        etag = '"%s"' % hashlib.sha1(
+            repr((self._stats, url.path, url.query))).hexdigest()
+        if if_none_match and (etag in [t.strip() for t in
+                                       if_none_match.split(',')]
+                              or if_none_match.strip() == '*'):
+            return 304, None, '', etag
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [p for p in url.path.split('/') if p]
+        try:
+            if parts in ([], ['list']):
+                bugs = self._bugs(bd, params)
+                rows = ''.join(
+                    '<tr><td><a href="/bug/%s">%s</a></td><td>%s</td>'
+                    '<td>%s</td><td>%s</td></tr>\n' % (
+                        bug.id, bug.prefix, cgi.escape(bug.text),
+                        cgi.escape(bug.owner or 'Nobody'),
+                        datetime.fromtimestamp(bug.time).strftime('%Y-%m-%d'))
+                    for bug in bugs)
+                return self._page(_('Bugs'), '<table>\n%s</table>\n<p>%s</p>'
+                                  % (rows, _('Found %d bugs') % len(bugs)),
+                                  etag)
+            if len(parts) == 2 and parts[0] == 'bug':
+                return self._page(bd.id(parts[1])[:10], '<pre>%s</pre>'
+                                  % cgi.escape(bd.details(parts[1])), etag)
+            if parts == ['users']:
+                rows = ''.join('<tr><td>%s</td><td>%d</td></tr>\n'
+                               % (cgi.escape(user), count) for user, count
+                               in sorted(bd._users_list().items()))
+                return self._page(_('Users'), '<table>\n%s</table>' % rows,
+                                  etag)
+            if parts == ['api', 'bugs']:
+                return self._json([bug._asdict()
+                                   for bug in self._bugs(bd, params)], etag)
+            if len(parts) == 3 and parts[:2] == ['api', 'bugs']:
+                task = bd[parts[2]]
+                record = bd._record(task)._asdict()
+                record['details'] = bd._read_details(task['id'])
+                return self._json(record, etag)
+            if parts == ['api', 'users']:
+                return self._json(bd._users_list(), etag)
+        except (UnknownPrefix, UnknownUser), e:
+            return 404, 'text/plain', str(e), etag
+        except Error, e:
+            return 400, 'text/plain', str(e), etag
+        return 404, 'text/plain', _('Not found'), etag
+
+    def _bugs(self, bd, params):
+        """Returns the bugs matching the list filters in params: open (true,
+        false or all), owner, grep, query and sort"""
+        is_open = params.get('open', 'true').lower()
+        is_open = None if is_open == 'all' else _truth(is_open)
+        return list(bd.iter_bugs(is_open, params.get('owner', '*'),
+                                 params.get('grep', ''),
+                                 params.get('sort', 'id').split(','),
+                                 query=params.get('query', '')))
+
+    def _page(self, title, body, etag):
+        return (200, 'text/html; charset=utf-8',
+                _WEB_PAGE % {'title': cgi.escape(title), 'body': body}, etag)
+
+    def _json(self, value, etag):
+        return 200, 'application/json', json.dumps(value, indent=2), etag
+
+
+class _WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a _WebView, set by subclasses as the view attribute"""
+    view = None
+    ui = None
+
+    def do_GET(self):
+        status, content_type, body, etag = self.view.respond(
+            self.path, self.headers.get('If-None-Match'))
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.ui.note("%s - %s\n" % (self.address_string(), format % args))
+
+
 class _CLI(object):
     """Command line interface."""
 
@@ -781,11 +3705,13 @@ class _CLI(object):
         self._bd = None
         self._revpath = None
 
-    def bd(self, opts):
+    def bd(self, opts, lazy=False, stream=False):
         if self._bd:
             raise Exception("Don't construct the BugsDict more than once.")
 
-        os.chdir(self.repo.root)
+        # Paths are absolute rather than relative to the cwd, which is left
+        # alone as the process may serve other commands (e.g. under chg)
+        root = self.repo.root
 
         # handle other revisions
         #
@@ -794,36 +3720,72 @@ class _CLI(object):
         # being accessed there, then simply set path to the temporary repodir
         if opts['rev']:
             # FIXME error on bad rev?
-            rev = str(self.repo[opts['rev']])
+            ctx = scmutil.revsingle(self.repo, opts['rev'])
+            rev = str(ctx)
             tempdir = tempfile.gettempdir()
             self._revpath = os.path.join(tempdir, 'b-' + rev)
             _mkdir_p(os.path.join(self._revpath, self.bugsdir))
-            relbugsdir = os.path.join(self.bugsdir, 'bugs')
-            revbugsdir = os.path.join(self._revpath, relbugsdir)
-            if not os.path.exists(revbugsdir):
-                _cat(self.ui, self.repo, relbugsdir, self._revpath, rev)
-            os.chdir(self._revpath)
+            bugsdir = util.pconvert(os.path.normpath(self.bugsdir))
+            # _cat fails on the bugs file if there are no bugs at the rev
+            paths = (_rev_table_files(ctx, bugsdir, 'bugs')
+                     or [bugsdir + '/bugs'])
+            paths += _rev_table_files(ctx, bugsdir, 'archive')
+            for path in paths:
+                revfile = os.path.join(self._revpath, path)
+                if not os.path.exists(revfile):
+                    _mkdir_p(os.path.dirname(revfile))
+                    _cat(self.ui, self.repo, path, self._revpath, rev)
+            # read the revision in the layout it was committed in, see migrate
+            layout = 'sharded' if any(
+                ShardedStorage.suffix + '/' in path[len(bugsdir):]
+                for path in paths) else 'text'
+            root = self._revpath
 
         fast_add = self.ui.configbool("bugs", "fast_add", False)
-        self._bd = BugsDict(self.bugsdir, self.user, fast_add)
+        cachedir = None if opts['rev'] else self.repo.cachevfs.join('b')
+        storage = self._storage()
+        if opts['rev'] and storage in ('text', 'sharded'):
+            storage = layout
+        budget = 0 if stream else self.ui.configbytes("bugs", "memory_budget",
+                                                      None)
+        self._bd = BugsDict(
+            os.path.join(root, self.bugsdir), self.user, fast_add,
+            cachedir=cachedir,
+            archive=self.ui.configbool("bugs", "archive", False),
+            lazy=lazy,
+            budget=budget,
+            storage=storage,
+            feed=self.ui.configbool("bugs", "feed", False))
         return self._bd
 
+    def _storage(self):
+        """Returns the name of the storage the bugs are kept in, see
+        _STORAGE"""
+        storage = self.ui.config("bugs", "storage", None)
+        if storage is None:
+            packed = self.ui.configbool("bugs", "packed_details", False)
+            storage = 'packed' if packed else 'text'
+        return storage
+
     def _cat_rev_details(self, task_id, rev):
         # Try to write the details file for this revision
         # if the lookup fails, we don't need to worry about it, the
-        # standard error handling will catch it and warn the user
+        # standard error handling will catch it and warn the user.  Files
+        # missing from the revision just mean the bug had no details then.
         fullid = self._bd.id(task_id)
-        detfile = os.path.join(self.bugsdir, 'details', fullid + '.txt')
-        revdetfile = os.path.join(self._revpath, detfile)
-        if not os.path.exists(revdetfile):
-            _mkdir_p(os.path.join(self._revpath, self.bugsdir, 'details'))
-            os.chdir(self.repo.root)  # TODO rearrange so this isn't necessary
-            _cat(self.ui, self.repo, detfile, self._revpath, rev)
-            os.chdir(self._revpath)
+        ctx = scmutil.revsingle(self.repo, rev)
+        for relpath in self._bd.storage.details_files(fullid):
+            detfile = os.path.join(self.bugsdir, relpath)
+            revdetfile = os.path.join(self._revpath, detfile)
+            if detfile in ctx and not os.path.exists(revdetfile):
+                _mkdir_p(os.path.dirname(revdetfile))
+                _cat(self.ui, self.repo, detfile, self._revpath, rev)
 
     def invoke(self, cmd, *args, **opts):
-        commands = ['add', 'assign', 'comment', 'details', 'edit', 'help', 'id',
-                    'list', 'rename', 'resolve', 'reopen', 'users', 'version']
+        commands = ['add', 'assign', 'comment', 'details', 'diff', 'dupes',
+                    'edit', 'feed', 'help', 'id', 'list', 'migrate', 'rename',
+                    'resolve', 'reopen', 'set', 'sql', 'users', 'verify',
+                    'version', 'web']
 
         candidates = [c for c in commands if c.startswith(cmd)]
         exact_candidate = [c for c in candidates if c == cmd]
@@ -836,11 +3798,13 @@ class _CLI(object):
         else:
             raise UnknownCommand(cmd)
 
-        getattr(self, cmd, None)(args, opts)
+        ret = getattr(self, cmd, None)(args, opts)
 
         # Add all new files to Mercurial - does not commit
         if not opts['rev']:
-            _track(self.ui, self.repo, self.bugsdir)
+            _track(self.ui, self.repo,
+                   os.path.join(self.repo.root, self.bugsdir))
+        return ret
 
     @ValidOpts('edit')
     def add(self, args, opts):
@@ -848,6 +3812,17 @@ class _CLI(object):
         if not title:
             raise InvalidCommand(_("Must specify issue title"))
         self.ui.write(self.bd(opts).add(title) + '\n')
+        # finding duplicates needs every bug in memory
+        if (not self._bd.fast_add and not self._bd._streaming
+                and self.ui.configbool("bugs", "dupes", True)):
+            dupes = self._bd.duplicates(title, self._dupe_threshold(),
+                                        self._bd.last_added_id)
+            if dupes:
+                self.ui.status(_("Possible duplicates:\n"))
+            for similarity, task_id in dupes[:5]:
+                self.ui.status("  %s - %s (%d%%)\n" % (
+                    self._bd._prefix(task_id), self._bd.bugs[task_id]['text'],
+                    similarity * 100))
         self._bd.write()
 
         self._maybe_edit(self._bd.last_added_id, opts)
@@ -881,17 +3856,65 @@ class _CLI(object):
 
         self._maybe_edit(task_id, opts)
 
-    @ValidOpts('rev')
-    @prefix_arg
-    def details(self, task_id, opts):
+    @ValidOpts('edit')
+    @prefix_plus_args
+    def set(self, task_id, args, opts):
+        if not args:
+            raise InvalidCommand(_("Must specify field=value to set"))
+        fields = _field_args(args)
+        bd = self.bd(opts)
+        for field, value in fields:
+            self.ui.write(bd.set(task_id, field, value) + '\n')
+        bd.write()
+
+        self._maybe_edit(task_id, opts)
+
+    @ValidOpts('rev', 'commits', 'resolved', 'owner', 'grep', 'alpha',
+               'chrono', 'since', 'until', 'query')
+    def details(self, args, opts):
+        filters = [opt for opt in ('resolved', 'grep', 'alpha', 'chrono',
+                                   'since', 'until', 'query') if opts[opt]]
+        if opts['owner'] != '*':
+            filters.append('owner')
+        if not args and not filters:
+            raise RequiresPrefix()
+        if args and filters:
+            raise InvalidCommand(_("--%s cannot be used with prefixes")
+                                 % filters[0])
+        bd = self.bd(opts, lazy=True)
+        if filters:
+            since = _timestamp(opts['since']) if opts['since'] else None
+            until = _timestamp(opts['until']) if opts['until'] else None
+            sort = 'title' if opts['alpha'] else 'time' if opts['chrono'] \
+                else 'id'
+            args = [bug.id for bug in bd.iter_bugs(
+                not opts['resolved'], opts['owner'], opts['grep'], sort,
+                since, until, opts['query'])]
         if opts['rev']:
-            self._cat_rev_details(task_id, opts['rev'])
-        self.ui.write(self.bd(opts).details(task_id) + '\n')
+            for task_id in args:
+                self._cat_rev_details(task_id, opts['rev'])
+        for i, text in enumerate(bd.iter_details(args)):
+            if i:
+                self.ui.write('\n')
+            self.ui.write(text + '\n')
+            if opts['commits']:
+                self._write_commits(bd.id(args[i]))
+
+    def _write_commits(self, full_id):
+        filtered = self.repo.changelog.filteredrevs
+        revs = [r for r in _bug_commits(self.repo, self._bd, full_id)
+                if r not in filtered]
+        self.ui.write(_("\nCommits:\n") if revs else
+                      _("\nNo Commits Found.\n"))
+        for rev in revs:
+            ctx = self.repo[rev]
+            self.ui.write("%d:%s %s\n" % (rev, short(ctx.node()),
+                                          ctx.description().split('\n')[0]))
 
     @ValidOpts()
     @prefix_arg
     def edit(self, task_id, opts):
-        self.bd(opts).edit(task_id, self.ui.geteditor())
+        self.bd(opts, lazy=True).edit(task_id, self.ui.geteditor())
 
     def _maybe_edit(self, task_id, opts):
         if opts['edit']:
@@ -904,7 +3927,7 @@ class _CLI(object):
         if not comment and not opts['edit']:
             raise InvalidCommand(
                 _("Must include comment text in command or use --edit"))
-        self.bd(opts).comment(task_id, comment)
+        self.bd(opts, lazy=True).comment(task_id, comment)
 
         self._maybe_edit(task_id, opts)
 
@@ -925,28 +3948,211 @@ class _CLI(object):
         self._maybe_edit(task_id, opts)
 
     @ValidOpts('alpha', 'chrono', 'grep', 'owner', 'resolved', 'rev',
-               'truncate')
+               'truncate', 'since', 'until', 'query', 'field', 'sort',
+               'activity', 'recent',
+               'watch')
     @zero_args
     def list(self, opts):
-        self.ui.write(self.bd(opts).list(
-            not opts['resolved'],
-            opts['owner'],
-            opts['grep'],
-            opts['alpha'],
-            opts['chrono'],
-            self.ui.termwidth() if opts['truncate'] else 0)
-                      + '\n')
+        if opts['rev'] and (opts['activity'] or opts['recent']
+                            or opts['watch']):
+            raise InvalidCommand(_("--activity, --recent and --watch cannot "
+                                   "be used with --rev"))
+        since = _timestamp(opts['since']) if opts['since'] else None
+        until = _timestamp(opts['until']) if opts['until'] else None
+
+        truncate = self.ui.termwidth() if opts['truncate'] else 0
+
+        def listing():
+            return self.bd(opts)._listing(
+                not opts['resolved'],
+                opts['owner'],
+                opts['grep'],
+                opts['alpha'],
+                opts['chrono'],
+                since,
+                until,
+                opts['query'],
+                opts['activity'],
+                opts['recent'],
+                _field_args(opts['field']),
+                opts['sort'])
+        if opts['watch']:
+            self._watch(listing, truncate, opts['activity'] or opts['recent'])
+        else:
+            bugs, columns, summary = listing()
+            for line in _list_lines(bugs, columns, truncate):
+                self.ui.write(line + '\n')
+            self.ui.write(summary + '\n')
+
+    def _watch(self, listing, truncate, details):
+        """Writes the bugs from listing(), and then polls the bugs database
+        for changes, listing them again when it changes and writing only the
+        bugs which were added, removed or changed.  Runs until interrupted."""
+        interval = self.ui.configwith(float, "bugs", "watch_interval", 2.0)
+        listed = listing()
+        for line in _list_lines(listed[0], listed[1], truncate):
+            self.ui.write(line + '\n')
+        self.ui.write(listed[2] + '\n')
+        self.ui.flush()
+        stats = self._bd.file_stats(details)
+        try:
+            while True:
+                time.sleep(interval)
+                latest = self._bd.file_stats(details)
+                if latest == stats:
+                    continue
+                stats = latest
+                self._bd = None  # reload
+                updated = listing()
+                changed = _diff_listings(listed, updated, truncate)
+                if changed:
+                    self.ui.write('\n'.join(changed) + '\n')
+                    self.ui.flush()
+                listed = updated
+        except KeyboardInterrupt:
+            pass
+
+    def _dupe_threshold(self):
+        return float(self.ui.config("bugs", "dupe_threshold", 0.5))
+
+    @ValidOpts('json')
+    def diff(self, args, opts):
+        if not 1 <= len(args) <= 2:
+            raise InvalidCommand(_("Must specify one or two revisions"))
+        old = scmutil.revsingle(self.repo, args[0])
+        new = (scmutil.revsingle(self.repo, args[1]) if len(args) == 2
+               else self.repo[None])
+        bugsdir = util.pconvert(os.path.normpath(self.bugsdir))
+        storage = _STORAGE.get(self._storage(), TextStorage)(
+            os.path.join(self.repo.root, self.bugsdir))
+        changes = _diff_revs(old, new, bugsdir, storage)
+        prefixes = _prefixes(
+            set(task['id'] for task in _rev_tasks(new, bugsdir))
+            | set(task_id for task_id, _t, _c in changes))
+        if opts['json']:
+            self.ui.write(json.dumps([
+                {'id': task_id, 'prefix': prefixes[task_id], 'title': title,
+                 'changes': [dict({'change': change, 'from': old_value,
+                                   'to': new_value},
+                                  **({'field': field} if field else {}))
+                             for change, field, old_value, new_value
+                             in bug_changes]}
+                for task_id, title, bug_changes in changes], indent=2) + '\n')
+            return
+        messages = {'added': _("added"), 'removed': _("removed"),
+                    'renamed': _("renamed from: %(old)s"),
+                    'reassigned': _("reassigned from %(old)s to %(new)s"),
+                    'resolved': _("resolved"), 'reopened': _("reopened"),
+                    'set': _("set %(field)s from '%(old)s' to '%(new)s'"),
+                    'details': _("details changed")}
+        for task_id, title, bug_changes in changes:
+            self.ui.write('%s - %s\n' % (prefixes[task_id], title))
+            for change, field, old_value, new_value in bug_changes:
+                unset = '' if field else 'Nobody'
+                self.ui.write('    %s\n' % messages[change] % {
+                    'field': field, 'old': old_value or unset,
+                    'new': new_value or unset})
+        self.ui.write(_("Found %d changed bug%s\n") % (
+            len(changes), '' if len(changes) == 1 else 's'))
+
+    @ValidOpts('rev')
+    @zero_args
+    def dupes(self, opts):
+        self.ui.write(self.bd(opts).dupes(self._dupe_threshold()) + '\n')
+
+    @ValidOpts('since', 'json')
+    @zero_args
+    def feed(self, opts):
+        bd = self.bd(opts, lazy=True)
+        events = [dict(event, cursor=cursor) for cursor, event
+                  in bd.events(opts['since'] or None)]
+        if opts['json']:
+            self.ui.write(json.dumps(events, indent=2, sort_keys=True) + '\n')
+            return
+        if not events and not bd.feed and not opts['since']:
+            self.ui.status(_("No events, set bugs.feed=true to record them\n"))
+        messages = {'add': _("added"), 'rename': _("renamed from: %(from)s"),
+                    'assign': _("assigned to %(owner)s"),
+                    'comment': _("commented: %(comment)s"),
+                    'set': _("set %(field)s to '%(value)s'"),
+                    'resolve': _("resolved"), 'reopen': _("reopened")}
+        for event in events:
+            prefix = bd._prefix(event['bug'])
+            values = dict(event, owner=event.get('owner') or 'Nobody')
+            self.ui.write('%s %s %s - %s: %s\n' % (
+                event['cursor'], event['user'] or 'Nobody', prefix,
+                event['title'], messages[event['op']] % values))
+
+    @ValidOpts()
+    def migrate(self, args, opts):
+        if len(args) != 1:
+            raise InvalidCommand(_("Must specify the storage to migrate to, "
+                                   "one of %s") % ', '.join(sorted(_STORAGE)))
+        self.ui.write(self.bd(opts).migrate(args[0]) + '\n')
+        # mark the files migrate removed as removed
+        self.ui.pushbuffer(error=True)
+        commands.remove(self.ui, self.repo,
+                        os.path.join(self.repo.root, self.bugsdir), after=True)
+        self.ui.popbuffer()
+
+    @ValidOpts('json')
+    def sql(self, args, opts):
+        query = ' '.join(args).strip()
+        if not query:
+            raise InvalidCommand(_("Must specify a query"))
+        # the mirror reads the bugs files itself
+        columns, rows = self.bd(opts, stream=True).sql(query)
+        if opts['json']:
+            self.ui.write(json.dumps([dict(zip(columns, row)) for row in rows],
+                                     indent=2) + '\n')
+            return
+        if columns:
+            self.ui.write(' | '.join(columns) + '\n')
+        for row in rows:
+            self.ui.write(' | '.join('' if value is None else str(value)
+                                     for value in row) + '\n')
 
     @ValidOpts('rev')
     @prefix_arg
     def id(self, task_id, opts):
-        self.ui.write(self.bd(opts).id(task_id) + '\n')
+        self.ui.write(self.bd(opts, lazy=True).id(task_id) + '\n')
 
     @ValidOpts()
     @zero_args
     def help(self, _opts):
         commands.help_(self.ui, 'b')
 
+    @ValidOpts('repair')
+    @zero_args
+    def verify(self, opts):
+        # read through the bugs files rather than parsing them up front, which
+        # fails on the malformed lines verify is meant to report
+        report, remaining = self.bd(opts, stream=True).verify(opts['repair'])
+        if opts['repair']:
+            # mark the files repair removed as removed
+            self.ui.pushbuffer(error=True)
+            commands.remove(self.ui, self.repo,
+                            os.path.join(self.repo.root, self.bugsdir),
+                            after=True)
+            self.ui.popbuffer()
+        self.ui.write(report + '\n')
+
+        # copies of revisions made by --rev are never cleaned up
+        tempdir = tempfile.gettempdir()
+        copies = [os.path.join(tempdir, name) for name in os.listdir(tempdir)
+                  if re.match(r'^b-[0-9a-f]{12}$', name)
+                  and scmutil.isrevsymbol(self.repo, name[2:])]
+        if copies and opts['repair']:
+            for path in copies:
+                shutil.rmtree(path, ignore_errors=True)
+            self.ui.status(_("Removed %d cached revision%s from %s\n") % (
+                len(copies), '' if len(copies) == 1 else 's', tempdir))
+        elif copies:
+            self.ui.status(_("Found %d cached revision%s in %s, which "
+                             "--repair removes\n") % (
+                len(copies), '' if len(copies) == 1 else 's', tempdir))
+        return 1 if remaining else 0
+
     @ValidOpts()
     @zero_args
     def version(self, _opts):
@@ -954,13 +4160,136 @@ class _CLI(object):
         self.ui.write(
             _("b Version %s - built %s\n") % (version_str, _build_date))
 
+    @ValidOpts('address', 'port')
+    @zero_args
+    def web(self, opts):
+        def make_bd():
+            self._bd = None
+            return self.bd(opts)
+
+        class Handler(_WebHandler):
+            view = _WebView(make_bd)
+            ui = self.ui
+        server = BaseHTTPServer.HTTPServer((opts['address'], opts['port']),
+                                           Handler)
+        self.ui.status(_("Serving bugs at http://%s:%d/\n")
+                       % server.server_address[:2])
+        self.ui.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
 
 cmdtable = {}
 command = registrar.command(cmdtable)
+revsetpredicate = registrar.revsetpredicate()
+templatekeyword = registrar.templatekeyword()
 testedwith = '4.7'  # And others circa 2010, before this variable existed
 buglink = 'http://hg.mwdiamond.com/b'
 
 
+def reposetup(ui, repo):
+    """Registers _merge_tool for the bugs database, archive, details pack and
+    change feed, unless bugs.merge is false or the user has already configured
+    a tool for them, and _fixes_hook if bugs.fixes is true."""
+    if not repo.local():
+        return
+    script = os.path.abspath(__file__)
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    if repo.ui.configbool("bugs", "fixes", False):
+        for hook in ('commit.b', 'changegroup.b'):
+            if not repo.ui.config('hooks', hook, None):
+                repo.ui.setconfig('hooks', hook,
+                                  'python:%s:_fixes_hook' % script, 'b')
+    if not repo.ui.configbool("bugs", "merge", True):
+        return
+    patterns = ['path:%s' % os.path.join(bugs_dir(repo.ui), name)
+                for name in ('bugs', 'archive', _PACK_FILE, _FEED_FILE,
+                             'bugs' + ShardedStorage.suffix,
+                             'archive' + ShardedStorage.suffix)]
+    patterns = [p for p in patterns if not repo.ui.config('merge-patterns', p)]
+    if not patterns:
+        return
+    # disabled only excludes the tool from being picked for other files,
+    # merge-patterns and --tool b still use it
+    for key, value in [('executable', 'python:%s:_merge_tool' % script),
+                       ('args', '$base $local $other'),
+                       ('premerge', 'False'),
+                       ('check', 'conflicts'),
+                       ('disabled', 'True')]:
+        repo.ui.setconfig('merge-tools', 'b.' + key, value, 'b')
+    for pattern in patterns:
+        repo.ui.setconfig('merge-patterns', pattern, 'b', 'b')
+
+
+def _fixes_hook(ui, repo, hooktype, node=None, node_last=None, **kwargs):
+    """ Resolves the bugs which new changesets say they fix, see
+    BugsDict.fix().
+
+    Registered by reposetup as the commit and changegroup hooks when
+    bugs.fixes is true, so a push or pull reads every incoming changeset in
+    one pass, against one BugsDict, and writes the bugs once, after the
+    transaction bringing them in is closed.  The bugs of the working copy are
+    changed, to be committed like any other change, so only changesets
+    descending from it are read, and none if there's no working copy. """
+    parent = repo['.']
+    if node is None or parent.node() == nullid:
+        return False
+    changesets = []
+    for rev in repo.revs('%d:%d and descendants(%d)', repo[node].rev(),
+                         repo[node_last or node].rev(), parent.rev()):
+        ctx = repo[rev]
+        if _fix_refs(ctx.description()):
+            changesets.append((ctx.hex()[:12], ctx.user(), ctx.description()))
+    if not changesets:
+        return False
+    cli = _CLI(ui, repo)
+    bd = cli.bd({'rev': ''}, lazy=True)
+    messages = bd.fix(changesets)
+    bd.write()
+    if hooktype == 'commit':
+        # the store is locked during a transaction, and the working copy
+        # can't be locked after it
+        _track(ui, repo, os.path.join(repo.root, cli.bugsdir))
+    for message in messages:
+        ui.status('b: %s\n' % message)
+    return False
+
+
+@revsetpredicate('bug(prefix)', weight=10)
+def revset_bug(repo, subset, x):
+    """Changesets referencing the bug with the given prefix, either by
+    including a unique prefix of its id in their description or by changing
+    its details file.
+    """
+    prefix = revsetlang.getstring(x, _("bug requires a bug prefix"))
+    bd = _repo_bugs(repo)
+    try:
+        full_id = bd.id(prefix)
+    except Error, e:
+        raise Abort(e.msg)
+    return subset & smartset.baseset(_bug_commits(repo, bd, full_id))
+
+
+@templatekeyword('bugs', requires={'repo', 'ctx'})
+def template_bugs(context, mapping):
+    """List of strings. The ids of the bugs referenced by the changeset, see
+    the bug() revset."""
+    repo = context.resource(mapping, 'repo')
+    ctx = context.resource(mapping, 'ctx')
+    bd = _repo_bugs(repo)
+    bugs = set()
+    for ref in _commit_index(repo).get(ctx.rev(), ()):
+        matched = bd._matches(ref)
+        if len(matched) == 1:
+            bugs.add(matched[0])
+    return templateutil.compatlist(context, mapping, 'bug', sorted(bugs))
+
+
 #
 # Command line processing
 #
@@ -975,6 +4304,24 @@ buglink = 'http://hg.mwdiamond.com/b'
              ('a', 'alpha', False, _('Sort list alphabetically')),
              ('c', 'chrono', False, _('Sort list chronologically')),
              ('T', 'truncate', False, _('Truncate list output to fit window')),
+             ('', 'since', '',
+              _('List bugs filed since DATE, or events after CURSOR')),
+             ('', 'until', '', _('List bugs filed before DATE')),
+             ('', 'query', '', _('List bugs matching QUERY')),
+             ('', 'field', [], _('List bugs whose FIELD=VALUE')),
+             ('', 'sort', [], _('Sort list by FIELD')),
+             ('', 'activity', False,
+              _('List the number of comments and last activity of bugs')),
+             ('', 'recent', False, _('Sort list by last activity')),
+             ('', 'watch', False,
+              _('Keep listing bugs as they change, until interrupted')),
+             ('', 'commits', False,
+              _('List the changesets which reference the bug')),
+             ('', 'address', 'localhost', _('Address for web to listen on')),
+             ('', 'port', 8000, _('Port for web to listen on')),
+             ('', 'repair', False, _('Repair the problems verify finds')),
+             ('', 'json', False,
+              _('Output the results of diff, feed or sql as JSON')),
              ('', 'rev', '',
               _('Run a read-only command against a different revision'))
          ],
@@ -987,7 +4334,7 @@ def execute_command(ui, repo, cmd='list', *args, **opts):
     
     add text [-e]
         Adds a new open bug to the database, if user is set in the config files,
-        assigns it to user
+        assigns it to user, and lists any open bugs with similar titles
         
         -e here and elsewhere launches the details editor for the issue upon
         successful execution of the command
@@ -1010,8 +4357,24 @@ def execute_command(ui, repo, cmd='list', *args, **opts):
         Use 'me' to assign the bug to the current user,
         and 'Nobody' to remove its assignment.
         
-    details [--rev rev] prefix [-e]
-        Prints the extended details of the specified bug
+    set prefix field=value... [-e]
+        Sets custom fields of the bug, such as priority=high or
+        milestone=2.0, or removes a field given no value (field=).  Fields
+        are named by letters, digits and _, and values may not contain ','
+        or '|'.  They are shown by details, and filtered and sorted on by list
+
+    details [--rev rev] prefix... [--commits]
+        Prints the extended details of the specified bugs
+
+    details [--rev rev] [-r] [-o owner] [-g text] [-a|-c] [--since date]
+            [--until date] [--query query] [--commits]
+        Prints the extended details of the bugs list would list with the same
+          options, e.g. every bug resolved for a release
+
+        --commits also lists the changesets which reference the bug, either
+          by a unique prefix of its id in their description or by changing
+          its details.  These are also available as the bug(prefix) revset
+          and the {bugs} template keyword.
         
     edit prefix
         Launches your specified editor to provide additional details 
@@ -1026,7 +4389,9 @@ def execute_command(ui, repo, cmd='list', *args, **opts):
     reopen prefix [-e]
         Marks the specified bug as open
         
-    list [--rev rev] [-r] [-o owner] [-g search] [-a|-c]
+    list [--rev rev] [-r] [-o owner] [-g search] [-a|-c] [--since date]
+         [--until date] [--query query] [--field field=value] [--sort field]
+         [--activity] [--recent] [--watch]
         Lists all bugs, with the following filters:
         
             -r list resolved bugs.
@@ -1040,16 +4405,96 @@ def execute_command(ui, repo, cmd='list', *args, **opts):
             -a list bugs alphabetically
             
             -c list bugs chronologically
+
+            --since, --until list bugs filed in the given window.  Dates are
+               either YYYY-MM-DD [HH:MM] (or YYYY-MM, or YYYY) or an age such
+               as 12h, 30d, or 2w
+
+            --query filter by a list of terms which must all match:
+               field:value, field~regex, or field>value (also >=, <, <=),
+               e.g. owner:me open:false title~"crash(es)?" time>30d
+
+            --activity list the number of comments on each bug (- if it has
+               no details) and the date of its last comment, or when it was
+               filed if there are none
+
+            --recent list bugs by their last activity
+
+            --watch keep running, and when the bugs change print the lines
+               of the bugs which were removed (-), added (+) or changed
+               (both)
         
+    diff rev1 [rev2] [--json]
+        Lists the bugs which were added, removed, renamed, reassigned,
+        resolved or reopened, or whose custom fields or details changed,
+        between two revisions, or a revision and the working directory
+
+        --json outputs the changes as a list of objects with the bug's id,
+          prefix and title, and its changes, each with the kind of change
+          and the old and new values (if any)
+
+    dupes [--rev rev]
+        Lists groups of open bugs with similar titles, which may be duplicates
+        of one another
+
+    feed [--since cursor] [--json]
+        Lists the changes made to bugs by add, rename, assign, comment,
+        resolve and reopen, oldest first, each starting with a cursor.  Only
+        recorded if bugs.feed is set.
+
+        --since only lists the changes after the one with the given cursor,
+          so a consumer can keep the last cursor it saw and read only the
+          changes since
+
+        --json outputs the changes as a list of objects with the event's
+          cursor, id, time, user and op, the bug's id and title, and the
+          op's from, owner or comment
+
     id [--rev rev] prefix [-e]
         Takes a prefix and returns the full id of that bug
     
+    sql query [--json]
+        Runs a read-only SQL query against a SQLite mirror of the bugs, kept
+        in the repository's cache and updated with the bugs which changed
+        before each query.  The bugs table has the id, title, owner, open,
+        time and archived columns of each bug, and the search table is a
+        full-text index of the id, title and details of each bug, e.g.
+
+            hg b sql "SELECT owner, count(*) FROM bugs GROUP BY owner"
+            hg b sql "SELECT id, title FROM search WHERE details MATCH 'crash'"
+
+        --json outputs the rows as a list of objects
+
+    verify [--repair]
+        Checks the bugs database and details for problems left by hand edits
+        or bad merges, such as malformed lines, duplicate ids, details without
+        a bug and unresolved merge conflicts, and lists them with their line
+        numbers.  Exits with status 1 if problems remain.
+
+        --repair fixes the problems which can be: missing fields are filled
+          in, duplicate ids b would ignore are dropped, stray details are
+          removed, and so are the copies of revisions --rev leaves behind
+
+    migrate storage
+        Moves the bugs database to another storage backend, text, packed or
+        sharded, e.g. to split the bugs into shards by the first characters
+        of their ids.  Set storage in the [bugs] section of your config to
+        the new backend afterwards
+
     version
         Outputs the version number of b being used in this repository
+
+    web [--address address] [--port port]
+        Serves a read-only view of the bugs over HTTP, until interrupted.
+        Pages list bugs (/, taking open=true|false|all, owner, grep, query
+        and sort parameters), show a bug's details (/bug/prefix) and list
+        users (/users); the same are available as JSON from /api/bugs,
+        /api/bugs/prefix and /api/users.  The bugs are reloaded when they
+        change, and responses carry an ETag for conditional requests.
     """
     try:
         try:
-            _CLI(ui, repo).invoke(cmd, *args, **opts)
+            return _CLI(ui, repo).invoke(cmd, *args, **opts)
         except Exception:
             if 'HG_B_LOG_TRACEBACKS' in os.environ:
                 traceback.print_exc(file=sys.stderr)
@@ -1089,7 +4534,8 @@ def bugs_dir(ui):
 def status(ui, repo, revision='tip', ignore=None):
     """Indicates the state of a revision relative to the bugs database.  In
     essence, this function is a wrapper for `hg stat --change x` which strips
-    out changes to the bugs directory.
+    out changes to the bugs directory.  Like it, a merge is compared to its
+    first parent, so the changes it brings in from the second count.
 
     A revision either:
     * Does not touch the bugs directory:
@@ -1109,21 +4555,46 @@ def status(ui, repo, revision='tip', ignore=None):
     
     You may pass a list of Mercurial patterns (see `hg help patterns`) relative
     to the repository root to exclude from the returned list.
+
+    To classify many revisions, use statuses() instead.
+    """
+    return _status_classifier(ui, repo, ignore)(repo[revision])
+
+
+def statuses(ui, repo, revs='tip', ignore=None):
+    """Classifies every revision in the revset revs, like status().
+
+    Returns a list of (revision number, status) pairs, in the order of the
+    revset.  The revset is resolved and the ignore patterns compiled once,
+    so this is much cheaper than calling status() for each revision, e.g.
+    from a hook:
+        b.statuses(ui, repo, '%s:' % node)
     """
-    # TODO should this just be deleted? It's unused internally and has no tests
-    if ignore:
-        raise Error("UNIMPLEMENTED")  # TODO this was never implemented
-    bugsdir = bugs_dir(ui)
-    ui.pushbuffer()
-    commands.status(ui, repo, change=revision, no_status=True, print0=True)
-    files = ui.popbuffer().split('\0')
-    bug_change = False
-    ret = []
-    for f in files:
-        if f.strip():
+    classify = _status_classifier(ui, repo, ignore)
+    return [(rev, classify(repo[rev]))
+            for rev in scmutil.revrange(repo, [revs])]
+
+
+def _status_classifier(ui, repo, ignore=None):
+    """Returns a function which takes a changectx and returns its status, see
+    status()"""
+    bugsdir = util.pconvert(os.path.normpath(bugs_dir(ui))) + '/'
+    ignored = matchmod.match(repo.root, '', ignore) if ignore else None
+
+    def classify(ctx):
+        # the files a changeset lists are read without comparing any file
+        # contents, but for a merge they're only the files which needed merging
+        if ctx.p2().node() == nullid:
+            files = ctx.files()
+        else:
+            files = sum(repo.status(ctx.p1(), ctx)[:3], [])
+        bug_change = False
+        ret = []
+        for f in sorted(files):
             if f.startswith(bugsdir):
                 bug_change = True
-            else:
+            elif not ignored or not ignored(f):
                 ret.append(f)
-    ui.write(ret if bug_change else None)
-    ui.write('\n')
+        return ret if bug_change else None
+
+    return classify